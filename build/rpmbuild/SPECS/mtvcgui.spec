@@ -54,6 +54,7 @@ mkdir -p $ICODIR/128x128/apps
 cp ui/icons/128x128/mtvcgui.png $ICODIR/128x128/apps
 cp -r * $LIBDIR/
 ln -fs ../../opt/mtvcgui/run.py $BINDIR/mtvcgui
+ln -fs ../../opt/mtvcgui/rec.py $BINDIR/mtvcgui-rec
 
 %clean
 rm -rf $RPM_BUILD_ROOT
@@ -63,6 +64,7 @@ rm -rf $RPM_BUILD_ROOT
 %doc
 /opt/mtvcgui/*
 /usr/bin/mtvcgui
+/usr/bin/mtvcgui-rec
 /usr/share/applications/mtvcgui.desktop
 /usr/share/icons/hicolor/16x16/apps/mtvcgui.png
 /usr/share/icons/hicolor/22x22/apps/mtvcgui.png
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+# Author: Santiago Bruno
+# License: GPL v3
+# Web pages: http://www.santiagobruno.com.ar/programas.html
+#            http://code.google.com/p/mtvcgui/
+
+"""Degradation of the encoding quality while a recording can't keep up with
+real time, e.g. because other programs are using the CPU. A slightly worse
+encode is better than one with lots of skipped frames.
+"""
+
+import time
+from collections import deque
+
+import utils
+
+#sizes tried after the fastest preset, relative to the original size
+SCALE_FACTORS = (0.75, 0.5)
+#codecs that only copy the video, mencoder doesn't apply -vf with them
+COPY_CODECS = ('raw', 'copy')
+
+
+def scale_parameters(parameters, factor):
+    """Returns a copy of parameters scaling the video to factor times the
+    scaled size (or the captured size if it isn't scaled)"""
+    try:
+        width = int(parameters.get('scalewidth'))
+        height = int(parameters.get('scaleheight'))
+    except (TypeError, ValueError):
+        width, height = utils.get_frame_size(parameters)
+    parameters = dict(parameters)
+    #codecs work with macroblocks of 16x16
+    parameters['scalewidth'] = str(max(16, int(width * factor) / 16 * 16))
+    parameters['scaleheight'] = str(max(16, int(height * factor) / 16 * 16))
+    return parameters
+
+
+def get_steps(parameters):
+    """Returns the (name, parameters) that are used in turn as the
+    recording keeps falling behind: the faster presets of the video codec
+    and then smaller sizes (if the video is encoded). If the parameters
+    don't use a preset of the ladder the faster half of it is used."""
+    import calibrate
+    ladder = calibrate.get_ladder(parameters)
+    current = calibrate.current_preset_index(parameters, ladder)
+    if current is None:
+        first = len(ladder) / 2
+    else:
+        first = current + 1
+    steps = [(preset[0], calibrate.apply_preset(parameters, preset, ladder))
+             for preset in ladder[first:]]
+    fastest = steps and steps[-1][1] or parameters
+    if fastest.get('videocodec') not in COPY_CODECS:
+        for factor in SCALE_FACTORS:
+            scaled = scale_parameters(fastest, factor)
+            steps.append(("scale %sx%s" % (scaled['scalewidth'],
+                                           scaled['scaleheight']), scaled))
+    #a step that changes nothing would restart mencoder for no speed-up
+    result = []
+    for name, step_parameters in steps:
+        previous = result and result[-1][1] or parameters
+        if step_parameters != previous:
+            result.append((name, step_parameters))
+    return result
+
+
+class DegradationController(object):
+    """Watches the metrics of a recording and decides when the next step of
+    the ladder must be used: when for a whole window of adaptive_window
+    seconds the video advanced slower than adaptive_min_speed, or more than
+    adaptive_max_skipped frames were skipped. After a change the new
+    segment gets a whole window before it is judged.
+    """
+
+    def __init__(self, parameters):
+        self.steps = get_steps(parameters)
+        self.level = 0
+        self.window = parameters.get('adaptive_window', 30)
+        self.min_speed = parameters.get('adaptive_min_speed', 0.95)
+        self.max_skipped = parameters.get('adaptive_max_skipped', 10)
+        #(time, position, skipped frames) in the current window
+        self.samples = deque()
+        self.window_start = None
+        #(time, step name, reason) of each change made
+        self.changes = []
+
+    def reset(self):
+        """Forgets the samples, call it when a new segment starts"""
+        self.samples.clear()
+        self.window_start = None
+
+    def falling_behind(self, metrics, now=None):
+        """Adds the current metrics to the window and returns the reason why
+        the recording is falling behind, or None if it keeps up or there
+        are no more steps"""
+        if now is None:
+            now = time.time()
+        if metrics.updated is None:
+            return None
+        if self.window_start is None:
+            self.window_start = now
+        self.samples.append((now, metrics.position, metrics.skipped_frames))
+        while self.samples[0][0] < now - self.window:
+            self.samples.popleft()
+        if self.level >= len(self.steps) or \
+            now - self.window_start < self.window:
+            return None
+
+        first_time, first_position, first_skipped = self.samples[0]
+        skipped = metrics.skipped_frames - first_skipped
+        if skipped > self.max_skipped:
+            return "%d frames skipped in %d seconds" % (skipped, self.window)
+        if now > first_time:
+            speed = (metrics.position - first_position) / (now - first_time)
+            if speed < self.min_speed:
+                return "encoding at %.2fx real time" % speed
+        return None
+
+    def next_step(self, reason=''):
+        """Returns the (name, parameters) of the next step and logs it"""
+        name, parameters = self.steps[self.level]
+        self.level += 1
+        self.changes.append((time.time(), name, reason))
+        print "Recording falling behind (%s), switching to %s" % (reason,
+                                                                  name)
+        self.reset()
+        return name, parameters
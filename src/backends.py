@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+
+# Author: Santiago Bruno
+# License: GPL v3
+# Web pages: http://www.santiagobruno.com.ar/programas.html
+#            http://code.google.com/p/mtvcgui/
+
+"""Programs that capture and encode. The same parameters are turned into
+the commands of mencoder (the default) or ffmpeg, as selected by the
+backend setting of the .ini file:
+
+    backend = ffmpeg
+
+ffmpeg is maintained in all the distributions, but it can't tune the TV
+card, mplayer is used to tune it before capturing. Its video filters
+(ffmpeg_filters) use the ffmpeg syntax, the extra filters of the GUI are
+only used by mencoder. The mencoder codecs ffmpeg has no encoder for
+(e.g. -ovc nuv) are recorded with mencoder.
+"""
+
+import os
+import time
+from subprocess import Popen, PIPE, STDOUT, call
+
+import utils
+from progress import ProgressParser
+
+#ffmpeg encoders by mencoder -ovc and -oac values
+FFMPEG_VIDEO_CODECS = {'x264': 'libx264', 'xvid': 'libxvid',
+                       'raw': 'rawvideo', 'copy': 'copy'}
+FFMPEG_AUDIO_CODECS = {'mp3lame': 'libmp3lame', 'pcm': 'pcm_s16le',
+                       'copy': 'copy', 'faac': 'aac',
+                       'twolame': 'libtwolame', 'toolame': 'mp2'}
+#mencoder -ovc values ffmpeg has no encoder for
+FFMPEG_UNSUPPORTED_CODECS = ('nuv', 'frameno', 'vfw', 'qtvideo')
+#ffmpeg encoders by -lavcopts vcodec and acodec values, when they differ
+FFMPEG_LAVC_CODECS = {'msmpeg4': 'msmpeg4v3', 'vorbis': 'libvorbis'}
+
+
+class MencoderBackend(object):
+    """Captures and encodes with mencoder, previews with mplayer"""
+
+    name = 'mencoder'
+
+    def capture_command(self, parameters, outputfile=None,
+                        output_format=None, raw=False):
+        return utils.generate_command(parameters, outputfile=outputfile,
+                                      output_format=output_format, raw=raw)
+
+    def encode_command(self, parameters, inputs, outputfile, extra=None):
+        return utils.generate_encode_command(parameters, inputs, outputfile,
+                                             extra)
+
+    def cut_options(self, frame, fps, frames=None):
+        """Returns the options that encode frames frames (all the rest if
+        None) from the keyframe number frame"""
+        #half a frame later so rounding can't make it seek to the keyframe
+        #before, mencoder seeks to keyframes
+        options = ['-ss', '%.3f' % ((frame + 0.5) / fps)]
+        if frames is not None:
+            options += ['-frames', str(frames)]
+        return options
+
+    def concat_command(self, parameters, inputs, outputfile):
+        """Returns the command that joins the encoded files without
+        re-encoding them"""
+        return ['mencoder'] + list(inputs) + \
+            ['-ovc', 'copy', '-oac', 'copy', '-o', outputfile]
+
+    def preview_command(self, parameters):
+        return utils.generate_mplayer_command(parameters)
+
+    def tune_command(self, parameters):
+        #mencoder tunes the card itself
+        return None
+
+    def unsupported_codec(self, parameters):
+        return None
+
+
+class FfmpegBackend(object):
+    """Captures from v4l2 and ALSA and encodes with ffmpeg, previews with
+    ffplay"""
+
+    name = 'ffmpeg'
+
+    def unsupported_codec(self, parameters):
+        """Returns the codec of the parameters ffmpeg can't encode, or
+        None"""
+        if parameters.get('videocodec') in FFMPEG_UNSUPPORTED_CODECS:
+            return parameters.get('videocodec')
+        return None
+
+    def video_codec_options(self, parameters):
+        videocodec = parameters.get('videocodec')
+        if videocodec == 'lavc':
+            codec = parameters.get('lavc_videocodec') or 'mpeg4'
+            options = ['-c:v', FFMPEG_LAVC_CODECS.get(codec, codec)]
+            if parameters.get('lavc_videobitrate'):
+                options += ['-b:v', parameters.get('lavc_videobitrate') + 'k']
+        elif videocodec == 'x264':
+            options = ['-c:v', 'libx264']
+            extra = []
+            for option in (parameters.get('x264_extra_opts') or '').split(':'):
+                key, sep, value = option.partition('=')
+                #ffmpeg selects them with its own options
+                if key in ('preset', 'tune', 'profile'):
+                    options += ['-' + key, value]
+                elif option:
+                    extra.append(option)
+            if parameters.get('x264_cbr') and parameters.get('x264_bitrate'):
+                options += ['-b:v', parameters.get('x264_bitrate') + 'k']
+            elif parameters.get('x264_dropdown_value') == 'qp' and \
+                parameters.get('x264_qp'):
+                options += ['-qp', parameters.get('x264_qp')]
+            elif parameters.get('x264_dropdown_value') == 'crf' and \
+                parameters.get('x264_crf'):
+                options += ['-crf', parameters.get('x264_crf')]
+            if extra:
+                options += ['-x264-params', ':'.join(extra)]
+        elif videocodec == 'xvid':
+            options = ['-c:v', 'libxvid']
+            if parameters.get('xvid_cbr') and parameters.get('xvid_bitrate'):
+                options += ['-b:v', parameters.get('xvid_bitrate') + 'k']
+            elif parameters.get('xvid_fixed_quant'):
+                options += ['-qscale:v', parameters.get('xvid_fixed_quant')]
+        else:
+            options = ['-c:v', FFMPEG_VIDEO_CODECS.get(videocodec,
+                                                       videocodec)]
+        if videocodec not in ('raw', 'copy'):
+            #the -threads of ffmpeg_extra_params come later and win
+            options += ['-threads', str(utils.get_encoder_threads(parameters))]
+        return options
+
+    def audio_codec_options(self, parameters):
+        audiocodec = parameters.get('audiocodec')
+        if audiocodec == 'none':
+            return ['-an']
+        if audiocodec == 'lavc':
+            codec = parameters.get('lavc_audiocodec') or 'mp2'
+            options = ['-c:a', FFMPEG_LAVC_CODECS.get(codec, codec)]
+            bitrate = parameters.get('lavc_audiobitrate')
+        else:
+            options = ['-c:a', FFMPEG_AUDIO_CODECS.get(audiocodec,
+                                                       audiocodec)]
+            bitrate = audiocodec == 'mp3lame' and \
+                parameters.get('lame_audiobitrate')
+        if bitrate:
+            options += ['-b:a', bitrate + 'k']
+        return options
+
+    def filter_options(self, parameters):
+        filters = []
+        if parameters.get('ffmpeg_filters'):
+            filters.append(parameters.get('ffmpeg_filters'))
+        if parameters.get('scalewidth') and parameters.get('scaleheight'):
+            filters.append("scale=%s:%s" % (parameters.get('scalewidth'),
+                                            parameters.get('scaleheight')))
+        options = []
+        if filters:
+            options += ['-vf', ','.join(filters)]
+        if parameters.get('ofps'):
+            options += ['-r', parameters.get('ofps')]
+        return options
+
+    def output_options(self, parameters, outputfile, output_format=None):
+        #the output is often the fifo of a Fanout, without extension
+        options = ['-f', output_format or 'avi']
+        if parameters.get('ffmpeg_extra_params'):
+            options += parameters.get('ffmpeg_extra_params').split()
+        #progress in key=value lines on stdout, see progress.py
+        return options + ['-progress', 'pipe:1', '-nostats', '-y',
+                          outputfile]
+
+    def input_options(self, parameters):
+        options = ['-f', 'v4l2']
+        norm = parameters.get('norm')
+        if norm and norm != '-1':
+            options += ['-standard', norm]
+        if parameters.get('input_int'):
+            options += ['-channel', parameters.get('input_int')]
+        if parameters.get('tvwidth') and parameters.get('tvheight'):
+            options += ['-video_size', '%sx%s' % (parameters.get('tvwidth'),
+                                                  parameters.get('tvheight'))]
+        options += ['-i', parameters.get('device') or '/dev/video0']
+        if parameters.get('audiocodec') != 'none':
+            #mencoder writes the ALSA devices with dots instead of colons
+            adevice = (parameters.get('adevice') or 'default').replace('.',
+                                                                       ':')
+            options += ['-f', 'alsa']
+            if parameters.get('audiorate'):
+                options += ['-sample_rate', parameters.get('audiorate')]
+            options += ['-i', adevice]
+        return options
+
+    def capture_command(self, parameters, outputfile=None,
+                        output_format=None, raw=False):
+        if not outputfile:
+            outputfile = utils.make_filename(parameters.get('outputfile'),
+                parameters.get('channel_text'),
+                append_suffix=parameters.get('append_suffix'))
+        if raw:
+            parameters = dict(parameters, videocodec='raw', scalewidth='',
+                              scaleheight='')
+            if parameters.get('audiocodec') != 'none':
+                parameters['audiocodec'] = 'pcm'
+        command = ['ffmpeg', '-nostdin'] + self.input_options(parameters)
+        if parameters.get('duration'):
+            command += ['-t', parameters.get('duration')]
+        command += self.filter_options(parameters)
+        command += self.video_codec_options(parameters)
+        command += self.audio_codec_options(parameters)
+        return command + self.output_options(parameters, outputfile,
+                                             output_format)
+
+    def encode_command(self, parameters, inputs, outputfile, extra=None):
+        command = ['ffmpeg', '-nostdin']
+        extra = list(extra or [])
+        #the mencoder options used in chunked encodes and benchmarks
+        if '-ss' in extra:
+            position = extra.index('-ss')
+            command += extra[position:position + 2]
+            del extra[position:position + 2]
+        if len(inputs) > 1:
+            #segments of a recording, concatenated like mencoder does
+            command += ['-i', 'concat:' + '|'.join(inputs)]
+        else:
+            command += ['-i', inputs[0] == '-' and 'pipe:0' or inputs[0]]
+        for option, ffmpeg_option in (('-frames', '-frames:v'),
+                                      ('-endpos', '-t')):
+            if option in extra:
+                position = extra.index(option)
+                command += [ffmpeg_option, extra[position + 1]]
+                del extra[position:position + 2]
+        command += self.filter_options(parameters)
+        command += self.video_codec_options(parameters)
+        command += self.audio_codec_options(parameters)
+        return command + extra + self.output_options(parameters, outputfile)
+
+    def cut_options(self, frame, fps, frames=None):
+        #ffmpeg decodes from the keyframe before and drops the frames until
+        #the position, it must not be after the frame (microseconds)
+        options = ['-ss', '%.6f' % (int(frame * 1000000 / fps) / 1e6)]
+        if frames is not None:
+            options += ['-frames', str(frames)]
+        return options
+
+    def concat_command(self, parameters, inputs, outputfile):
+        """Returns the command that joins the encoded files without
+        re-encoding them, with the concat demuxer. Its list of files is
+        written next to the first one."""
+        list_filename = os.path.splitext(inputs[0])[0] + '.txt'
+        list_file = open(list_filename, 'w')
+        try:
+            for filename in inputs:
+                list_file.write("file '%s'\n" % os.path.abspath(
+                    filename).replace("'", "'\\''"))
+        finally:
+            list_file.close()
+        return ['ffmpeg', '-nostdin', '-f', 'concat', '-safe', '0', '-i',
+                list_filename, '-c', 'copy'] + \
+            self.output_options(parameters, outputfile)
+
+    def preview_command(self, parameters):
+        return ['ffplay'] + self.input_options(
+            dict(parameters, audiocodec='none'))
+
+    def tune_command(self, parameters):
+        """Returns the command that tunes the card to the channel, ffmpeg
+        captures from whatever it is tuned to"""
+        return utils.generate_mplayer_command(parameters,
+            extra_params=['-really-quiet', '-frames', '1', '-vo', 'null',
+                          '-ao', 'null'])
+
+
+BACKENDS = {'mencoder': MencoderBackend, 'ffmpeg': FfmpegBackend}
+
+
+def get_backend(parameters):
+    """Returns the backend selected in the parameters, mencoder by
+    default"""
+    backend = BACKENDS.get(parameters.get('backend'))
+    if backend is None:
+        if parameters.get('backend'):
+            print "Unknown backend %s, using mencoder" % \
+                parameters.get('backend')
+        backend = MencoderBackend
+    backend = backend()
+    codec = backend.unsupported_codec(parameters)
+    if codec:
+        print "%s can't encode %s, using mencoder" % (backend.name, codec)
+        backend = MencoderBackend()
+    return backend
+
+
+def tune(parameters):
+    """Tunes the card if the backend can't do it itself"""
+    command = get_backend(parameters).tune_command(parameters)
+    if command:
+        print "Excecuting %s" % " ".join(command)
+        null = open(os.devnull, 'r+')
+        try:
+            call(command, stdin=null, stdout=null)
+        except OSError:
+            print "excecution of %s failed" % " ".join(command)
+        finally:
+            null.close()
+
+
+def benchmark(parameters, sample, seconds=None, backends=None):
+    """Encodes the first seconds of the sample (as many as when calibrating
+    by default) with the codecs of the parameters using each backend and
+    returns a list of (backend name, result), where result is a dict with
+    the frames encoded, the speed in fps, the CPU time used and the exit
+    status"""
+    import calibrate
+    if seconds is None:
+        seconds = calibrate.DEFAULT_SAMPLE_SECONDS
+    results = []
+    for name in backends or sorted(BACKENDS):
+        backend = BACKENDS[name]()
+        codec = backend.unsupported_codec(parameters)
+        if codec:
+            results.append((name, {'command': [], 'returncode': 127,
+                                   'error': "can't encode %s" % codec,
+                                   'frames': 0, 'elapsed': 0.0,
+                                   'cpu_time': 0.0, 'fps': 0.0,
+                                   'cpu_load': 0.0}))
+            continue
+        command = backend.encode_command(parameters, [sample], os.devnull,
+                                         ['-endpos', str(seconds)])
+        parser = ProgressParser()
+        cpu_start = calibrate.children_cpu_time()
+        start = time.time()
+        try:
+            process = Popen(command, stdout=PIPE, stderr=STDOUT)
+        except OSError:
+            results.append((name, {'command': command, 'returncode': 127,
+                                   'frames': 0, 'elapsed': 0.0,
+                                   'cpu_time': 0.0, 'fps': 0.0,
+                                   'cpu_load': 0.0}))
+            continue
+        while True:
+            data = process.stdout.read(4096)
+            if not data:
+                break
+            parser.feed(data)
+        returncode = process.wait()
+        elapsed = time.time() - start
+        cpu_time = calibrate.children_cpu_time() - cpu_start
+        frames = parser.metrics.frames
+        results.append((name, {'command': command, 'returncode': returncode,
+                               'frames': frames, 'elapsed': elapsed,
+                               'cpu_time': cpu_time,
+                               'fps': elapsed and frames / elapsed or 0.0,
+                               'cpu_load': elapsed and cpu_time / elapsed
+                                   or 0.0}))
+    return results
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+
+# Author: Santiago Bruno
+# License: GPL v3
+# Web pages: http://www.santiagobruno.com.ar/programas.html
+#            http://code.google.com/p/mtvcgui/
+
+"""Calibration of the encoder options: short benchmark encodes are run with
+a ladder of presets, from the highest quality to the fastest, to find the
+best one this machine can encode in real time with some headroom left.
+"""
+
+import os
+import resource
+import threading
+import time
+from subprocess import Popen, PIPE, STDOUT
+
+import utils
+from progress import ProgressParser
+
+#spare encoding speed required over the capture frame rate, the capture
+#itself, the audio encoding and the rest of the system need some CPU too
+DEFAULT_HEADROOM = 0.2
+#seconds of video encoded with each preset
+DEFAULT_SAMPLE_SECONDS = 10
+
+#presets by video codec, from the highest quality to the fastest. Each one
+#is the parameter that selects it and its value.
+PRESET_LADDERS = {
+    'x264': [('x264 ' + preset, 'x264_extra_opts', 'preset=' + preset)
+             for preset in ('slow', 'medium', 'fast', 'faster', 'veryfast',
+                            'superfast', 'ultrafast')],
+    'xvid': [('xvid me_quality=%d' % quality, 'xvid_me_quality', str(quality))
+             for quality in (6, 5, 4, 3, 2, 1)],
+    'lavc': [('lavc mbd=2 trellis', 'lavc_video_extra_opts',
+              'mbd=2:trell:v4mv:last_pred=3:cmp=2:subcmp=2'),
+             ('lavc mbd=2', 'lavc_video_extra_opts', 'mbd=2:v4mv'),
+             ('lavc mbd=1', 'lavc_video_extra_opts', 'mbd=1'),
+             ('lavc mbd=0', 'lavc_video_extra_opts', 'mbd=0'),
+             ('lavc fast', 'lavc_video_extra_opts', 'mbd=0:fast:me_range=8')],
+}
+
+#synthetic frames generated, they are sent in a loop
+SYNTHETIC_FRAMES = 25
+
+
+def option_key(option):
+    return option.split('=', 1)[0]
+
+
+def get_managed_options(ladder):
+    """Returns the names of the encoder options set by some preset of the
+    ladder"""
+    managed = set()
+    for name, parm, value in ladder:
+        managed.update(option_key(o) for o in value.split(':'))
+    return managed
+
+
+def merge_options(options, preset_options, ladder):
+    """Returns the colon separated encoder options with the ones of the
+    preset, removing first any option that is set by some preset of the
+    ladder so the user's other options are kept"""
+    managed = get_managed_options(ladder)
+    kept = [o for o in (options or '').split(':')
+            if o and option_key(o) not in managed]
+    return ':'.join(kept + [preset_options])
+
+
+def get_ladder(parameters):
+    """Returns the presets that can be tried with the selected video codec"""
+    return PRESET_LADDERS.get(parameters.get('videocodec'), [])
+
+
+def apply_preset(parameters, preset, ladder=None):
+    """Returns a copy of parameters using the given preset of the ladder"""
+    name, parm, value = preset
+    parameters = dict(parameters)
+    if parm.endswith('_extra_opts'):
+        if ladder is None:
+            ladder = get_ladder(parameters)
+        parameters[parm] = merge_options(parameters.get(parm), value, ladder)
+    else:
+        parameters[parm] = value
+    return parameters
+
+
+def current_preset_index(parameters, ladder=None):
+    """Returns the position in the ladder of the preset the parameters use,
+    or None if they don't use any. The options the ladder manages must be
+    exactly the ones of the preset, e.g. mbd=0:fast:me_range=8 isn't the
+    mbd=0 preset."""
+    if ladder is None:
+        ladder = get_ladder(parameters)
+    managed = get_managed_options(ladder)
+    for index, (name, parm, value) in enumerate(ladder):
+        if parm.endswith('_extra_opts'):
+            options = set(o for o in (parameters.get(parm) or '').split(':')
+                          if option_key(o) in managed)
+            if options == set(value.split(':')):
+                return index
+        elif parameters.get(parm) == value:
+            return index
+    return None
+
+
+def preset_name(parameters):
+    """Returns the name of the preset of the ladder the parameters use, or
+    else the video codec"""
+    ladder = get_ladder(parameters)
+    index = current_preset_index(parameters, ladder)
+    if index is not None:
+        return ladder[index][0]
+    videocodec = parameters.get('videocodec') or ''
+    if videocodec == 'lavc' and parameters.get('lavc_videocodec'):
+        return 'lavc ' + parameters.get('lavc_videocodec')
+    return videocodec
+
+
+def make_synthetic_frames(width, height, count=SYNTHETIC_FRAMES):
+    """Generates I420 frames with a moving gradient and a noisy area, which
+    is about as hard to encode as a noisy analog capture"""
+    pattern = ''.join(chr(16 + (i * 7) % 220) for i in range(width * 2))
+    chroma = chr(128) * (width * height / 2)
+    noisy_rows = height / 3
+    frames = []
+    for n in range(count):
+        offset = (n * 8) % width
+        row = pattern[offset:offset + width]
+        luma = row * (height - noisy_rows) + os.urandom(width * noisy_rows)
+        frames.append(luma + chroma)
+    return frames
+
+
+class FrameWriter(threading.Thread):
+    """Writes synthetic frames to the encoder stdin"""
+
+    def __init__(self, pipe, frames, count):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pipe = pipe
+        self.frames = frames
+        self.count = count
+
+    def run(self):
+        try:
+            try:
+                for n in xrange(self.count):
+                    self.pipe.write(self.frames[n % len(self.frames)])
+            except (IOError, OSError):
+                #the encoder finished or failed
+                pass
+        finally:
+            try:
+                self.pipe.close()
+            except (IOError, OSError):
+                pass
+
+
+def generate_benchmark_command(parameters, sample=None, seconds=None,
+                               frame_size=None):
+    """Generates the mencoder command that encodes the sample (or the
+    synthetic frames read from stdin) with the video options of the
+    parameters and throws the result away"""
+    fps = utils.get_capture_fps(parameters)
+    if sample:
+        command = ['mencoder', sample]
+    else:
+        width, height = frame_size
+        command = ['mencoder', '-', '-demuxer', 'rawvideo', '-rawvideo',
+                   'w=%d:h=%d:fps=%s:format=i420' % (width, height, fps)]
+    video_parameters = dict(parameters)
+    video_parameters['audiocodec'] = 'none'
+    command += utils.generate_codec_params(video_parameters)
+    if seconds:
+        command += ['-endpos', str(seconds)]
+    if parameters.get('ofps'):
+        command += ['-ofps', parameters.get('ofps')]
+    command += utils.generate_filters(video_parameters)
+    command += utils.generate_encoder_options(video_parameters)
+    command += ['-o', os.devnull]
+    return command
+
+
+def children_cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def benchmark(parameters, sample=None, seconds=DEFAULT_SAMPLE_SECONDS,
+              frames=None):
+    """Encodes the sample, or synthetic frames if there is no sample, and
+    returns a dict with the frames encoded, the encoding speed in fps, the
+    CPU time used and the return code of mencoder (127 and the error if
+    it can't be run). frames are the synthetic frames to use, they are
+    generated if not given."""
+    fps = utils.get_capture_fps(parameters)
+    if sample:
+        frame_count = None
+        command = generate_benchmark_command(parameters, sample, seconds)
+    else:
+        frame_count = int(seconds * fps)
+        frame_size = utils.get_frame_size(parameters)
+        if frames is None:
+            frames = make_synthetic_frames(*frame_size)
+        command = generate_benchmark_command(parameters,
+                                             frame_size=frame_size)
+
+    parser = ProgressParser()
+    cpu_start = children_cpu_time()
+    start = time.time()
+    try:
+        process = Popen(command, stdin=(None if sample else PIPE),
+                        stdout=PIPE, stderr=STDOUT)
+    except OSError, e:
+        return {'command': command, 'returncode': 127, 'error': str(e),
+                'frames': 0, 'elapsed': 0.0, 'cpu_time': 0.0, 'fps': 0.0,
+                'cpu_load': 0.0}
+    writer = None
+    if not sample:
+        writer = FrameWriter(process.stdin, frames, frame_count)
+        writer.start()
+    while True:
+        data = process.stdout.read(4096)
+        if not data:
+            break
+        parser.feed(data)
+    returncode = process.wait()
+    elapsed = time.time() - start
+    cpu_time = children_cpu_time() - cpu_start
+    if writer:
+        writer.join()
+
+    encoded = parser.metrics.frames or frame_count or 0
+    return {'command': command, 'returncode': returncode,
+            'frames': encoded, 'elapsed': elapsed, 'cpu_time': cpu_time,
+            'fps': elapsed and encoded / elapsed or 0.0,
+            'cpu_load': elapsed and cpu_time / elapsed or 0.0}
+
+
+def calibrate(parameters, sample=None, headroom=DEFAULT_HEADROOM,
+              seconds=DEFAULT_SAMPLE_SECONDS, log=None):
+    """Benchmarks the presets of the ladder of the selected video codec,
+    from the highest quality down, and stops at the first one that encodes
+    at least headroom (a fraction) faster than the capture frame rate.
+    log, if given, is called with a line of text describing each result.
+    Returns (preset, results) where preset is the chosen one (the fastest
+    if none is fast enough) or None if the codec has no presets, and
+    results is a list of (preset, benchmark result)."""
+    ladder = get_ladder(parameters)
+    required_fps = utils.get_capture_fps(parameters) * (1 + headroom)
+    frames = None
+    if not sample and ladder:
+        frames = make_synthetic_frames(*utils.get_frame_size(parameters))
+
+    results = []
+    for preset in ladder:
+        result = benchmark(apply_preset(parameters, preset, ladder),
+                           sample=sample, seconds=seconds, frames=frames)
+        results.append((preset, result))
+        if result.get('error'):
+            #no other preset can be run either
+            if log:
+                log("can't run %s: %s" % (result['command'][0],
+                                          result['error']))
+            break
+        if log:
+            if result['returncode']:
+                log("%s: mencoder failed with status %d" %
+                    (preset[0], result['returncode']))
+            else:
+                log("%s: %.1f fps, %.1f CPUs (%.1f fps needed)" %
+                    (preset[0], result['fps'], result['cpu_load'],
+                     required_fps))
+        if not result['returncode'] and result['fps'] >= required_fps:
+            return preset, results
+
+    if results:
+        #nothing is fast enough, the fastest that works is the best we have
+        working = [r for r in results if not r[1]['returncode']]
+        if working:
+            return working[-1][0], results
+    return None, results
+
+
+def save_preset(parameters, preset, result=None, config_filename=None):
+    """Saves the option that selects the preset to the configuration file,
+    along with the speed measured for it"""
+    name, parm, value = preset
+    tuned = apply_preset(parameters, preset)
+    values = {parm: tuned[parm], 'calibrated_preset': name}
+    if result:
+        values['calibrated_fps'] = '%.1f' % result['fps']
+    utils.save_configuration(values, config_filename=config_filename)
+    return tuned
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+# Author: Santiago Bruno
+# License: GPL v3
+# Web pages: http://www.santiagobruno.com.ar/programas.html
+#            http://code.google.com/p/mtvcgui/
+
+"""Notification of finished child processes (mencoder, mplayer...) without
+polling them periodically.
+"""
+
+import fcntl
+import os
+import signal
+
+
+class ChildWatcher(object):
+    """Calls a function as soon as a watched child process finishes.
+
+    A SIGCHLD handler is installed and signal.set_wakeup_fd makes every
+    signal write a byte to a pipe. The read end of that pipe (fileno()) can
+    be watched with select (which fails with EINTR when the signal arrives,
+    just retry it) or a QSocketNotifier, and when it is readable
+    handle_events() must be called to reap the finished children and call
+    their callbacks. Nothing runs while no child changes its state.
+
+    There is only one wakeup fd per process, so use get_watcher() instead of
+    creating instances. It must be used from the main thread.
+    """
+
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        for fd in (self.read_fd, self.write_fd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+            fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+        self.watched = {}
+
+        #the handler does nothing, but python only writes to the wakeup fd
+        #for signals with a python handler
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        #don't make system calls of the rest of the program fail with EINTR
+        signal.siginterrupt(signal.SIGCHLD, False)
+        signal.set_wakeup_fd(self.write_fd)
+
+    def fileno(self):
+        return self.read_fd
+
+    def watch(self, process, callback):
+        """Calls callback with the exit status of the process (a Popen
+        instance) when it finishes"""
+        self.watched[process.pid] = (process, callback)
+        #it may have finished already, check it in the next handle_events
+        self.wakeup()
+
+    def unwatch(self, process):
+        self.watched.pop(process.pid, None)
+
+    def wakeup(self):
+        try:
+            os.write(self.write_fd, '\0')
+        except OSError:
+            #the pipe is full, it will be read anyway
+            pass
+
+    def handle_events(self):
+        """Reaps the watched processes that finished and calls their
+        callbacks. Call it when fileno() is readable."""
+        try:
+            while os.read(self.read_fd, 512):
+                pass
+        except OSError:
+            pass
+        for pid, (process, callback) in self.watched.items():
+            returncode = process.poll()
+            if returncode is not None:
+                del self.watched[pid]
+                callback(returncode)
+
+
+_watcher = None
+
+def get_watcher():
+    """Returns the child watcher of this process, creating it if needed"""
+    global _watcher
+    if _watcher is None:
+        _watcher = ChildWatcher()
+    return _watcher
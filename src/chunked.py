@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+
+# Author: Santiago Bruno
+# License: GPL v3
+# Web pages: http://www.santiagobruno.com.ar/programas.html
+#            http://code.google.com/p/mtvcgui/
+
+"""Parallel re-encoding of a single long recording: it is split at
+keyframes in chunks that are encoded at the same time by several processes
+of the backend, and the results are joined by it without re-encoding them
+again.
+
+AVI recordings are split at the keyframes listed in their index, segmented
+recordings (.m3u8) in groups of whole segments, which already start at
+keyframes.
+"""
+
+import os
+import shutil
+import struct
+import tempfile
+import time
+from subprocess import Popen, STDOUT
+
+import backends
+import transcode
+import utils
+
+#idx1 flag of the keyframes
+AVIIF_KEYFRAME = 0x10
+#in the OpenDML indexes the size of the frames that aren't keyframes has
+#this bit set
+ODML_NOT_KEYFRAME = 0x80000000
+#a chunk shorter than this isn't worth a process
+MIN_CHUNK_SECONDS = 30
+
+
+def read_chunk_header(avi):
+    header = avi.read(8)
+    if len(header) < 8:
+        return None, 0
+    return struct.unpack('<4sI', header)
+
+
+def read_avi_index(filename):
+    """Returns (fps, frame count, keyframes) of the video of an AVI file,
+    keyframes being the numbers of the frames that are keyframes, read from
+    the OpenDML indexes or else from idx1. Returns None if the file has no
+    index or isn't an AVI file."""
+    avi = open(filename, 'rb')
+    try:
+        riff, size = read_chunk_header(avi)
+        if riff != 'RIFF' or avi.read(4) != 'AVI ':
+            return None
+        #(scale, rate, super index) of the video stream, and its number
+        video = None
+        stream = 0
+        keyframes = None
+        frames = 0
+        while True:
+            fourcc, size = read_chunk_header(avi)
+            if fourcc is None:
+                break
+            next_chunk = avi.tell() + size + (size & 1)
+            if fourcc == 'LIST':
+                list_type = avi.read(4)
+                if list_type in ('hdrl', 'strl'):
+                    #the headers are inside, go on reading them
+                    continue
+            elif fourcc == 'strh':
+                values = struct.unpack('<4s4sIHHIIII', avi.read(32))
+                if values[0] == 'vids' and video is None:
+                    video = [stream, values[6], values[7], None]
+                stream += 1
+            elif fourcc == 'indx' and video and video[0] == stream - 1:
+                video[3] = avi.read(size)
+            elif fourcc == 'idx1' and video and keyframes is None:
+                chunk_ids = ['%02d%s' % (video[0], kind)
+                             for kind in ('dc', 'db')]
+                keyframes = []
+                index = avi.read(size)
+                for entry in range(len(index) / 16):
+                    chunk_id, flags = struct.unpack_from('<4sI', index,
+                                                         entry * 16)
+                    if chunk_id in chunk_ids:
+                        if flags & AVIIF_KEYFRAME:
+                            keyframes.append(frames)
+                        frames += 1
+            avi.seek(next_chunk)
+
+        if not video or not video[1]:
+            return None
+        stream, scale, rate, super_index = video
+        if super_index:
+            odml = read_odml_index(avi, super_index)
+            if odml:
+                frames, keyframes = odml
+        if not keyframes:
+            return None
+        return float(rate) / scale, frames, keyframes
+    finally:
+        avi.close()
+
+
+def read_odml_index(avi, super_index):
+    """Returns (frame count, keyframes) read from the standard indexes the
+    OpenDML super index points to, or None"""
+    longs, sub_type, index_type, entries = struct.unpack('<HBBI',
+                                                         super_index[:8])
+    #AVI_INDEX_OF_INDEXES
+    if index_type != 0 or longs != 4:
+        return None
+    frames = 0
+    keyframes = []
+    for n in range(entries):
+        offset, size, duration = struct.unpack(
+            '<QII', super_index[24 + n * 16:40 + n * 16])
+        avi.seek(offset)
+        fourcc, size = read_chunk_header(avi)
+        longs, sub_type, index_type, count = struct.unpack('<HBBI',
+                                                          avi.read(8))
+        avi.read(16)
+        for entry in range(count):
+            offset, size = struct.unpack('<II', avi.read(8))
+            if not size & ODML_NOT_KEYFRAME:
+                keyframes.append(frames)
+            frames += 1
+    return frames, keyframes
+
+
+def choose_cuts(keyframes, frames, chunks):
+    """Returns the keyframes where the video is cut to get chunks of about
+    the same length, the first one always"""
+    cuts = [keyframes[0]]
+    for n in range(1, chunks):
+        target = frames * n / chunks
+        after = [k for k in keyframes if k >= target]
+        if after and after[0] > cuts[-1] and after[0] < frames:
+            cuts.append(after[0])
+    return cuts
+
+
+def make_chunks(backend, inputfile, chunks):
+    """Returns the inputs of each chunk, as (files, extra options of the
+    encode command of the backend), or None if the file can't be split"""
+    inputs = transcode.get_input_files(inputfile)
+    if len(inputs) > 1:
+        #segments, they start at keyframes
+        chunks = min(chunks, len(inputs))
+        return [(inputs[len(inputs) * n / chunks:
+                        len(inputs) * (n + 1) / chunks], [])
+                for n in range(chunks)]
+
+    index = read_avi_index(inputfile)
+    if not index:
+        return None
+    fps, frames, keyframes = index
+    chunks = max(1, min(chunks, int(frames / fps / MIN_CHUNK_SECONDS)))
+    cuts = choose_cuts(keyframes, frames, chunks)
+    result = []
+    for n, cut in enumerate(cuts):
+        frames = None
+        if n + 1 < len(cuts):
+            frames = cuts[n + 1] - cut
+        result.append(([inputfile], backend.cut_options(cut, fps, frames)))
+    return result
+
+
+def run_all(commands, log=None):
+    """Runs the commands at the same time with low priority and waits for
+    them. Returns the highest exit status."""
+    processes = []
+    null = open(os.devnull, 'w')
+    try:
+        for command in commands:
+            if log:
+                log("Excecuting %s" % " ".join(command))
+            processes.append(Popen(transcode.low_priority(command),
+                                   stdout=null, stderr=STDOUT))
+        return max([process.wait() for process in processes] or [0])
+    finally:
+        null.close()
+
+
+def encode_chunked(parameters, inputfile, outputfile, chunks=None,
+                   log=None):
+    """Re-encodes inputfile to outputfile with the codecs of the parameters
+    splitting it in chunks (the number of CPUs by default) that are encoded
+    in parallel. Falls back to a single process if the file can't be split.
+    Returns the exit status of the encoder."""
+    if not chunks:
+        chunks = transcode.get_free_cpus()
+    backend = backends.get_backend(parameters)
+    parts = make_chunks(backend, inputfile, chunks)
+    if not parts or len(parts) == 1:
+        if log:
+            log("%s can't be split, encoding it in a single process" %
+                inputfile)
+        return run_all([backend.encode_command(
+            parameters, transcode.get_input_files(inputfile), outputfile)],
+            log)
+
+    directory = tempfile.mkdtemp(prefix='chunks',
+                                 dir=os.path.dirname(outputfile) or '.')
+    try:
+        extension = os.path.splitext(outputfile)[1] or '.avi'
+        chunk_files = [os.path.join(directory,
+                                    'chunk_%03d%s' % (n, extension))
+                       for n in range(len(parts))]
+        if not parameters.get('encoder_threads'):
+            #the chunks are encoded at the same time
+            parameters = dict(parameters, encoder_threads=max(1,
+                utils.get_available_cpus() / len(parts)))
+        commands = [backend.encode_command(parameters, inputs, chunk_file,
+                                           extra)
+                    for (inputs, extra), chunk_file in zip(parts,
+                                                           chunk_files)]
+        returncode = run_all(commands, log)
+        if returncode:
+            return returncode
+        return run_all([backend.concat_command(parameters, chunk_files,
+                                               outputfile)], log)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def benchmark_chunked(parameters, inputfile, chunks=None, log=None):
+    """Re-encodes inputfile in a single process and then in parallel chunks
+    and returns a dict with the seconds each one took and the speedup"""
+    directory = tempfile.mkdtemp(prefix='benchmark',
+                                 dir=os.path.dirname(inputfile) or '.')
+    try:
+        outputfile = os.path.join(directory, 'single.avi')
+        start = time.time()
+        backend = backends.get_backend(parameters)
+        single_returncode = run_all([backend.encode_command(
+            parameters, transcode.get_input_files(inputfile), outputfile)],
+            log)
+        single = time.time() - start
+
+        outputfile = os.path.join(directory, 'chunked.avi')
+        start = time.time()
+        returncode = encode_chunked(parameters, inputfile, outputfile,
+                                    chunks, log)
+        chunked = time.time() - start
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return {'returncode': single_returncode or returncode,
+            'single': single, 'chunked': chunked,
+            'speedup': chunked and single / chunked or 0.0}
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+# Author: Santiago Bruno
+# License: GPL v3
+# Web pages: http://www.santiagobruno.com.ar/programas.html
+#            http://code.google.com/p/mtvcgui/
+
+"""Free space of the disks recordings are written to. Before a recording
+starts the space it needs is estimated from its bitrates and duration, and
+while it runs the growth of its files is compared with the space left. When
+it would fill the disk in less than disk_warn_minutes a warning is given,
+and in less than disk_rollover_minutes it continues in a new file in one of
+disk_spare_dirs (separated by commas), as adaptive quality does, e.g.:
+
+    disk_spare_dirs = /mnt/spare,/media/usb
+"""
+
+import collections
+import os
+
+import utils
+
+#seconds between checks while recording, and seconds of growth used to
+#measure the write rate
+CHECK_INTERVAL = 5
+RATE_WINDOW = 60
+#the rate is not trusted before this many seconds of growth
+MIN_RATE_SPAN = 10
+
+WARN, ROLLOVER = 'warn', 'rollover'
+
+
+def free_space(directory):
+    """Returns the bytes free in the filesystem of the directory for us,
+    or None if it can't be known"""
+    try:
+        stat = os.statvfs(directory)
+    except OSError:
+        return None
+    return stat.f_bavail * stat.f_frsize
+
+
+def get_spare_dirs(parameters):
+    """Returns disk_spare_dirs and then the output_roots"""
+    directories = []
+    for parm in ('disk_spare_dirs', 'output_roots'):
+        directories += [os.path.expanduser(d.strip()) for d in
+                        (parameters.get(parm) or '').split(',') if d.strip()]
+    return directories
+
+
+def same_filesystem(directory1, directory2):
+    try:
+        return os.stat(directory1).st_dev == os.stat(directory2).st_dev
+    except OSError:
+        return False
+
+
+def find_spare_dir(parameters, directory, needed):
+    """Returns the first of disk_spare_dirs (or output_roots) that isn't
+    on the disk of directory and has the bytes needed free, or None"""
+    for spare in get_spare_dirs(parameters):
+        if same_filesystem(spare, directory):
+            continue
+        free = free_space(spare)
+        if free is not None and free >= needed:
+            return spare
+    return None
+
+
+def estimate_rate(recording):
+    """Returns the bytes per second the recording will write, in all its
+    renditions"""
+    renditions = [parameters for name, parameters
+                  in recording.get_rendition_parameters()]
+    return sum(utils.estimate_bitrate(parameters) for parameters in
+               renditions or [recording.parameters]) * 1000 / 8
+
+
+def check_start(recording):
+    """Checks that the disk of recording.filename has room for the whole
+    recording (or for disk_warn_minutes if it has no duration). If it
+    hasn't, the file is moved to a spare directory that has, if any.
+    Returns a warning, or None if there is room."""
+    parameters = recording.parameters
+    if recording.is_timeshift():
+        return None
+    rate = estimate_rate(recording)
+    needed = rate * (utils.str_to_secs(parameters.get('duration')) or
+                     parameters.get('disk_warn_minutes', 0) * 60)
+    directory = os.path.dirname(os.path.abspath(recording.filename))
+    free = free_space(directory)
+    if free is None or needed <= free:
+        return None
+    spare = find_spare_dir(parameters, directory, needed)
+    if spare:
+        recording.filename = os.path.join(
+            spare, os.path.basename(recording.filename))
+        if recording.root:
+            recording.root = spare
+        return "Not enough space in %s (%d MB needed, %d MB free), " \
+            "recording to %s" % (directory, needed / 1000000, free / 1000000,
+                                 recording.filename)
+    return "Not enough space in %s: %d MB needed, %d MB free" % (
+        directory, needed / 1000000, free / 1000000)
+
+
+class DiskWatch(object):
+    """Follows the growth of the files of a recording and tells when the
+    disk is going to be full"""
+
+    def __init__(self, parameters):
+        self.parameters = parameters
+        self.warn_seconds = parameters.get('disk_warn_minutes', 0) * 60
+        self.rollover_seconds = parameters.get('disk_rollover_minutes', 0) * 60
+        #(time, bytes written) of the last RATE_WINDOW seconds
+        self.sizes = collections.deque()
+        self.last_check = None
+        self.warned = False
+
+    def due(self, now):
+        return self.last_check is None or \
+            now - self.last_check >= CHECK_INTERVAL
+
+    def rate(self):
+        """Returns the bytes per second written lately, or None"""
+        first_time, first_size = self.sizes[0]
+        last_time, last_size = self.sizes[-1]
+        if last_time - first_time < MIN_RATE_SPAN:
+            return None
+        return float(last_size - first_size) / (last_time - first_time)
+
+    def update(self, filename, size, now, remaining=None):
+        """Adds the bytes the recording has written to filename so far and
+        returns (WARN, None, seconds left) or (ROLLOVER, spare directory,
+        seconds left) when the disk is almost full, otherwise None.
+        remaining is how many seconds the recording will still last, if it
+        has a duration."""
+        self.last_check = now
+        self.sizes.append((now, size))
+        while now - self.sizes[0][0] > RATE_WINDOW:
+            self.sizes.popleft()
+        rate = self.rate()
+        directory = os.path.dirname(os.path.abspath(filename))
+        free = free_space(directory)
+        if not rate or rate <= 0 or free is None:
+            return None
+        seconds_left = free / rate
+        if remaining is not None and remaining < seconds_left:
+            #it ends before the disk is full
+            return None
+        if seconds_left < self.rollover_seconds:
+            spare = find_spare_dir(self.parameters, directory,
+                                   rate * (remaining or self.warn_seconds))
+            if spare:
+                return ROLLOVER, spare, seconds_left
+        if seconds_left < self.warn_seconds and not self.warned:
+            self.warned = True
+            return WARN, None, seconds_left
+        return None
@@ -0,0 +1,570 @@
+# -*- coding: utf-8 -*-
+
+# Author: Santiago Bruno
+# License: GPL v3
+# Web pages: http://www.santiagobruno.com.ar/programas.html
+#            http://code.google.com/p/mtvcgui/
+
+"""Distribution of the stream written by mencoder to several destinations
+(the output file, a preview player...) so it is captured only once and
+nothing is read back from the disk.
+"""
+
+import errno
+import fcntl
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import deque
+from subprocess import Popen, PIPE, STDOUT, call
+
+from utils import set_cloexec
+
+CHUNK_SIZE = 65536
+TS_PACKET_SIZE = 188
+#a segment longer (or bigger) than this times the requested length is cut
+#even if no keyframe was found
+SEGMENT_GRACE = 1.5
+
+
+def get_thread_id():
+    """Returns the kernel id of the calling thread (its directory in
+    /proc/<pid>/task), or None if it can't be known"""
+    try:
+        return int(os.readlink('/proc/thread-self').split('/')[-1])
+    except (OSError, ValueError):
+        return None
+
+
+class FileSink(object):
+    """Writes the stream to a file. Nothing is lost, if it can't be written
+    the error is raised and the capture ends."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                          0666)
+        set_cloexec(self.fd)
+
+    def write(self, data):
+        while data:
+            written = os.write(self.fd, data)
+            data = data[written:]
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PipeSink(object):
+    """Writes the stream to a pipe (e.g. the stdin of mplayer) without ever
+    blocking. If the reader doesn't keep up the data that doesn't fit in the
+    pipe is dropped, so a slow preview can't slow down the capture. If the
+    reader goes away the sink stops writing. The given fd is duplicated,
+    the caller still has to close it."""
+
+    def __init__(self, fd):
+        self.fd = os.dup(fd)
+        set_cloexec(self.fd)
+        self.closed = False
+        self.dropped = 0
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def write(self, data):
+        if self.closed:
+            return
+        try:
+            written = os.write(self.fd, data)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                written = 0
+            elif e.errno == errno.EPIPE:
+                self.close()
+                return
+            else:
+                raise
+        self.dropped += len(data) - written
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            try:
+                os.close(self.fd)
+            except OSError:
+                pass
+
+
+class ProcessSink(object):
+    """Writes the stream to the stdin of a process that needs all of it
+    (e.g. the encoder of a rendition). If it doesn't keep up the capture
+    waits for it. close() waits for the process to finish."""
+
+    def __init__(self, command, env=None):
+        self.command = command
+        devnull = open(os.devnull, 'w')
+        try:
+            self.process = Popen(command, stdin=PIPE, stdout=devnull,
+                                 stderr=STDOUT, env=env)
+        finally:
+            devnull.close()
+        self.fd = self.process.stdin.fileno()
+        set_cloexec(self.fd)
+        self.closed = False
+
+    def write(self, data):
+        if self.closed:
+            return
+        try:
+            while data:
+                written = os.write(self.fd, data)
+                data = data[written:]
+        except OSError, e:
+            if e.errno != errno.EPIPE:
+                raise
+            #the process failed, the rest of the capture goes on
+            print "%s stopped reading the captured stream" % self.command[0]
+            self.closed = True
+
+    def close(self):
+        self.closed = True
+        self.process.stdin.close()
+        returncode = self.process.wait()
+        if returncode:
+            print "%s finished with status code %s" % (
+                " ".join(self.command), returncode)
+        return returncode
+
+
+def is_random_access(packet):
+    """Returns true if the MPEG-TS packet starts a frame that can be decoded
+    alone (a keyframe), so a segment starting there plays from the start"""
+    if ord(packet[0]) != 0x47 or not ord(packet[1]) & 0x40:
+        return False
+    #adaptation field with the random_access_indicator flag
+    return bool(ord(packet[3]) & 0x20 and ord(packet[4]) and
+                ord(packet[5]) & 0x40)
+
+
+class SegmentSink(object):
+    """Writes an MPEG-TS stream to consecutive files root_001.ts,
+    root_002.ts... of about seconds seconds or size bytes each (0 for no
+    limit), cutting them at a keyframe when possible. As MPEG-TS is made of
+    independent packets each segment can be played alone and nothing is
+    lost between them. root.m3u8 lists the finished segments, and command
+    (if given) is run with the name of each one when it is finished. The
+    segments can continue in another directory, see move_to.
+    """
+
+    def __init__(self, root, seconds=0, size=0, command=None):
+        self.root = root
+        self.seconds = seconds
+        self.size = size
+        self.command = command
+        self.manifest = root + '.m3u8'
+        #the root of the segments after the current one, see move_to
+        self.next_root = None
+        self.number = 0
+        self.segments = []
+        self.hooks = []
+        self.pending = ''
+        self.fd = None
+        self.open_segment()
+        try:
+            self.write_manifest()
+        except (IOError, OSError), e:
+            os.close(self.fd)
+            os.remove(self.filename)
+            raise OSError(e.errno, e.strerror)
+
+    def open_segment(self):
+        if self.next_root:
+            self.root, self.next_root = self.next_root, None
+        self.number += 1
+        self.filename = "%s_%03d.ts" % (self.root, self.number)
+        self.fd = os.open(self.filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                          0666)
+        set_cloexec(self.fd)
+        self.segment_start = time.time()
+        self.written = 0
+
+    def close_segment(self):
+        os.close(self.fd)
+        self.fd = None
+        self.segments.append((self.filename,
+                              time.time() - self.segment_start))
+        self.write_manifest()
+        self.run_hook(self.filename)
+
+    def write_manifest(self, finished=False):
+        """Writes the playlist, replacing it atomically"""
+        durations = [duration for filename, duration in self.segments]
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3',
+                 '#EXT-X-TARGETDURATION:%d' % int(max(durations + [
+                     self.seconds]) + 1),
+                 '#EXT-X-MEDIA-SEQUENCE:0']
+        directory = os.path.dirname(os.path.abspath(self.manifest))
+        for filename, duration in self.segments:
+            lines.append('#EXTINF:%.3f,' % duration)
+            if os.path.dirname(os.path.abspath(filename)) != directory:
+                #moved to another directory
+                lines.append(os.path.abspath(filename))
+            else:
+                lines.append(os.path.basename(filename))
+        if finished:
+            lines.append('#EXT-X-ENDLIST')
+        tmp_filename = self.manifest + '.tmp'
+        manifest = open(tmp_filename, 'w')
+        try:
+            manifest.write('\n'.join(lines) + '\n')
+        finally:
+            manifest.close()
+        os.rename(tmp_filename, self.manifest)
+
+    def remove_files(self):
+        """Removes the playlist and the segments once closed, when the
+        recording couldn't be started"""
+        for filename in [self.manifest] + [filename for filename, duration
+                                           in self.segments]:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    def run_hook(self, filename):
+        self.hooks = [hook for hook in self.hooks if hook.poll() is None]
+        if self.command:
+            try:
+                self.hooks.append(Popen(self.command.split() + [filename]))
+            except OSError:
+                print "excecution of %s failed" % self.command
+
+    def move_to(self, directory):
+        """Writes the next segments to directory, cutting the current one
+        with the next data written (e.g. when its disk is almost full)"""
+        self.next_root = os.path.join(directory, os.path.basename(self.root))
+
+    def elapsed_fraction(self):
+        """Returns how full the current segment is, 1 when it must be cut"""
+        if self.next_root:
+            return SEGMENT_GRACE
+        fractions = [0]
+        if self.seconds:
+            fractions.append((time.time() - self.segment_start) /
+                             self.seconds)
+        if self.size:
+            fractions.append(float(self.written) / self.size)
+        return max(fractions)
+
+    def write_data(self, data):
+        while data:
+            written = os.write(self.fd, data)
+            data = data[written:]
+            self.written += written
+
+    def write(self, data):
+        data = self.pending + data
+        usable = len(data) - len(data) % TS_PACKET_SIZE
+        self.pending = data[usable:]
+        fraction = self.elapsed_fraction()
+        if fraction < 1:
+            self.write_data(data[:usable])
+            return
+        cut = None
+        if fraction >= SEGMENT_GRACE:
+            cut = 0
+        else:
+            for offset in xrange(0, usable, TS_PACKET_SIZE):
+                if is_random_access(data[offset:offset + TS_PACKET_SIZE]):
+                    cut = offset
+                    break
+        if cut is None:
+            self.write_data(data[:usable])
+            return
+        self.write_data(data[:cut])
+        self.close_segment()
+        self.open_segment()
+        self.write_data(data[cut:usable])
+
+    def close(self):
+        self.write_data(self.pending)
+        self.pending = ''
+        if self.written:
+            self.close_segment()
+        else:
+            os.close(self.fd)
+            os.remove(self.filename)
+        self.write_manifest(finished=True)
+
+
+def preallocate(filename, size):
+    """Reserves size bytes on disk for the file, so writing it doesn't
+    fail in the middle when the disk gets full"""
+    try:
+        if call(['fallocate', '-l', str(size), filename]) == 0:
+            return
+    except OSError:
+        pass
+    #a sparse file at least, if fallocate is not available
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT, 0666)
+    try:
+        os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+
+
+class RingSink(SegmentSink):
+    """Writes an MPEG-TS stream to a ring of slots files of seconds seconds
+    (or size bytes) each in directory, created once with their size and
+    then overwritten in turn, so the disk used doesn't grow. The slots
+    written are available to keep them with RingCopier.
+    """
+
+    def __init__(self, directory, slots, seconds, size):
+        created = not os.path.isdir(directory)
+        if created:
+            os.makedirs(directory)
+        self.directory = directory
+        self.slots = slots
+        self.slot_size = size
+        self.condition = threading.Condition()
+        #(sequence number, filename, bytes, start time) of the finished
+        #slots that haven't been overwritten, oldest first
+        self.finished = deque()
+        self.cut_requested = False
+        self.closed = False
+        try:
+            SegmentSink.__init__(self, os.path.join(directory, 'slot'),
+                                 seconds, size)
+        except OSError:
+            if created:
+                #with the slot it could preallocate, if any
+                shutil.rmtree(directory, ignore_errors=True)
+            raise
+
+    def open_segment(self):
+        self.number += 1
+        self.filename = "%s_%02d.ts" % (self.root,
+                                        (self.number - 1) % self.slots)
+        self.condition.acquire()
+        try:
+            #its previous content is lost
+            while self.finished and self.finished[0][1] == self.filename:
+                self.finished.popleft()
+        finally:
+            self.condition.release()
+        if not os.path.exists(self.filename):
+            preallocate(self.filename, self.slot_size)
+        #not truncated, the space is reused
+        self.fd = os.open(self.filename, os.O_WRONLY | os.O_CREAT, 0666)
+        set_cloexec(self.fd)
+        self.segment_start = time.time()
+        self.written = 0
+
+    def close_segment(self):
+        os.close(self.fd)
+        self.fd = None
+        self.condition.acquire()
+        try:
+            self.finished.append((self.number, self.filename, self.written,
+                                  self.segment_start))
+            self.cut_requested = False
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def write_manifest(self, finished=False):
+        pass
+
+    def elapsed_fraction(self):
+        if self.cut_requested:
+            return SEGMENT_GRACE
+        return SegmentSink.elapsed_fraction(self)
+
+    def cut(self):
+        """Ends the current slot with the next data written, so what has
+        been captured until now can be copied"""
+        self.condition.acquire()
+        try:
+            self.cut_requested = True
+            return self.number
+        finally:
+            self.condition.release()
+
+    def close(self):
+        self.write_data(self.pending)
+        self.pending = ''
+        self.close_segment()
+        self.condition.acquire()
+        try:
+            self.closed = True
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+
+class RingCopier(threading.Thread):
+    """Copies to filename what a RingSink captured since the time since
+    (the slot that includes it, as slots are cut at keyframes) and what it
+    captures next, until stop() is called or the capture ends."""
+
+    def __init__(self, ring, filename, since):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.ring = ring
+        self.filename = filename
+        self.since = since
+        self.last = None
+        self.error = None
+        self.lost = 0
+
+    def next_slot(self, sequence):
+        """Waits until the slot is finished and returns it, or None if the
+        copy must end"""
+        ring = self.ring
+        ring.condition.acquire()
+        try:
+            while True:
+                if self.last is not None and sequence > self.last:
+                    return None
+                for slot in ring.finished:
+                    if slot[0] == sequence:
+                        return slot
+                if ring.finished and ring.finished[0][0] > sequence:
+                    #overwritten before it could be copied
+                    self.lost += 1
+                    print "Time-shift slot %d was lost" % sequence
+                    sequence += 1
+                    continue
+                if ring.closed:
+                    return None
+                ring.condition.wait()
+        finally:
+            ring.condition.release()
+
+    def first_slot(self):
+        ring = self.ring
+        ring.condition.acquire()
+        try:
+            for sequence, filename, length, start in ring.finished:
+                if start + ring.seconds > self.since:
+                    return sequence
+            return ring.number
+        finally:
+            ring.condition.release()
+
+    def run(self):
+        try:
+            output = open(self.filename, 'wb')
+            try:
+                sequence = self.first_slot()
+                while True:
+                    slot = self.next_slot(sequence)
+                    if slot is None:
+                        break
+                    sequence, filename, length, start = slot
+                    self.copy(filename, length, output)
+                    sequence += 1
+            finally:
+                output.close()
+        except (IOError, OSError), e:
+            print "Error copying the time-shift buffer: %s" % e
+            self.error = e
+
+    def copy(self, filename, length, output):
+        slot = open(filename, 'rb')
+        try:
+            while length > 0:
+                data = slot.read(min(length, CHUNK_SIZE))
+                if not data:
+                    break
+                output.write(data)
+                length -= len(data)
+        finally:
+            slot.close()
+
+    def stop(self):
+        """Ends the copy with what has been captured until now"""
+        self.last = self.ring.cut()
+        self.ring.condition.acquire()
+        try:
+            self.ring.condition.notifyAll()
+        finally:
+            self.ring.condition.release()
+
+
+class Fanout(threading.Thread):
+    """Creates a named pipe (fifo_path) where mencoder must write its output,
+    and copies everything written there to each of the sinks from a
+    background thread. Call finish() when mencoder has finished, it returns
+    when everything has been written and the sinks are closed.
+    """
+
+    def __init__(self, sinks=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sinks = list(sinks or [])
+        self.error = None
+        #the id of the thread once it runs, to sample what it uses
+        self.tid = None
+        self.tmp_dir = tempfile.mkdtemp(prefix='mtvcgui-')
+        self.fifo_path = os.path.join(self.tmp_dir, 'stream')
+        try:
+            os.mkfifo(self.fifo_path, 0600)
+            #the fifo is opened here so mencoder doesn't block opening it,
+            #and it is also kept open for writing so reading doesn't reach
+            #the end before mencoder opens it. finish() closes it.
+            self.read_fd = os.open(self.fifo_path,
+                                   os.O_RDONLY | os.O_NONBLOCK)
+        except OSError:
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+            raise
+        self.hold_fd = os.open(self.fifo_path, os.O_WRONLY)
+        set_cloexec(self.read_fd)
+        set_cloexec(self.hold_fd)
+        flags = fcntl.fcntl(self.read_fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.read_fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def run(self):
+        self.tid = get_thread_id()
+        try:
+            try:
+                while True:
+                    data = os.read(self.read_fd, CHUNK_SIZE)
+                    if not data:
+                        break
+                    for sink in self.sinks:
+                        sink.write(data)
+            except (IOError, OSError), e:
+                #closing the fifo makes mencoder fail instead of blocking
+                print "Error writing the captured stream: %s" % e
+                self.error = e
+        finally:
+            os.close(self.read_fd)
+            for sink in self.sinks:
+                try:
+                    sink.close()
+                except (IOError, OSError), e:
+                    print "Error closing the captured stream: %s" % e
+                    self.error = e
+
+    def finish(self):
+        """Ends the distribution once mencoder has finished writing"""
+        if self.hold_fd is not None:
+            os.close(self.hold_fd)
+            self.hold_fd = None
+        if self.ident is None:
+            #never started
+            os.close(self.read_fd)
+            for sink in self.sinks:
+                try:
+                    sink.close()
+                except (IOError, OSError):
+                    pass
+        else:
+            self.join()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+# Author: Santiago Bruno
+# License: GPL v3
+# Web pages: http://www.santiagobruno.com.ar/programas.html
+#            http://code.google.com/p/mtvcgui/
+
+"""Metrics of the recordings in the Prometheus text format, to monitor
+many capture computers. They are served over HTTP on metrics_port (at
+/metrics, 0 disables it) and/or written every few seconds to
+mtvcgui_<pid>.prom in metrics_textfile_dir, for the textfile collector of
+node_exporter. Each process of the headless scheduler writes its own file,
+only the first one can listen on the port.
+
+The values are read from what the recordings already keep (the progress
+parsed from mencoder and the samples of procstats), collecting them is
+cheap.
+"""
+
+import BaseHTTPServer
+import os
+import threading
+import time
+
+from utils import set_cloexec
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+#seconds between writes of the textfile
+TEXTFILE_INTERVAL = 5
+
+
+def escape_label(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+class MetricsText(object):
+    """Builds the text of the metrics. The samples of each one are kept
+    together after its HELP and TYPE lines, as the format requires."""
+
+    def __init__(self):
+        self.names = []
+        #name: (help, type, sample lines)
+        self.families = {}
+
+    def add(self, name, value, labels=None, help_text='', kind='gauge'):
+        if value is None:
+            return
+        if name not in self.families:
+            self.names.append(name)
+            self.families[name] = (help_text, kind, [])
+        sample = name
+        if labels:
+            sample = "%s{%s}" % (name, ",".join(
+                '%s="%s"' % (key, escape_label(labels[key]))
+                for key in sorted(labels)))
+        self.families[name][2].append("%s %s" % (sample, float(value)))
+
+    def text(self):
+        lines = []
+        for name in self.names:
+            help_text, kind, samples = self.families[name]
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s %s" % (name, kind))
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+def add_recording(text, recording):
+    metrics = recording.metrics
+    labels = {'device': recording.parameters.get('device') or '',
+              'channel': recording.parameters.get('channel_text') or ''}
+    text.add('mtvcgui_recording_start_time_seconds', recording.start_time,
+             labels, "When the recording started")
+    text.add('mtvcgui_recording_position_seconds', metrics.position, labels,
+             "Seconds of video encoded")
+    text.add('mtvcgui_recording_fps', metrics.fps, labels,
+             "Encoding speed in frames per second")
+    text.add('mtvcgui_recording_speed', metrics.speed, labels,
+             "Seconds encoded per second of real time")
+    text.add('mtvcgui_recording_frames_total', metrics.frames, labels,
+             "Frames encoded", 'counter')
+    text.add('mtvcgui_recording_skipped_frames_total',
+             metrics.skipped_frames, labels,
+             "Frames skipped because the encoder fell behind", 'counter')
+    text.add('mtvcgui_recording_duplicate_frames_total',
+             metrics.duplicate_frames, labels, "Frames duplicated",
+             'counter')
+    text.add('mtvcgui_recording_written_bytes_total',
+             sum(recording.stats.written.values()), labels,
+             "Bytes written to disk by the processes of the recording",
+             'counter')
+    if recording.stats.samples:
+        for name, usage in recording.stats.samples[-1][1].items():
+            process_labels = dict(labels, process=name)
+            text.add('mtvcgui_process_cpu_percent', usage.cpu_percent,
+                     process_labels, "CPU used by the process, 100 is a "
+                     "whole CPU")
+            text.add('mtvcgui_process_resident_bytes', usage.rss,
+                     process_labels, "Resident memory of the process")
+
+
+def collect(recordings=(), schedule=None, transcode_queue=None,
+            active=None, now=None):
+    """Returns the metrics of the running recordings, the scheduled ones
+    and the transcode queue. active is the number of recordings running if
+    they aren't in recordings (they run in child processes)."""
+    if now is None:
+        now = time.time()
+    text = MetricsText()
+    #poll() would finish the recording in the thread of the server
+    running = [r for r in recordings
+               if r.process is not None and r.returncode is None]
+    if active is None:
+        active = len(running)
+    text.add('mtvcgui_recordings_active', active, None,
+             "Recordings running")
+    for recording in running:
+        add_recording(text, recording)
+    if schedule is not None:
+        text.add('mtvcgui_scheduled_recordings', len(schedule.heap), None,
+                 "Recordings scheduled")
+        deadline = schedule.next_deadline()
+        if deadline is not None:
+            text.add('mtvcgui_next_recording_seconds',
+                     max(deadline - now, 0), None,
+                     "Seconds until the next scheduled recording is "
+                     "launched")
+    if transcode_queue is not None:
+        import transcode
+        for status in (transcode.QUEUED, transcode.RUNNING):
+            text.add('mtvcgui_transcode_jobs',
+                     len([job for job in transcode_queue.jobs
+                          if job.status == status]),
+                     {'status': status}, "Re-encodings in the queue")
+    return text.text()
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        try:
+            body = self.server.collect().encode('utf-8')
+        except Exception, e:
+            self.send_error(500, str(e))
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        #scraped every few seconds, don't fill the log
+        pass
+
+
+class MetricsExporter(object):
+    """Serves the text returned by collect on port (if not 0) from a
+    thread, and writes it to textfile_dir (if set) when update is
+    called"""
+
+    def __init__(self, collect, port=0, address='127.0.0.1',
+                 textfile_dir=''):
+        self.collect = collect
+        self.port = port
+        self.address = address
+        self.server = None
+        self.textfile = textfile_dir and os.path.join(
+            textfile_dir, 'mtvcgui_%d.prom' % os.getpid())
+        self.last_write = None
+
+    def start(self):
+        if not self.port:
+            return
+        try:
+            self.server = BaseHTTPServer.HTTPServer(
+                (self.address, self.port), MetricsHandler)
+        except IOError, e:
+            print "Can't serve the metrics on port %d: %s" % (self.port, e)
+            return
+        self.server.collect = self.collect
+        #mencoder and the other children must not keep the port
+        set_cloexec(self.server.fileno())
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def update(self, now=None):
+        """Writes the textfile if TEXTFILE_INTERVAL passed since the last
+        time"""
+        if not self.textfile:
+            return
+        if now is None:
+            now = time.time()
+        if self.last_write and now - self.last_write < TEXTFILE_INTERVAL:
+            return
+        self.last_write = now
+        #the collector must never read a half written file
+        temporary = self.textfile + '.tmp'
+        try:
+            textfile = open(temporary, 'w')
+            try:
+                textfile.write(self.collect().encode('utf-8'))
+            finally:
+                textfile.close()
+            os.rename(temporary, self.textfile)
+        except (IOError, OSError), e:
+            print "Error writing the metrics: %s" % e
+
+    def next_write(self):
+        """Returns when the textfile must be written again, or None if there
+        is none"""
+        if not self.textfile:
+            return None
+        return (self.last_write or time.time()) + TEXTFILE_INTERVAL
+
+    def close_in_child(self):
+        """Closes the port in a process forked from this one. The exec of
+        mencoder closes it, but a fork alone doesn't, and the serving
+        thread only runs in the parent."""
+        if self.server:
+            self.server.socket.close()
+            self.server = None
+        self.textfile = ''
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if self.textfile:
+            try:
+                os.remove(self.textfile)
+            except OSError:
+                pass
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+# Author: Santiago Bruno
+# License: GPL v3
+# Web pages: http://www.santiagobruno.com.ar/programas.html
+#            http://code.google.com/p/mtvcgui/
+
+"""A pool of output directories, usually on different disks, to spread the
+recordings made at the same time. With
+
+    output_roots = /srv/disk1/tv,/srv/disk2/tv
+
+each recording (and each segment that continues it) goes to the root whose
+disk is least loaded: the bytes per second being written to it by the
+recordings running, plus the new one, relative to the sustained write
+speed measured for it. Roots without room for the recording, or that
+wouldn't keep up with it, are only used if no other root is left. The
+output file template is taken relative to the chosen root.
+
+The write speeds are measured with mtvcgui-rec --measure-roots, never while
+recording, and kept in ~/.mtvcgui/output_roots.cache. Until all the roots
+have been measured they are taken as equally fast and only the bytes per
+second being written to them is compared. The recordings writing to each
+root are kept in ~/.mtvcgui/placements.cache so the recordings of other
+processes (e.g. the scheduler) are counted too. The root of a recording
+is chosen and the recording added there in one step, with placements.lock
+held, so the recordings placed at the same time see each other.
+"""
+
+import fcntl
+import itertools
+import os
+import tempfile
+import time
+
+import diskwatch
+import utils
+
+SPEEDS_CACHE_FILENAME = 'output_roots.cache'
+PLACEMENTS_CACHE_FILENAME = 'placements.cache'
+PLACEMENTS_LOCK_FILENAME = 'placements.lock'
+#bytes written to measure the speed of a root, in blocks of this size
+MEASURE_BYTES = 64 * 1024 * 1024
+MEASURE_BLOCK = 1024 * 1024
+MEASURE_PREFIX = '.mtvcgui_write_test'
+
+#numbers the placements of this process, see new_key
+placement_numbers = itertools.count(1)
+
+
+def get_roots(parameters):
+    return [os.path.expanduser(root.strip()) for root in
+            (parameters.get('output_roots') or '').split(',')
+            if root.strip()]
+
+
+def measure_write_speed(directory, size=MEASURE_BYTES):
+    """Writes size bytes to a file in the directory, waiting for them to
+    reach the disk, and returns the bytes per second, or None if it can't
+    be written"""
+    block = '\0' * MEASURE_BLOCK
+    start = time.time()
+    try:
+        fd, filename = tempfile.mkstemp(prefix=MEASURE_PREFIX, dir=directory)
+        test = os.fdopen(fd, 'wb')
+        try:
+            for n in range(max(1, size / MEASURE_BLOCK)):
+                test.write(block)
+            test.flush()
+            os.fsync(test.fileno())
+        finally:
+            test.close()
+            os.remove(filename)
+    except (IOError, OSError), e:
+        print "Can't measure the write speed of %s: %s" % (directory, e)
+        return None
+    return max(1, size / MEASURE_BLOCK) * MEASURE_BLOCK / \
+        max(time.time() - start, 0.001)
+
+
+def get_write_speeds(roots, refresh=False):
+    """Returns the measured write speed of each root, in bytes per second
+    (None if it hasn't been measured or couldn't be). Only with refresh
+    they are measured, all of them."""
+    cache = utils.load_cache(SPEEDS_CACHE_FILENAME)
+    changed = False
+    for root in roots:
+        if refresh:
+            speed = measure_write_speed(root)
+            if speed is None:
+                continue
+            cache[root] = {'speed': speed, 'measured': time.time()}
+            changed = True
+    if changed:
+        utils.save_cache(SPEEDS_CACHE_FILENAME, cache)
+    return dict((root, cache.get(root, {}).get('speed')) for root in roots)
+
+
+def process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def new_key():
+    """Returns a key for a placement of this process, unique among the
+    running ones"""
+    return "%d-%d" % (os.getpid(), next(placement_numbers))
+
+
+def lock_placements():
+    """Returns the open lock file of the placements once this process
+    holds it (until it is closed), or None if it can't be opened"""
+    lock_filename = os.path.join(utils.get_config_dir(),
+                                 PLACEMENTS_LOCK_FILENAME)
+    try:
+        lock_file = open(lock_filename, 'a')
+    except IOError:
+        return None
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    return lock_file
+
+
+def load_placements():
+    """Returns the recordings running in the roots, as a dict of key:
+    (root, bytes per second), without the ones whose process has
+    finished"""
+    cache = utils.load_cache(PLACEMENTS_CACHE_FILENAME)
+    placements = {}
+    for key, (root, rate) in cache.items():
+        if process_exists(int(key.split('-')[0])):
+            placements[key] = (root, rate)
+    return placements
+
+
+def add_placement(key, root, rate):
+    """Counts the recording of the placement key in the load of root"""
+    lock_file = lock_placements()
+    try:
+        placements = load_placements()
+        placements[key] = (root, rate)
+        utils.save_cache(PLACEMENTS_CACHE_FILENAME, placements)
+    finally:
+        if lock_file:
+            lock_file.close()
+
+
+def remove_placement(key):
+    lock_file = lock_placements()
+    try:
+        placements = load_placements()
+        if placements.pop(key, None):
+            utils.save_cache(PLACEMENTS_CACHE_FILENAME, placements)
+    finally:
+        if lock_file:
+            lock_file.close()
+
+
+def get_device(directory):
+    try:
+        return os.stat(directory).st_dev
+    except OSError:
+        return None
+
+
+def choose_root(parameters, rate, needed, placements):
+    """Returns the root for a recording that writes rate bytes per second
+    and needs needed bytes, given the placements running, or None if there
+    are no roots available. The roots on the same disk share its load."""
+    roots = [root for root in get_roots(parameters) if os.path.isdir(root)]
+    if not roots:
+        return None
+    speeds = get_write_speeds(roots)
+    measured = all(speeds.get(root) for root in roots)
+    #bytes per second being written, by disk
+    writing = {}
+    for root, root_rate in placements.values():
+        device = get_device(root)
+        writing[device] = writing.get(device, 0) + root_rate
+    max_load = parameters.get('output_root_max_load') or 1.0
+    candidates = []
+    for root in roots:
+        free = diskwatch.free_space(root) or 0
+        device = get_device(root)
+        if measured:
+            load = (writing.get(device, 0) + rate) / speeds[root]
+            slow = load > max_load
+        else:
+            #all taken as equally fast until they are measured
+            load = writing.get(device, 0) + rate
+            slow = False
+        #the ones that can hold it and keep up first, then the least
+        #loaded, then the one with more space
+        candidates.append(((free < needed, slow, load, -free), root))
+    return min(candidates)[1]
+
+
+def place(parameters, rate=None, key=None):
+    """Returns the root for a recording with the parameters, writing rate
+    bytes per second (estimated from its bitrates by default), or None if
+    there is no pool. With a key (see new_key) the recording is added to
+    the placements of the root, before another process can choose one."""
+    if not get_roots(parameters):
+        return None
+    if rate is None:
+        rate = utils.estimate_bitrate(parameters) * 1000 / 8
+    needed = rate * (utils.str_to_secs(parameters.get('duration')) or
+                     parameters.get('disk_warn_minutes', 0) * 60)
+    lock_file = lock_placements()
+    try:
+        placements = load_placements()
+        root = choose_root(parameters, rate, needed, placements)
+        if key and root:
+            placements[key] = (root, rate)
+            utils.save_cache(PLACEMENTS_CACHE_FILENAME, placements)
+    finally:
+        if lock_file:
+            lock_file.close()
+    return root
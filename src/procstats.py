@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+# Author: Santiago Bruno
+# License: GPL v3
+# Web pages: http://www.santiagobruno.com.ar/programas.html
+#            http://code.google.com/p/mtvcgui/
+
+"""Resources used by the processes of a recording (mencoder, the preview
+player, the encoders of the renditions and the thread of ours that copies
+the stream to them), sampled from /proc/<pid>/stat, status and io. The
+last samples are kept in memory and a summary with all of them is saved
+next to the recording, in filename.stats, to see how many captures at the
+same time a computer can handle.
+"""
+
+import collections
+import json
+import os
+import time
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+#seconds between samples, and samples kept (the last 10 minutes)
+SAMPLE_INTERVAL = 1.0
+MAX_SAMPLES = 600
+#the stats file is written again after this many seconds, and at the end
+SAVE_INTERVAL = 60
+STATS_SUFFIX = '.stats'
+
+#usage of a process: CPU used since the previous sample (100 is a whole
+#CPU), resident memory in bytes and bytes written to disk since it started
+Usage = collections.namedtuple('Usage', 'cpu_percent rss write_bytes')
+
+
+def read_process(pid, tid=None):
+    """Returns (CPU seconds, resident bytes, bytes written to disk) of the
+    process, or None if it has finished. The bytes written are None if
+    /proc/<pid>/io can't be read. If tid is given only that thread of the
+    process is read, its memory is shared with the rest and is left out
+    (0)."""
+    directory = '/proc/%d' % pid
+    if tid is not None:
+        directory += '/task/%d' % tid
+    try:
+        stat = open(directory + '/stat').read()
+        status = ''
+        if tid is None:
+            status = open(directory + '/status').read()
+    except IOError:
+        return None
+    #the name of the command, in parenthesis, may have spaces
+    fields = stat[stat.rindex(')') + 2:].split()
+    #utime and stime, fields 14 and 15 of stat
+    cpu = (int(fields[11]) + int(fields[12])) / float(CLOCK_TICKS)
+    rss = 0
+    for line in status.splitlines():
+        if line.startswith('VmRSS:'):
+            rss = int(line.split()[1]) * 1024
+            break
+    write_bytes = None
+    try:
+        for line in open(directory + '/io'):
+            if line.startswith('write_bytes:'):
+                write_bytes = int(line.split()[1])
+                break
+    except IOError:
+        pass
+    return cpu, rss, write_bytes
+
+
+class ProcessStats(object):
+    """Samples of the usage of a group of processes, by name. samples has
+    the last ones as (time, {name: Usage}); the totals of all of them are
+    kept apart so the summary covers the whole recording."""
+
+    def __init__(self, max_samples=MAX_SAMPLES):
+        self.samples = collections.deque(maxlen=max_samples)
+        #pid: (time, CPU seconds) of its previous sample
+        self.previous = {}
+        self.count = 0
+        #the first sample of a process has no CPU usage yet
+        self.cpu_count = 0
+        self.cpu_percent_sum = 0.0
+        self.cpu_percent_max = 0.0
+        self.rss_max = 0
+        #name: highest bytes written seen, they only grow
+        self.written = {}
+        self.last_sample = None
+        self.last_save = time.time()
+
+    def sample(self, processes, now=None):
+        """Samples the processes, a dict of name: pid (or (pid, tid) for a
+        thread of a process), and returns the {name: Usage} of the ones
+        running"""
+        if now is None:
+            now = time.time()
+        usages = {}
+        measured = False
+        for name, pid in processes.items():
+            if isinstance(pid, tuple):
+                values = read_process(*pid)
+            else:
+                values = read_process(pid)
+            if values is None:
+                continue
+            cpu, rss, write_bytes = values
+            cpu_percent = 0.0
+            if pid in self.previous:
+                when, previous_cpu = self.previous[pid]
+                if now > when:
+                    cpu_percent = (cpu - previous_cpu) / (now - when) * 100
+                    measured = True
+            self.previous[pid] = (now, cpu)
+            usages[name] = Usage(round(cpu_percent, 1), rss, write_bytes)
+            if write_bytes is not None:
+                self.written[name] = max(self.written.get(name, 0),
+                                         write_bytes)
+        self.last_sample = now
+        if usages:
+            self.samples.append((now, usages))
+            total = self.total(usages)
+            self.count += 1
+            if measured:
+                self.cpu_count += 1
+                self.cpu_percent_sum += total.cpu_percent
+                self.cpu_percent_max = max(self.cpu_percent_max,
+                                           total.cpu_percent)
+            self.rss_max = max(self.rss_max, total.rss)
+        return usages
+
+    def due(self, now=None):
+        """Returns True if SAMPLE_INTERVAL passed since the last sample"""
+        if now is None:
+            now = time.time()
+        return self.last_sample is None or \
+            now - self.last_sample >= SAMPLE_INTERVAL
+
+    def total(self, usages):
+        """Returns the Usage of all the processes of a sample together"""
+        return Usage(sum(u.cpu_percent for u in usages.values()),
+                     sum(u.rss for u in usages.values()),
+                     sum(u.write_bytes or 0 for u in usages.values()))
+
+    def current(self):
+        """Returns the total Usage of the last sample, or None"""
+        if not self.samples:
+            return None
+        return self.total(self.samples[-1][1])
+
+    def summary(self):
+        return {'samples': self.count,
+                'cpu_percent_avg': round(self.cpu_count and
+                                         self.cpu_percent_sum /
+                                         self.cpu_count, 1),
+                'cpu_percent_max': round(self.cpu_percent_max, 1),
+                'rss_max': self.rss_max,
+                'write_bytes': sum(self.written.values())}
+
+    def save(self, filename, now=None):
+        """Writes the summary and the samples kept to filename"""
+        self.last_save = now or time.time()
+        stats = self.summary()
+        stats['series'] = [
+            {'time': round(when, 2),
+             'processes': dict((name, usage._asdict())
+                               for name, usage in usages.items())}
+            for when, usages in self.samples]
+        try:
+            stats_file = open(filename, 'w')
+            try:
+                json.dump(stats, stats_file)
+            finally:
+                stats_file.close()
+        except IOError, e:
+            print "Error writing the stats file: %s" % e
+
+    def save_due(self, now=None):
+        """Returns True if the stats file must be written again"""
+        if now is None:
+            now = time.time()
+        return now - self.last_save >= SAVE_INTERVAL
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+# Author: Santiago Bruno
+# License: GPL v3
+# Web pages: http://www.santiagobruno.com.ar/programas.html
+#            http://code.google.com/p/mtvcgui/
+
+"""Parsing of the progress that mencoder prints while encoding, e.g.
+
+Pos:  12.3s    308f ( 5%)  25.12fps Trem:   2min  45mb  A-V:0.012 [1498:128]
+
+or ffmpeg with -progress, in blocks of key=value lines ending with
+progress=continue.
+"""
+
+import re
+import time
+
+STATUS_RE = re.compile(r"Pos:\s*(?P<position>[\d.]+)s\s+(?P<frames>\d+)f"
+                       r"(?:\s+\(\s*(?P<percent>\d+)%\))?"
+                       r"(?:\s+(?P<fps>[\d.]+)fps)?"
+                       r"(?:\s+Trem:\s*(?P<remaining>\d+)min)?"
+                       r"(?:\s+(?P<size>\d+)mb)?"
+                       r"(?:\s+A-V:\s*(?P<av>[-\d.]+))?"
+                       r"(?:\s+\[(?P<vbitrate>\d+):(?P<abitrate>\d+)\])?")
+SKIPPING_RE = re.compile(r"Skipping frame!")
+DUPLICATE_RE = re.compile(r"(\d+) duplicate frame\(s\)!")
+FFMPEG_RE = re.compile(r"^(\w+)=\s*(\S*)$")
+
+#longest partial line kept while waiting for its end
+MAX_PENDING = 4096
+
+
+class EncoderMetrics(object):
+    """Progress of a running mencoder, as parsed by ProgressParser"""
+
+    def __init__(self):
+        #seconds of video encoded, frames encoded and percent of -endpos
+        self.position = 0.0
+        self.frames = 0
+        self.percent = None
+        #encoding speed reported by mencoder, in frames per second
+        self.fps = 0.0
+        self.min_fps = None
+        self.fps_sum = 0.0
+        self.fps_samples = 0
+        #estimated remaining time and final size
+        self.remaining_min = None
+        self.size_mb = 0
+        self.av_delay = 0.0
+        self.video_bitrate = None
+        self.audio_bitrate = None
+        #frames mencoder had to drop or duplicate to keep up
+        self.skipped_frames = 0
+        self.duplicate_frames = 0
+        #seconds of video encoded per second of real time in the last
+        #updates, less than 1 means that the encoder is falling behind
+        self.speed = None
+        self.start_time = time.time()
+        self.updated = None
+
+    def average_fps(self):
+        if not self.fps_samples:
+            return 0.0
+        return self.fps_sum / self.fps_samples
+
+    def as_dict(self):
+        return {'position': self.position, 'frames': self.frames,
+                'percent': self.percent, 'fps': self.fps,
+                'min_fps': self.min_fps, 'average_fps': self.average_fps(),
+                'remaining_min': self.remaining_min, 'size_mb': self.size_mb,
+                'av_delay': self.av_delay,
+                'video_bitrate': self.video_bitrate,
+                'audio_bitrate': self.audio_bitrate,
+                'skipped_frames': self.skipped_frames,
+                'duplicate_frames': self.duplicate_frames,
+                'speed': self.speed}
+
+
+class ProgressParser(object):
+    """Parses mencoder output incrementally as it is read. mencoder rewrites
+    its status line ending it with a carriage return, so only the last
+    incomplete line is kept between calls to feed."""
+
+    def __init__(self, metrics=None):
+        self.metrics = metrics or EncoderMetrics()
+        self.pending = ''
+        self.last_position = None
+        self.last_time = None
+        #values of the ffmpeg progress block being read
+        self.ffmpeg_values = {}
+
+    def feed(self, data, now=None):
+        """Parses a chunk of output. Returns true if the metrics changed."""
+        if now is None:
+            now = time.time()
+        lines = re.split('[\r\n]', self.pending + data)
+        self.pending = lines.pop()[-MAX_PENDING:]
+        changed = False
+        for line in lines:
+            changed = self.parse_line(line, now) or changed
+        return changed
+
+    def parse_line(self, line, now):
+        metrics = self.metrics
+        changed = False
+        for match in SKIPPING_RE.finditer(line):
+            metrics.skipped_frames += 1
+            changed = True
+        for match in DUPLICATE_RE.finditer(line):
+            metrics.duplicate_frames += int(match.group(1))
+            changed = True
+
+        match = FFMPEG_RE.match(line)
+        if match:
+            return self.parse_ffmpeg_value(match.group(1), match.group(2),
+                                           now)
+
+        match = STATUS_RE.search(line)
+        if not match:
+            return changed
+        values = match.groupdict()
+        metrics.position = float(values['position'])
+        metrics.frames = int(values['frames'])
+        if values['percent'] is not None:
+            metrics.percent = int(values['percent'])
+        if values['fps'] is not None:
+            metrics.fps = float(values['fps'])
+            metrics.fps_sum += metrics.fps
+            metrics.fps_samples += 1
+            if metrics.min_fps is None or metrics.fps < metrics.min_fps:
+                metrics.min_fps = metrics.fps
+        if values['remaining'] is not None:
+            metrics.remaining_min = int(values['remaining'])
+        if values['size'] is not None:
+            metrics.size_mb = int(values['size'])
+        if values['av'] is not None:
+            metrics.av_delay = float(values['av'])
+        if values['vbitrate'] is not None:
+            metrics.video_bitrate = int(values['vbitrate'])
+            metrics.audio_bitrate = int(values['abitrate'])
+        self.update_speed(now)
+        return True
+
+    def parse_ffmpeg_value(self, key, value, now):
+        """Keeps a value of the ffmpeg progress, and updates the metrics
+        with all of them at the end of the block"""
+        if key != 'progress':
+            self.ffmpeg_values[key] = value
+            return False
+        values = self.ffmpeg_values
+        self.ffmpeg_values = {}
+        metrics = self.metrics
+        try:
+            #out_time_ms is in microseconds too
+            position = values.get('out_time_us', values.get('out_time_ms'))
+            if position not in (None, 'N/A'):
+                metrics.position = int(position) / 1e6
+            metrics.frames = int(values.get('frame', metrics.frames))
+            if 'fps' in values:
+                metrics.fps = float(values['fps'])
+                metrics.fps_sum += metrics.fps
+                metrics.fps_samples += 1
+                if metrics.min_fps is None or metrics.fps < metrics.min_fps:
+                    metrics.min_fps = metrics.fps
+            if values.get('total_size', 'N/A') != 'N/A':
+                metrics.size_mb = int(values['total_size']) / (1024 * 1024)
+            #ffmpeg counts them from the start
+            metrics.skipped_frames = int(values.get('drop_frames',
+                                                    metrics.skipped_frames))
+            metrics.duplicate_frames = int(values.get(
+                'dup_frames', metrics.duplicate_frames))
+        except ValueError:
+            return False
+        self.update_speed(now)
+        return True
+
+    def update_speed(self, now):
+        metrics = self.metrics
+        if self.last_time is not None and now - self.last_time >= 1:
+            metrics.speed = (metrics.position - self.last_position) / \
+                (now - self.last_time)
+            self.last_position = metrics.position
+            self.last_time = now
+        elif self.last_time is None:
+            self.last_position = metrics.position
+            self.last_time = now
+        metrics.updated = now
@@ -0,0 +1,623 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""
+    mtvcgui-rec: headless recorder for mtvcgui
+    Copyright (C) 2008-2012  Santiago Bruno
+    Web pages: http://www.santiagobruno.com.ar/programas.html#mtvcgui
+               http://code.google.com/p/mtvcgui/
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Records using the configuration saved from the GUI without importing PyQt,
+# so it starts fast and can be run from cron or as a systemd service.
+
+#python imports
+import errno
+import os
+import select
+import signal
+import sys
+import time
+from optparse import OptionParser
+
+#other imports, the modules of the other commands (calibration, re-encoding,
+#reports...) are imported where they are used so it starts fast
+import backends
+import childwatch
+import scheduler
+import utils
+from recorder import Recording, make_timeshift_filename
+
+
+def parse_args(argv):
+    parser = OptionParser(usage="%prog [options]",
+        description="Records TV with mencoder using a configuration saved "
+                    "from mtvcgui (by default ~/.mtvcgui/mtvcgui.ini).")
+    parser.add_option("-c", "--config", dest="config",
+                      help="configuration file to use")
+    parser.add_option("-d", "--duration", dest="duration",
+                      help="recording length as hh:mm:ss")
+    parser.add_option("--channel", dest="channel",
+                      help="channel number to record")
+    parser.add_option("--frequency", dest="frequency",
+                      help="frequency to record")
+    parser.add_option("-o", "--output", dest="outputfile",
+                      help="output file template, e.g. "
+                           "./capture_{%channel_%Y%m%d_%H%M%S}.avi")
+    parser.add_option("--no-commands", dest="run_commands",
+                      action="store_false", default=True,
+                      help="don't run the pre and post capture commands")
+    parser.add_option("-n", "--dry-run", dest="dry_run",
+                      action="store_true", default=False,
+                      help="print the mencoder command and exit")
+    parser.add_option("-b", "--background", dest="background",
+                      action="store_true", default=False,
+                      help="detach from the terminal and record in background")
+    parser.add_option("-l", "--log", dest="log",
+                      help="file where output is written when recording in "
+                           "background (default /dev/null)")
+    parser.add_option("--calibrate", dest="calibrate",
+                      action="store_true", default=False,
+                      help="benchmark the presets of the video codec and save "
+                           "the best one this machine encodes in real time")
+    parser.add_option("--sample", dest="sample",
+                      help="recorded clip to use when calibrating instead of "
+                           "a synthetic source")
+    parser.add_option("--compare-backends", dest="compare_backends",
+                      action="store_true", default=False,
+                      help="encode the --sample clip with mencoder and "
+                           "ffmpeg and compare their speed")
+    parser.add_option("--headroom", dest="headroom", type="float",
+                      help="spare encoding speed required when calibrating, "
+                           "as a fraction of the frame rate (default 0.2)")
+    parser.add_option("--timeshift", dest="timeshift",
+                      action="store_true", default=False,
+                      help="capture to the time-shift buffer until stopped; "
+                           "SIGUSR1 starts recording from timeshift_minutes "
+                           "ago and SIGUSR2 stops recording")
+    parser.add_option("--at", dest="at",
+                      help="schedule the recording at the given time "
+                           "(YYYY-MM-DD HH:MM) instead of recording now")
+    parser.add_option("--repeat", dest="repeat",
+                      choices=sorted(scheduler.RECURRENCES.keys()),
+                      help="repeat the scheduled recording daily or weekly")
+    parser.add_option("--list-schedule", dest="list_schedule",
+                      action="store_true", default=False,
+                      help="list the scheduled recordings")
+    parser.add_option("--unschedule", dest="unschedule", type="int",
+                      metavar="ID", help="remove a scheduled recording")
+    parser.add_option("--scheduler", dest="scheduler",
+                      action="store_true", default=False,
+                      help="make the scheduled recordings, don't run the "
+                           "GUI at the same time or they will be recorded "
+                           "twice")
+    parser.add_option("--transcode", dest="transcode", metavar="FILE",
+                      help="queue the re-encoding of a recorded file with "
+                           "the settings of the [transcode] section")
+    parser.add_option("--transcode-queue", dest="transcode_queue",
+                      action="store_true", default=False,
+                      help="run the queued re-encodings until there are "
+                           "none left")
+    parser.add_option("--chunks", dest="chunks", type="int",
+                      help="with --transcode, re-encode the file now split "
+                           "in this many chunks encoded in parallel (0 for "
+                           "one per CPU)")
+    parser.add_option("--benchmark-chunks", dest="benchmark_chunks",
+                      action="store_true", default=False,
+                      help="with --transcode, compare re-encoding the file "
+                           "in a single process and in parallel chunks")
+    parser.add_option("--measure-roots", dest="measure_roots",
+                      action="store_true", default=False,
+                      help="measure the write speed of the output_roots "
+                           "again")
+    parser.add_option("--report", dest="report", metavar="DIR",
+                      help="summarize the telemetry of the recordings in "
+                           "DIR, to find the ones that miss real time")
+    parser.add_option("--group-by", dest="group_by", action="append",
+                      help="with --report, group the recordings by channel, "
+                           "device, preset or backend (all of them by "
+                           "default)")
+    options, args = parser.parse_args(argv)
+    if options.group_by:
+        import telemetry
+        for key in options.group_by:
+            if key not in telemetry.GROUP_KEYS:
+                parser.error("invalid --group-by %s, use one of %s" % (
+                    key, ", ".join(telemetry.GROUP_KEYS)))
+    return options, args
+
+
+def get_parameters(options):
+    """Returns the recording parameters from the configuration, overridden
+    by the command line options, or None if there is no configuration"""
+    parameters = utils.load_parameters(options.config)
+    if parameters is None:
+        return None
+    if options.duration:
+        parameters['duration'] = options.duration
+    if options.channel:
+        parameters['channel_type'] = 'number'
+        parameters['channel'] = options.channel
+        parameters['channel_text'] = options.channel
+    if options.frequency:
+        parameters['channel_type'] = 'frequency'
+        parameters['frequency'] = options.frequency
+        parameters['channel_text'] = options.frequency
+    if options.outputfile:
+        parameters['outputfile'] = options.outputfile
+    if not options.run_commands:
+        parameters['pre_command'] = ''
+        parameters['post_command'] = ''
+    return parameters
+
+
+def daemonize(log_filename=None):
+    """Detaches the process from the terminal"""
+    if os.fork():
+        os._exit(0)
+    os.setsid()
+    if os.fork():
+        os._exit(0)
+    null = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(null, sys.stdin.fileno())
+    log = os.open(log_filename or os.devnull,
+                  os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644)
+    os.dup2(log, sys.stdout.fileno())
+    os.dup2(log, sys.stderr.fileno())
+
+
+def make_exporter(parameters, get_arguments):
+    """Returns the started metrics.MetricsExporter of the settings, or None
+    if the metrics aren't exported. get_arguments returns the keyword
+    arguments of metrics.collect."""
+    if not parameters.get('metrics_port') and \
+        not parameters.get('metrics_textfile_dir'):
+        return None
+    import metrics
+    exporter = metrics.MetricsExporter(
+        lambda: metrics.collect(**get_arguments()),
+        parameters.get('metrics_port'), parameters.get('metrics_address'),
+        parameters.get('metrics_textfile_dir'))
+    exporter.start()
+    return exporter
+
+
+def record(parameters):
+    """Records supervising mencoder until it finishes or a signal to stop is
+    received. Returns mencoder exit status."""
+    recording = Recording(parameters)
+    #the segment being recorded, the settings may change in a new segment
+    current = [recording]
+    recording.check_space()
+
+    def stop(signum, frame):
+        print "Stopping recording (signal %d)" % signum
+        current[0].stop()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, stop)
+
+    try:
+        recording.run_pre_command()
+    except OSError:
+        print "excecution of %s failed" % parameters.get('pre_command')
+
+    segment = recording
+    #the files recorded, one per segment
+    finished = []
+    exporter = make_exporter(parameters, lambda: {'recordings': current})
+    while segment:
+        current[0] = segment
+        try:
+            segment.start()
+        except OSError, e:
+            print segment.start_error(e)
+            if segment is recording:
+                if exporter:
+                    exporter.stop()
+                return 1
+            break
+
+        returncode = segment.wait(exporter and exporter.update)
+        print "process finished with status code %s" % str(returncode)
+        progress = segment.metrics
+        print "Encoded %d frames at %.1f fps on average, %d skipped, " \
+            "%d duplicate" % (progress.frames, progress.average_fps(),
+                              progress.skipped_frames,
+                              progress.duplicate_frames)
+        finished.append(segment)
+        segment = segment.next_segment()
+    if exporter:
+        exporter.stop()
+
+    try:
+        recording.run_post_command()
+    except OSError:
+        print "excecution of %s failed" % parameters.get('post_command')
+
+    #the intermediate files of two-stage captures, or the re-encodings
+    import transcode
+    queue = transcode.TranscodeQueue(parameters.get('transcode_workers'))
+    if [segment for segment in finished
+        if queue.add_recording(segment.filename, segment.parameters)]:
+        run_transcode_queue(queue)
+
+    return returncode
+
+
+def run_transcode_queue(queue):
+    """Runs the queued re-encodings until there are none left, unless
+    another process is running them"""
+    if not queue.lock():
+        print "The transcode queue is being run by another process"
+        return 0
+
+    def stop(signum, frame):
+        print "Stopping transcoding (signal %d)" % signum
+        queue.stop()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, stop)
+
+    queue.run()
+    return 0
+
+
+def log(line):
+    print line
+    sys.stdout.flush()
+
+
+def transcode_chunked(parameters, options):
+    """Re-encodes a file now, in parallel chunks"""
+    import chunked
+    import transcode
+    parameters = transcode.get_transcode_parameters(parameters)
+    inputfile = os.path.abspath(options.transcode)
+    outputfile = transcode.make_output_filename(inputfile, parameters)
+    returncode = chunked.encode_chunked(parameters, inputfile, outputfile,
+                                        options.chunks, log=log)
+    if not returncode:
+        print "Saved %s" % outputfile
+    return returncode
+
+
+def benchmark_chunks(parameters, options):
+    import chunked
+    import transcode
+    parameters = transcode.get_transcode_parameters(parameters)
+    result = chunked.benchmark_chunked(parameters,
+                                       os.path.abspath(options.transcode),
+                                       options.chunks, log=log)
+    if result['returncode']:
+        print >> sys.stderr, "mencoder failed with status %d" % \
+            result['returncode']
+        return 1
+    print "Single process: %.1f s, parallel chunks: %.1f s (%.2fx)" % (
+        result['single'], result['chunked'], result['speedup'])
+    return 0
+
+
+def timeshift(parameters):
+    """Captures to the time-shift buffer, keeping part of it when asked
+    with signals. Returns mencoder exit status."""
+    parameters = dict(parameters)
+    parameters['timeshift'] = True
+    parameters['duration'] = ''
+    recording = Recording(parameters)
+    copiers = []
+
+    def keep(signum, frame):
+        if copiers and copiers[-1].last is None:
+            return
+        filename = make_timeshift_filename(parameters)
+        print "Recording from %d minutes ago to %s" % (
+            parameters.get('timeshift_minutes'), filename)
+        copiers.append(recording.keep(filename))
+
+    def stop_keeping(signum, frame):
+        if copiers and copiers[-1].last is None:
+            print "Recording stopped"
+            copiers[-1].stop()
+
+    def stop(signum, frame):
+        print "Stopping time-shift capture (signal %d)" % signum
+        recording.stop()
+
+    signal.signal(signal.SIGUSR1, keep)
+    signal.signal(signal.SIGUSR2, stop_keeping)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, stop)
+
+    try:
+        recording.start()
+    except OSError, e:
+        print recording.start_error(e)
+        return 1
+    returncode = recording.wait()
+    print "process finished with status code %s" % str(returncode)
+    #they end with the capture
+    for copier in copiers:
+        copier.join()
+    return returncode
+
+
+def run_calibration(parameters, options):
+    """Finds and saves the best preset for the selected video codec"""
+    import calibrate
+    if options.headroom is None:
+        options.headroom = calibrate.DEFAULT_HEADROOM
+    if not calibrate.get_ladder(parameters):
+        print >> sys.stderr, "There are no presets to calibrate for the " \
+            "%s video codec" % parameters.get('videocodec')
+        return 2
+    print "Calibrating for %.2f fps with %d%% of headroom" % \
+        (utils.get_capture_fps(parameters), options.headroom * 100)
+    preset, results = calibrate.calibrate(parameters, sample=options.sample,
+                                          headroom=options.headroom, log=log)
+    if preset is None:
+        print >> sys.stderr, "mencoder failed with every preset"
+        return 1
+    result = dict(results)[preset]
+    calibrate.save_preset(parameters, preset, result,
+                          config_filename=options.config)
+    print "Saved %s (%.1f fps)" % (preset[0], result['fps'])
+    return 0
+
+
+def compare_backends(parameters, options):
+    """Encodes the sample with each backend and prints their speed"""
+    if not options.sample:
+        print >> sys.stderr, "A recorded clip is needed, use --sample"
+        return 2
+    for name, result in backends.benchmark(parameters, options.sample):
+        if result.get('error'):
+            print "%s: %s" % (name, result['error'])
+        elif result['returncode']:
+            print "%s: failed with status %d" % (name, result['returncode'])
+        else:
+            print "%s: %.1f fps, %.1f CPUs" % (name, result['fps'],
+                                               result['cpu_load'])
+    return 0
+
+
+def print_conflicts(conflicts):
+    for start, jobs in conflicts:
+        print "Conflict at %s with: %s" % (
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(start)),
+            ", ".join("%d %s" % (job.id, job.description()) for job in jobs))
+
+
+def schedule(parameters, options):
+    """Adds a recording to the schedule"""
+    try:
+        start = time.mktime(time.strptime(options.at, '%Y-%m-%d %H:%M'))
+    except ValueError:
+        print >> sys.stderr, "Invalid time %s, use YYYY-MM-DD HH:MM" % \
+            options.at
+        return 2
+    duration = utils.str_to_secs(parameters.get('duration')) or 0
+    job = scheduler.ScheduledJob(start, duration, parameters, options.repeat)
+    schedule = scheduler.Scheduler(parameters.get('tuners', 1))
+    conflicts = schedule.add(job)
+    print "Scheduled %d %s" % (job.id, job.description())
+    print_conflicts(conflicts)
+    return 0
+
+
+def list_schedule(parameters):
+    schedule = scheduler.Scheduler(parameters.get('tuners', 1))
+    for job in schedule.jobs():
+        print "%d %s" % (job.id, job.description())
+        print_conflicts(schedule.conflicts(job))
+    return 0
+
+
+def run_scheduler(parameters):
+    """Records the scheduled recordings when their time comes, each one in
+    a child process. It sleeps until the next one must start, or until the
+    schedule is changed (SIGUSR1) or a child finishes. The signals are
+    written to the pipe of a childwatch.ChildWatcher, so one that arrives
+    before the sleep starts is not lost."""
+    schedule = scheduler.Scheduler(parameters.get('tuners', 1))
+    pid_filename = os.path.join(utils.get_config_dir(),
+                                scheduler.SCHEDULER_PID_FILENAME)
+    pid_file = open(pid_filename, 'w')
+    pid_file.write(str(os.getpid()))
+    pid_file.close()
+
+    children = {}
+    stopping = []
+    exporter = make_exporter(parameters, lambda: {'schedule': schedule,
+                                                  'active': len(children)})
+
+    def stop(signum, frame):
+        stopping.append(signum)
+
+    #it handles SIGCHLD, and every signal with a handler wakes it up
+    watcher = childwatch.get_watcher()
+    signal.signal(signal.SIGUSR1, lambda signum, frame: None)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, stop)
+
+    print "Scheduler started"
+    try:
+        while not stopping:
+            while children:
+                try:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                except OSError, e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                if not pid:
+                    break
+                #a child that isn't a job is just reaped
+                job = children.pop(pid, None)
+                if job:
+                    print "Finished %s" % job.description()
+
+            schedule.load()
+            for job in schedule.pop_due():
+                print "Starting %s" % job.description()
+                job_parameters = scheduler.job_parameters(job)
+                if not job_parameters.get('encoder_threads'):
+                    #its share of the CPUs with the recordings running
+                    job_parameters['encoder_threads'] = max(1,
+                        utils.get_available_cpus() / (len(children) + 1))
+                #the port is ours, the recording writes its own textfile
+                job_parameters['metrics_port'] = 0
+                pid = os.fork()
+                if not pid:
+                    if exporter:
+                        exporter.close_in_child()
+                    signal.set_wakeup_fd(-1)
+                    for signum in (signal.SIGUSR1, signal.SIGCHLD):
+                        signal.signal(signum, signal.SIG_DFL)
+                    returncode = 1
+                    try:
+                        returncode = max(record(job_parameters), 0)
+                    finally:
+                        os._exit(returncode)
+                children[pid] = job
+
+            if exporter:
+                exporter.update()
+            deadline = schedule.next_deadline()
+            if stopping:
+                break
+            next_write = exporter and exporter.next_write()
+            if next_write:
+                #wake up to write the metrics
+                deadline = min(deadline or next_write, next_write)
+            timeout = None
+            if deadline is not None:
+                timeout = max(deadline - time.time(), 0)
+            try:
+                select.select([watcher], [], [], timeout)
+            except select.error:
+                #interrupted by a signal, it is in the pipe too
+                pass
+            watcher.handle_events()
+    finally:
+        if exporter:
+            exporter.stop()
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        os.remove(pid_filename)
+    print "Scheduler stopped"
+    return 0
+
+
+def measure_roots(parameters):
+    """Measures the write speed of the output roots and prints them"""
+    import outputpool
+    roots = outputpool.get_roots(parameters)
+    if not roots:
+        print >> sys.stderr, "No output_roots in the configuration"
+        return 1
+    speeds = outputpool.get_write_speeds(roots, refresh=True)
+    for root in roots:
+        if speeds.get(root):
+            print "%s: %.1f MB/s" % (root, speeds[root] / 1e6)
+        else:
+            print "%s: can't be written" % root
+    return 0
+
+
+def main(argv):
+    options, args = parse_args(argv)
+    if options.report:
+        import telemetry
+        text = telemetry.report(options.report, options.group_by)
+        if text is None:
+            print >> sys.stderr, "No recordings found in %s" % options.report
+            return 1
+        print text
+        return 0
+
+    parameters = get_parameters(options)
+    if parameters is None:
+        print >> sys.stderr, "No configuration found, save one from mtvcgui"
+        return 2
+
+    if options.calibrate:
+        return run_calibration(parameters, options)
+
+    if options.compare_backends:
+        return compare_backends(parameters, options)
+
+    if options.measure_roots:
+        return measure_roots(parameters)
+
+    if options.list_schedule:
+        return list_schedule(parameters)
+
+    if options.unschedule:
+        scheduler.Scheduler().remove(options.unschedule)
+        return 0
+
+    if options.at:
+        return schedule(parameters, options)
+
+    if options.transcode and options.benchmark_chunks:
+        return benchmark_chunks(parameters, options)
+
+    if options.transcode and options.chunks is not None:
+        return transcode_chunked(parameters, options)
+
+    if options.transcode:
+        import transcode
+        queue = transcode.TranscodeQueue(parameters.get('transcode_workers'))
+        job = queue.add(os.path.abspath(options.transcode), parameters)
+        print "Queued %d %s" % (job.id, job.description())
+        return 0
+
+    if options.dry_run:
+        print " ".join(
+            backends.get_backend(parameters).capture_command(parameters))
+        return 0
+
+    if options.background:
+        daemonize(options.log)
+
+    if options.scheduler:
+        return run_scheduler(parameters)
+
+    if options.transcode_queue:
+        import transcode
+        return run_transcode_queue(
+            transcode.TranscodeQueue(parameters.get('transcode_workers')))
+
+    if options.timeshift:
+        returncode = timeshift(parameters)
+    else:
+        returncode = record(parameters)
+    if returncode < 0:
+        #stopped by us, mencoder finishes the file properly
+        return 0
+    return returncode
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,791 @@
+# -*- coding: utf-8 -*-
+
+# Author: Santiago Bruno
+# License: GPL v3
+# Web pages: http://www.santiagobruno.com.ar/programas.html
+#            http://code.google.com/p/mtvcgui/
+
+"""Recording of captures with mencoder, without any GUI dependency so it can
+be used both from the main window and from the headless recorder.
+"""
+
+import errno
+import fcntl
+import json
+import os
+import select
+import signal
+import sys
+import time
+from subprocess import Popen, PIPE, call
+
+import backends
+import diskwatch
+import scheduler
+import utils
+from adaptive import DegradationController
+from procstats import ProcessStats, SAMPLE_INTERVAL, STATS_SUFFIX
+from fanout import Fanout, FileSink, PipeSink, ProcessSink, RingCopier, \
+    RingSink, SegmentSink
+from progress import ProgressParser
+
+#player used to watch what is being recorded, reading it from stdin
+PREVIEW_COMMAND = ['mplayer', '-quiet', '-']
+
+#seconds of each file of the time-shift buffer
+TIMESHIFT_SLOT_SECONDS = 30
+
+
+def make_timeshift_filename(parameters):
+    """Generates the filename for what is kept from the time-shift buffer,
+    from the template in the parameters but with the .ts extension"""
+    root = os.path.splitext(parameters.get('outputfile'))[0]
+    return utils.make_filename(root + '.ts', parameters.get('channel_text'),
+                               append_suffix=True)
+
+
+class Recording(object):
+    """A capture made by mencoder with the given parameters, as returned by
+    MainWindow.get_params_from_gui or utils.load_parameters.
+
+    If adaptive_quality is set in the parameters and the encoder falls
+    behind, mencoder is stopped to continue with faster settings in a new
+    segment, see next_segment.
+    """
+
+    def __init__(self, parameters, controller=None):
+        if parameters.get('two_stage_capture') and \
+            not parameters.get('timeshift') and \
+            'final_parameters' not in parameters:
+            import transcode
+            parameters = transcode.get_intermediate_parameters(parameters)
+        self.parameters = parameters
+        if controller is None and parameters.get('adaptive_quality'):
+            controller = DegradationController(parameters)
+        self.controller = controller
+        #parameters of the segment that must follow this one
+        self.next_parameters = None
+        self.segment = 1
+        self.base_filename = None
+        #when the recording must end, in all the segments
+        self.end_time = None
+        self.filename = None
+        #the mencoder command, once start has generated it
+        self.command = None
+        self.process = None
+        self.pid = 0
+        self.fanout = None
+        #the sink of segmented recordings
+        self.segment_sink = None
+        self.preview_process = None
+        self.progress = ProgressParser()
+        self.metrics = self.progress.metrics
+        self.returncode = None
+        self.start_time = None
+        self.stop_time = None
+        self.preview = False
+        #when the pre capture command was run, when the first frame was
+        #captured (estimated from the first progress reported) and the
+        #seconds between both
+        self.launch_time = None
+        self.capture_start = None
+        self.startup_latency = None
+        #the time-shift buffer, when it is a time-shift capture
+        self.ring = None
+        #the CPUs it runs on and the threads of its encoder, when a
+        #RecordingManager chooses them
+        self.cpus = None
+        self.threads = None
+        #the files of the renditions encoded from the capture, besides
+        #filename
+        self.rendition_files = []
+        #CPU, memory and disk used by its processes, see sample_stats
+        self.stats = ProcessStats()
+        #(step, reason) when it was stopped to continue with faster settings
+        self.degraded = None
+        #watches the free space while recording, and the directory where
+        #the next segment goes when the disk is almost full
+        self.disk_watch = diskwatch.DiskWatch(parameters)
+        self.next_directory = None
+        #the output root it was placed in and the key of its placement
+        #there, see outputpool.py
+        self.root = None
+        self.placement = None
+        #where the scheduled start is in the file, see write_start_marker
+        self.start_offset = None
+
+    def make_filename(self):
+        """Generates the output filename from the template in the parameters,
+        in the least loaded of the output_roots if there are any"""
+        if self.parameters.get('output_roots') and not self.is_timeshift():
+            import outputpool
+            if not self.placement:
+                self.placement = outputpool.new_key()
+            self.root = outputpool.place(self.parameters,
+                                         diskwatch.estimate_rate(self),
+                                         self.placement)
+        self.filename = utils.make_filename(
+            self.parameters.get('outputfile'),
+            self.parameters.get('channel_text'),
+            append_suffix=self.parameters.get('append_suffix'),
+            root=self.root)
+        if self.streams_preview():
+            self.filename = os.path.splitext(self.filename)[0] + '.ts'
+        return self.filename
+
+    def get_env(self):
+        env = os.environ.copy()
+        if self.parameters.get('setenvvars'):
+            for key, val in self.parameters.get('envvars').items():
+                env[key] = val
+        return env
+
+    def run_pre_command(self):
+        """Runs the command to be run before capturing, if any.
+        Raises OSError if it can't be run."""
+        self.launch_time = time.time()
+        pre_command = self.parameters.get('pre_command')
+        if pre_command:
+            utils.run_user_command(pre_command)
+
+    def run_post_command(self):
+        """Runs the command to be run after capturing, if any.
+        Raises OSError if it can't be run."""
+        post_command = self.parameters.get('post_command')
+        if post_command:
+            utils.run_user_command(post_command)
+
+    def is_timeshift(self):
+        return bool(self.parameters.get('timeshift'))
+
+    def make_ring(self):
+        """Creates the time-shift buffer, with room for timeshift_minutes
+        and a couple of slots more for the ones being written and copied"""
+        directory = self.parameters.get('timeshift_dir') or \
+            os.path.join(utils.get_config_dir(), 'timeshift')
+        directory = os.path.join(directory, os.path.basename(
+            self.parameters.get('device') or 'video'))
+        minutes = self.parameters.get('timeshift_minutes') or 1
+        slots = -(-minutes * 60 / TIMESHIFT_SLOT_SECONDS) + 2
+        #bytes of a slot at the expected bitrate, with some margin
+        size = int(utils.estimate_bitrate(self.parameters) * 1.5 * 1000 / 8 *
+                   TIMESHIFT_SLOT_SECONDS)
+        self.filename = directory
+        self.ring = RingSink(directory, slots, TIMESHIFT_SLOT_SECONDS, size)
+        return self.ring
+
+    def keep(self, filename, minutes=None):
+        """Starts copying to filename what the time-shift capture recorded
+        in the last minutes (timeshift_minutes by default) and what it
+        records next, until stop() is called on the returned RingCopier"""
+        if minutes is None:
+            minutes = self.parameters.get('timeshift_minutes')
+        copier = RingCopier(self.ring, filename, time.time() - minutes * 60)
+        copier.start()
+        return copier
+
+    def is_segmented(self):
+        return bool(self.parameters.get('segment_seconds') or
+                    self.parameters.get('segment_size_mb'))
+
+    def streams_preview(self):
+        """Returns True if the file is written from the stream sent to the
+        preview player. mencoder can't seek back in it to finish an AVI
+        header, so it is recorded in MPEG-TS (with the .ts extension)."""
+        return bool(self.preview and not self.is_timeshift() and
+                    not self.is_segmented() and
+                    not self.get_rendition_parameters())
+
+    def get_rendition_parameters(self):
+        """Returns the (name, parameters) of the outputs encoded from the
+        capture when there are [rendition NAME] sections: the output file
+        (named None), and the ones of the sections. They aren't used in
+        time-shift, segmented and two-stage captures."""
+        renditions = self.parameters.get('renditions')
+        if not renditions or self.is_timeshift() or self.is_segmented() or \
+            'final_parameters' in self.parameters:
+            return []
+        result = [(None, utils.get_rendition_parameters(self.parameters, {}))]
+        for name, overrides in renditions:
+            result.append((name, utils.get_rendition_parameters(
+                self.parameters, overrides)))
+        return result
+
+    def get_renditions(self):
+        """Returns the (filename, parameters) of the outputs encoded from
+        the capture, see get_rendition_parameters"""
+        result = []
+        root, ext = os.path.splitext(self.filename)
+        for name, parameters in self.get_rendition_parameters():
+            if name is None:
+                filename = self.filename
+            elif parameters.get('outputfile') != \
+                self.parameters.get('outputfile'):
+                filename = utils.make_filename(parameters.get('outputfile'),
+                    self.parameters.get('channel_text'),
+                    append_suffix=self.parameters.get('append_suffix'))
+            else:
+                filename = "%s_%s%s" % (root, name, ext)
+            result.append((filename, parameters))
+        return result
+
+    def start(self, preview=False):
+        """Starts mencoder. Raises OSError if it can't be run.
+        If preview is true, what is recorded is also played with mplayer
+        while it is written. mencoder writes to a pipe and the stream is
+        copied in memory to the file and to the player, in MPEG-TS, see
+        streams_preview.
+        If segment_seconds or segment_size_mb are set the recording is
+        split in MPEG-TS files and filename is their playlist, see
+        fanout.SegmentSink.
+        If timeshift is set it is written to a ring of files in timeshift_dir
+        (filename), to keep part of it with keep.
+        If there are renditions (see get_renditions) mencoder captures
+        without encoding and the stream is copied to an encoder for each
+        one.
+        """
+        self.preview = preview
+        if not self.filename:
+            self.make_filename()
+        output_format = None
+        renditions = self.get_renditions()
+        parameters = self.parameters
+        if self.threads and not parameters.get('encoder_threads'):
+            parameters = dict(parameters, encoder_threads=self.threads)
+        backend = backends.get_backend(parameters)
+        sinks = []
+        try:
+            #the output is created before mencoder is run, if it can't be
+            #created there is no command yet, see start_error
+            if self.is_timeshift():
+                sinks.append(self.make_ring())
+                output_format = 'mpegts'
+            elif self.is_segmented():
+                root = os.path.splitext(self.filename)[0]
+                sink = SegmentSink(root,
+                    seconds=self.parameters.get('segment_seconds'),
+                    size=self.parameters.get('segment_size_mb') * 1024 * 1024,
+                    command=self.parameters.get('segment_command'))
+                self.filename = sink.manifest
+                self.segment_sink = sink
+                sinks.append(sink)
+                output_format = 'mpegts'
+            elif self.streams_preview():
+                if os.path.splitext(self.filename)[1] != '.ts':
+                    self.filename = os.path.splitext(self.filename)[0] + '.ts'
+                sinks.append(FileSink(self.filename))
+                output_format = 'mpegts'
+            if sinks or renditions or preview:
+                self.fanout = Fanout(sinks)
+                outputfile = self.fanout.fifo_path
+            else:
+                outputfile = self.filename
+            self.command = backend.capture_command(parameters,
+                                                   outputfile=outputfile,
+                                                   output_format=output_format,
+                                                   raw=bool(renditions))
+            backends.tune(self.parameters)
+            print "Excecuting %s" % " ".join(self.command)
+            self.rendition_files = []
+            #the encoders of the renditions run at the same time
+            threads = max(1, utils.get_encoder_threads(parameters) /
+                          max(1, len(renditions)))
+            for filename, rendition_parameters in renditions:
+                if not rendition_parameters.get('encoder_threads'):
+                    rendition_parameters = dict(rendition_parameters,
+                                                encoder_threads=threads)
+                command = backend.encode_command(rendition_parameters, ['-'],
+                                                 filename)
+                print "Excecuting %s" % " ".join(command)
+                self.fanout.add_sink(ProcessSink(command, env=self.get_env()))
+                if filename != self.filename:
+                    self.rendition_files.append(filename)
+            self.process = Popen(self.command, stdout=PIPE, env=self.get_env())
+        except OSError:
+            if self.fanout:
+                self.finish_fanout()
+            else:
+                #the fanout closes them when there is one
+                for sink in sinks:
+                    try:
+                        sink.close()
+                    except (IOError, OSError):
+                        pass
+            if self.segment_sink:
+                #nothing was recorded
+                self.segment_sink.remove_files()
+                self.segment_sink = None
+            #a ring that was created is kept to be reused
+            self.ring = None
+            self.release_placement()
+            raise
+        self.pid = self.process.pid
+        self.start_time = time.time()
+        self.metrics.start_time = self.start_time
+        if not self.base_filename:
+            self.base_filename = self.filename
+            duration = utils.str_to_secs(self.parameters.get('duration'))
+            if duration:
+                self.end_time = self.start_time + duration
+        flags = fcntl.fcntl(self.process.stdout, fcntl.F_GETFL)
+        fcntl.fcntl(self.process.stdout, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        if preview:
+            try:
+                self.preview_process = Popen(PREVIEW_COMMAND, stdin=PIPE,
+                                             env=self.get_env())
+                self.fanout.add_sink(PipeSink(self.preview_process.stdin.fileno()))
+            except OSError:
+                print "excecution of %s failed" % " ".join(PREVIEW_COMMAND)
+        if self.fanout:
+            self.fanout.start()
+        return self.pid
+
+    def start_error(self, error):
+        """Returns the message for the OSError error raised by start"""
+        if self.command is None:
+            return "can't create %s: %s" % (self.filename, error.strerror or
+                                            error)
+        return "excecution of %s failed" % " ".join(self.command)
+
+    def finish_fanout(self):
+        if self.fanout:
+            self.fanout.finish()
+            self.fanout = None
+        if self.preview_process:
+            #the player gets the end of the stream, let it finish
+            self.preview_process.stdin.close()
+
+    def stop_preview(self):
+        if self.preview_process and self.preview_process.poll() is None:
+            try:
+                os.kill(self.preview_process.pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def output_fileno(self):
+        """Returns the pipe with mencoder output, read_output must be called
+        when it is readable"""
+        return self.process.stdout.fileno()
+
+    def read_output(self):
+        """Reads and parses the available mencoder output without blocking,
+        and copies it to our stdout. Returns False when the output ended."""
+        while True:
+            try:
+                data = os.read(self.output_fileno(), 65536)
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return True
+                raise
+            if not data:
+                return False
+            sys.stdout.write(data)
+            sys.stdout.flush()
+            self.progress.feed(data)
+            if self.capture_start is None and self.metrics.updated:
+                self.capture_started()
+            if self.controller and self.next_parameters is None:
+                self.check_speed()
+
+    def capture_started(self):
+        """Saves how long the capture took to start so scheduled recordings
+        can be launched in advance, and if this one was launched before the
+        time it was scheduled, marks where that time is in the file"""
+        metrics = self.metrics
+        self.capture_start = metrics.updated - metrics.position
+        self.startup_latency = self.capture_start - (self.launch_time or
+                                                     self.start_time)
+        if self.segment == 1:
+            scheduler.record_startup_latency(self.parameters.get('device'),
+                                             self.startup_latency)
+        scheduled_start = self.parameters.get('scheduled_start')
+        if scheduled_start and self.segment == 1:
+            self.write_start_marker(scheduled_start)
+
+    def write_start_marker(self, scheduled_start):
+        """Writes filename.start with the position of the scheduled start in
+        the file, what is before it can be skipped or cut"""
+        offset = scheduled_start - self.capture_start
+        if offset < 0:
+            print "The capture started %.1f seconds late" % -offset
+        self.start_offset = round(max(offset, 0), 2)
+        marker = {'scheduled_start': scheduled_start,
+                  'capture_start': self.capture_start,
+                  'start_offset': self.start_offset}
+        try:
+            marker_file = open(self.filename + '.start', 'w')
+            try:
+                json.dump(marker, marker_file)
+            finally:
+                marker_file.close()
+        except IOError, e:
+            print "Error writing the start marker: %s" % e
+
+    def check_space(self):
+        """Checks before starting that the disk has room for the
+        recording, see diskwatch.check_start. Returns a warning or None."""
+        if not self.filename:
+            self.make_filename()
+        root = self.root
+        warning = diskwatch.check_start(self)
+        if warning:
+            print warning
+        if self.placement and self.root != root:
+            #moved to a spare directory
+            import outputpool
+            outputpool.add_placement(self.placement, self.root,
+                                     diskwatch.estimate_rate(self))
+        return warning
+
+    def release_placement(self):
+        """Stops counting the recording in the load of its output root,
+        when it has finished or won't be started"""
+        if self.placement:
+            import outputpool
+            outputpool.remove_placement(self.placement)
+            self.placement = None
+
+    def check_disk(self, now=None):
+        """Compares the growth of the files with the free space every few
+        seconds. If the disk is almost full it continues in a spare
+        directory when there is one, see next_segment (segmented recordings
+        just write their next segment there). Returns a warning when it is
+        given, or None."""
+        if now is None:
+            now = time.time()
+        if not self.is_running() or self.is_timeshift() or \
+            not self.disk_watch.due(now):
+            return None
+        size = self.output_size()
+        for filename in self.rendition_files:
+            try:
+                size += os.path.getsize(filename)
+            except OSError:
+                pass
+        remaining = self.end_time and self.end_time - now
+        #the disk of the segment being written
+        current = self.segment_sink and self.segment_sink.filename or \
+            self.filename
+        result = self.disk_watch.update(current, size, now, remaining)
+        if not result:
+            return None
+        action, directory, seconds_left = result
+        if action == diskwatch.ROLLOVER and self.segment_sink:
+            if self.segment_sink.next_root:
+                #already moving
+                return None
+            warning = "The disk of %s will be full in %d seconds, " \
+                "continuing in %s" % (current, seconds_left, directory)
+            self.segment_sink.move_to(directory)
+            if self.placement:
+                import outputpool
+                self.root = directory
+                outputpool.add_placement(self.placement, self.root,
+                                         diskwatch.estimate_rate(self))
+        elif action == diskwatch.ROLLOVER and self.next_parameters is None:
+            warning = "The disk of %s will be full in %d seconds, " \
+                "continuing in %s" % (self.filename, seconds_left, directory)
+            self.next_parameters = dict(self.parameters)
+            self.next_directory = directory
+            try:
+                os.kill(self.pid, signal.SIGTERM)
+            except OSError:
+                pass
+        else:
+            warning = "The disk of %s will be full in %d minutes" % (
+                self.filename, seconds_left / 60)
+        print warning
+        return warning
+
+    def check_speed(self):
+        """Stops mencoder to continue with the next step of the controller
+        if the encoder is falling behind"""
+        reason = self.controller.falling_behind(self.metrics)
+        if reason and self.poll() is None:
+            name, self.next_parameters = self.controller.next_step(reason)
+            self.degraded = (name, reason)
+            try:
+                os.kill(self.pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def next_segment(self):
+        """Returns the Recording that continues this one when it has been
+        stopped to change its settings, or None. It writes to the same
+        filename with _partN appended, in another directory if the disk was
+        almost full or in the least loaded of the output_roots, and must be
+        started by the caller (the pre and post commands are run only
+        once)."""
+        if self.next_parameters is None:
+            return None
+        parameters = dict(self.next_parameters)
+        if self.end_time:
+            remaining = int(self.end_time - time.time())
+            if remaining <= 0:
+                return None
+            parameters['duration'] = utils.secs_to_str(remaining)
+        segment = Recording(parameters, self.controller)
+        segment.segment = self.segment + 1
+        segment.base_filename = self.base_filename
+        segment.end_time = self.end_time
+        segment.threads = self.threads
+        if self.placement:
+            import outputpool
+            segment.placement = outputpool.new_key()
+        if self.next_directory:
+            #the disk was almost full
+            segment.root = self.next_directory
+            if segment.placement:
+                outputpool.add_placement(segment.placement, segment.root,
+                                         diskwatch.estimate_rate(segment))
+        elif segment.placement:
+            segment.root = outputpool.place(parameters,
+                                            diskwatch.estimate_rate(segment),
+                                            segment.placement)
+        if segment.root:
+            segment.base_filename = os.path.join(
+                segment.root, os.path.basename(self.base_filename))
+        root, ext = os.path.splitext(segment.base_filename)
+        segment.filename = "%s_part%d%s" % (root, segment.segment, ext)
+        return segment
+
+    def processes(self):
+        """Returns the processes of the recording that are running, as a
+        dict of name: pid"""
+        processes = {}
+        if self.is_running():
+            processes[self.command[0]] = self.pid
+        if self.preview_process and self.preview_process.poll() is None:
+            processes['preview'] = self.preview_process.pid
+        if self.fanout:
+            #the stream is copied by a thread of ours, the rest of our
+            #process (e.g. the GUI and other recordings) isn't counted
+            if self.fanout.tid:
+                processes['fanout'] = (os.getpid(), self.fanout.tid)
+            renditions = [sink for sink in self.fanout.sinks
+                          if isinstance(sink, ProcessSink)]
+            for n, sink in enumerate(renditions):
+                processes['rendition %d' % (n + 1)] = sink.process.pid
+        return processes
+
+    def sample_stats(self, now=None):
+        """Samples the resources used by the processes if it is time to,
+        and saves them to filename.stats every minute. Returns the total
+        usage of the last sample, see procstats.ProcessStats.current."""
+        if self.is_running() and self.stats.due(now):
+            self.stats.sample(self.processes(), now)
+            if self.stats.save_due(now):
+                self.save_stats()
+        return self.stats.current()
+
+    def save_stats(self):
+        if self.filename and self.stats.count:
+            self.stats.save(self.filename + STATS_SUFFIX)
+
+    def output_size(self):
+        """Returns the bytes of the output file, or of its segments"""
+        import transcode
+        try:
+            size = sum(os.path.getsize(f)
+                       for f in transcode.get_input_files(self.filename))
+        except (IOError, OSError):
+            return self.metrics.size_mb * 1000000
+        if self.segment_sink and self.segment_sink.fd is not None:
+            #the one being written isn't in the playlist yet
+            try:
+                size += os.path.getsize(self.segment_sink.filename)
+            except OSError:
+                pass
+        return size
+
+    def telemetry(self):
+        """Returns what is known about the recording, to be saved in its
+        telemetry sidecar"""
+        import calibrate
+        metrics = self.metrics
+        size = self.output_size()
+        summary = self.stats.summary()
+        parameters = self.parameters
+        mean_bitrate = None
+        if metrics.position:
+            #kbit/s
+            mean_bitrate = round(size * 8 / metrics.position / 1000, 1)
+        return {
+            'filename': self.filename,
+            'command': self.command,
+            'channel': parameters.get('channel_text'),
+            'device': parameters.get('device'),
+            'preset': calibrate.preset_name(parameters),
+            'backend': backends.get_backend(parameters).name,
+            'segment': self.segment,
+            'start_time': self.start_time,
+            'stop_time': self.stop_time,
+            'scheduled_start': parameters.get('scheduled_start'),
+            'start_offset': self.start_offset,
+            'startup_latency': self.startup_latency,
+            'position': metrics.position,
+            'frames': metrics.frames,
+            'capture_fps': utils.get_capture_fps(parameters),
+            'average_fps': round(metrics.average_fps(), 2),
+            'min_fps': metrics.min_fps,
+            'skipped_frames': metrics.skipped_frames,
+            'duplicate_frames': metrics.duplicate_frames,
+            'size': size,
+            'mean_bitrate': mean_bitrate,
+            'peak_rss': summary['rss_max'],
+            'cpu_percent_avg': summary['cpu_percent_avg'],
+            'returncode': self.returncode,
+            'degraded_to': self.degraded and self.degraded[0],
+            'degraded_reason': self.degraded and self.degraded[1],
+            'renditions': self.rendition_files,
+        }
+
+    def finished(self):
+        self.stop_time = time.time()
+        self.finish_fanout()
+        self.release_placement()
+        self.save_stats()
+        if self.filename and not self.is_timeshift():
+            import telemetry
+            telemetry.write_sidecar(self.filename, self.telemetry())
+
+    def poll(self):
+        """Returns the exit status of mencoder or None if it is running"""
+        if self.process and self.returncode is None:
+            self.returncode = self.process.poll()
+            if self.returncode is not None:
+                self.finished()
+        return self.returncode
+
+    def wait(self, tick=None):
+        """Waits for mencoder to finish, reading its output meanwhile, and
+        returns its exit status. tick, if given, is called about every
+        second meanwhile."""
+        while self.read_output():
+            self.sample_stats()
+            self.check_disk()
+            if tick:
+                tick()
+            try:
+                select.select([self.output_fileno()], [], [], SAMPLE_INTERVAL)
+            except select.error:
+                #interrupted by a signal
+                pass
+        while self.poll() is None:
+            try:
+                self.returncode = self.process.wait()
+                self.finished()
+            except OSError:
+                #interrupted by a signal
+                pass
+        return self.returncode
+
+    def stop(self):
+        """Asks mencoder to finish, it will close the output file properly"""
+        self.next_parameters = None
+        if self.poll() is None:
+            try:
+                os.kill(self.pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def is_running(self):
+        return self.process is not None and self.poll() is None
+
+    def elapsed(self):
+        """Returns the seconds elapsed since the capture started"""
+        if not self.start_time:
+            return 0
+        return int((self.stop_time or time.time()) - self.start_time)
+
+
+def get_cpus():
+    """Returns the numbers of the CPUs recordings can run on"""
+    return utils.get_allowed_cpus()
+
+
+def split_cpus(cpus, count):
+    """Splits the cpus in count groups as equal as possible. If there are
+    more groups than cpus they are shared."""
+    if count <= len(cpus):
+        size, extra = divmod(len(cpus), count)
+        groups = []
+        start = 0
+        for i in range(count):
+            end = start + size + (i < extra and 1 or 0)
+            groups.append(cpus[start:end])
+            start = end
+        return groups
+    return [[cpus[i % len(cpus)]] for i in range(count)]
+
+
+class RecordingManager(object):
+    """Keeps the recordings made at the same time, e.g. one per capture
+    card, and spreads them across the CPUs so they don't compete for the
+    same ones. The caller starts and supervises each Recording, and tells
+    the manager with add and remove (replace when a recording continues in
+    a new segment).
+    """
+
+    def __init__(self, cpus=None):
+        self.cpus = cpus or get_cpus()
+        self.recordings = []
+        self.taskset = utils.find_executable('taskset')
+
+    def thread_share(self):
+        """Returns the encoder threads of a recording started now: its share
+        of the CPUs available, with the ones running"""
+        running = len([r for r in self.recordings if r.is_running()])
+        available = min(len(self.cpus), utils.get_available_cpus())
+        return max(1, available / (running + 1))
+
+    def add(self, recording):
+        self.recordings.append(recording)
+        self.balance()
+
+    def remove(self, recording):
+        if recording in self.recordings:
+            self.recordings.remove(recording)
+            self.balance()
+
+    def replace(self, recording, segment):
+        self.recordings[self.recordings.index(recording)] = segment
+        self.balance()
+
+    def device_in_use(self, device):
+        """Returns the recording capturing from the device, or None"""
+        for recording in self.recordings:
+            if recording.parameters.get('device') == device:
+                return recording
+        return None
+
+    def filename_in_use(self, filename):
+        return filename in [r.filename for r in self.recordings]
+
+    def balance(self):
+        """Gives each running recording its own share of the CPUs"""
+        running = [r for r in self.recordings if r.is_running()]
+        if not self.taskset or not running:
+            return
+        devnull = open(os.devnull, 'w')
+        for recording, cpus in zip(running, split_cpus(self.cpus,
+                                                       len(running))):
+            recording.cpus = cpus
+            cpu_list = ','.join(str(cpu) for cpu in cpus)
+            #-a for all the threads of mencoder
+            pids = [recording.pid]
+            if recording.preview_process:
+                pids.append(recording.preview_process.pid)
+            for pid in pids:
+                try:
+                    call([self.taskset, '-a', '-p', '-c', cpu_list, str(pid)],
+                         stdout=devnull)
+                except OSError:
+                    print "excecution of %s failed" % self.taskset
+        devnull.close()
+
+    def stop_all(self):
+        for recording in self.recordings:
+            recording.stop_preview()
+            recording.stop()
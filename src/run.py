@@ -25,7 +25,6 @@
 #python imports
 import ConfigParser
 import os
-import re
 import sys
 import time
 from subprocess import Popen, call, PIPE
@@ -40,12 +39,73 @@ from ui.info import Ui_InfoDialog
 from ui.mtvcgui import Ui_MainWindow
 
 #other imports
+import backends
+import calibrate
+import metrics
+import scheduler
+import transcode
 import utils
+from childwatch import get_watcher
+from recorder import Recording, RecordingManager, make_timeshift_filename
 
 config = ConfigParser.ConfigParser()
 
-NORMS_DICT = {}
-INPUTS_DICT = {}
+#seconds to wait for mplayer to report the device norms and inputs
+DEVICE_PROBE_TIMEOUT = 15
+#seconds between checks of the schedule while the headless scheduler makes
+#the recordings, it may take a moment to launch the ones that are due
+SCHEDULE_RECHECK_SECONDS = 5
+
+def get_saved_int(option, name):
+    """Returns the number saved in the configuration for the norm or input
+    (given in option) called name, or None if it was saved with another name
+    """
+    if config.has_option('mencoder GUI', option + '_int') and \
+        config.has_option('mencoder GUI', option) and \
+        config.get('mencoder GUI', option) == name:
+        return config.get('mencoder GUI', option + '_int')
+    return None
+
+class DeviceProbeThread(QtCore.QThread):
+    """Gets the norms and inputs supported by a device without blocking the
+    GUI. The result is emitted with the probed(PyQt_PyObject) signal.
+    """
+    def __init__(self, cmd, device, driver, parent=None):
+        QtCore.QThread.__init__(self, parent)
+        self.cmd = cmd
+        self.device = device
+        self.driver = driver
+
+    def run(self):
+        dev_info = utils.get_device_information(self.cmd,
+                                                timeout=DEVICE_PROBE_TIMEOUT)
+        dev_info['device'] = self.device
+        dev_info['driver'] = self.driver
+        self.emit(QtCore.SIGNAL("probed(PyQt_PyObject)"), dev_info)
+
+
+class CalibrationThread(QtCore.QThread):
+    """Benchmarks the encoder presets without blocking the GUI. Each result
+    is emitted as a line of text with the logged(QString) signal and the
+    chosen preset with calibrated(PyQt_PyObject).
+    """
+    def __init__(self, parameters, parent=None):
+        QtCore.QThread.__init__(self, parent)
+        self.parameters = parameters
+
+    def log(self, line):
+        self.emit(QtCore.SIGNAL("logged(QString)"), line)
+
+    def run(self):
+        #calibrated is always emitted, the GUI waits for it
+        preset, results = None, []
+        try:
+            preset, results = calibrate.calibrate(self.parameters,
+                                                  log=self.log)
+        finally:
+            self.emit(QtCore.SIGNAL("calibrated(PyQt_PyObject)"),
+                      (preset, dict(results).get(preset)))
+
 
 class InfoDialog(QtGui.QDialog, Ui_InfoDialog):
     def __init__(self, parent=None):
@@ -84,37 +144,73 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
         self.translator = None
         self.locale_string = None
         self.mplayer_preview_pid = 0
-        self.mplayer_recording_pid = 0
-        self.mencoder_pid = 0
-        self.tail_pid = 0
-
-        #timer to update state while recording
-        self.time_running = 0
+        #the recording started with the record button, and all the ones
+        #running (with the ones started from the recordings tab)
+        self.recording = None
+        self.recording_manager = RecordingManager()
+        self.output_notifiers = {}
+        #the time-shift capture running in background, and the copy of it
+        #being kept when recording
+        self.timeshift = None
+        self.timeshift_copier = None
+        #re-encodings of finished recordings, see transcode.py
+        self.transcode_queue = transcode.TranscodeQueue(
+            utils.get_advanced_parameters()['transcode_workers'])
+        self.transcode_notifiers = {}
+        self.device_probe_thread = None
+        self.finished_probe_threads = []
+        self.calibration_thread = None
+        self.calibration_dialog = None
+        #norms and inputs of the selected device by number
+        self.norms_dict = {}
+        self.inputs_dict = {}
+        #watches the selected device node to notice when it is replaced
+        self.device_watcher = QtCore.QFileSystemWatcher()
+        QtCore.QObject.connect(self.device_watcher,
+            QtCore.SIGNAL("directoryChanged(QString)"), self.device_dir_changed)
+        self.device_identity = None
+
+        #finished children are notified through the watcher pipe
+        self.child_watcher = get_watcher()
+        self.child_notifier = QtCore.QSocketNotifier(
+            self.child_watcher.fileno(), QtCore.QSocketNotifier.Read)
+        QtCore.QObject.connect(self.child_notifier,
+            QtCore.SIGNAL("activated(int)"), self.children_changed)
+
+        #timer to update the recording time shown while recording
         self.checker_timer = QtCore.QTimer()
         QtCore.QObject.connect(self.checker_timer,
-            QtCore.SIGNAL("timeout()"), self.update_status)
-
-        #timer to check if the time of a sheduled recorded has been reached
-        self.time_waiting = 0
+            QtCore.SIGNAL("timeout()"), self.update_recordings)
+
+        #scheduled recordings, the timer fires when the next one must start
+        self.scheduler = scheduler.Scheduler(
+            utils.get_advanced_parameters()['tuners'])
+        #whether mtvcgui-rec --scheduler was making the recordings at the
+        #last check
+        self.scheduler_running = False
         self.schedule_timer = QtCore.QTimer()
+        self.schedule_timer.setSingleShot(True)
         QtCore.QObject.connect(self.schedule_timer,
             QtCore.SIGNAL("timeout()"), self.check_schedule)
 
-        #timer to check if mencoder has already created the recorded file
-        #and preview it
-        self.preview_file_timer = QtCore.QTimer()
-        QtCore.QObject.connect(self.preview_file_timer,
-            QtCore.SIGNAL("timeout()"), self.check_preview_file)
-
-        #timer to check if mplayer preview is still alive
-        self.mplayer_preview_timer = QtCore.QTimer()
-        QtCore.QObject.connect(self.mplayer_preview_timer,
-            QtCore.SIGNAL("timeout()"), self.check_mplayer_preview)
-
+        #metrics for monitoring, see metrics.py
+        settings = utils.get_advanced_parameters()
+        self.metrics_exporter = metrics.MetricsExporter(
+            lambda: metrics.collect(self.recording_manager.recordings,
+                                    self.scheduler, self.transcode_queue),
+            settings['metrics_port'], settings['metrics_address'],
+            settings['metrics_textfile_dir'])
+        self.metrics_exporter.start()
+        self.metrics_timer = QtCore.QTimer()
+        QtCore.QObject.connect(self.metrics_timer,
+            QtCore.SIGNAL("timeout()"), self.metrics_exporter.update)
+        if self.metrics_exporter.textfile:
+            self.metrics_timer.start(metrics.TEXTFILE_INTERVAL * 1000)
 
         self.error_dialog = QtGui.QErrorMessage(parent)
 
         self.setupUi(self)
+        self.setup_extra_ui()
         
         # I add the icon here because with QT Designer I get a different path
         icon = QtGui.QIcon()
@@ -127,20 +223,13 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
         self.recording_date.setTime(QtCore.QTime(now[3], now[4], 0))
         
         
-        codecs = utils.get_codecs_list('mencoder -oac help')
-        if codecs:
-            self.audiocodec.clear()
-            for codec in codecs:
-                self.audiocodec.addItem(codec)
-                
-        codecs = utils.get_codecs_list('mencoder -ovc help')
-        if codecs:
-            self.videocodec.clear()
-            for codec in codecs:
-                self.videocodec.addItem(codec)     
+        self.update_codecs_lists()
 
         self.set_params_from_config()
         self.update_device_values()
+        self.update_schedule()
+        #jobs left pending when the program was closed
+        self.start_transcodes()
         
         oldconfig = False
         if config.has_option('mencoder GUI', 'audiocodec'):
@@ -172,101 +261,469 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
         
    
 
-    def update_status(self):
-        returncode = self.mencoder_instance.poll()
-        if returncode is None:
-            self.time_running += 1
-            self.status_label.setText(self.tr('Recording... %1').arg(utils.secs_to_str(self.time_running)))
-        else:
-            print "process finished with status code %s" % str(returncode)
-            if returncode > 0:
-                self.error_dialog.showMessage(self.tr("mencoder execution " \
-                    "failed. This program produces output to stdout. Start " \
-                    "the program from the command line and check console " \
-                    "output for possible causes of this failure."))
-            self.record_stop_cleanup()
-
-    def check_preview_file(self):        
-        #check that file exists and has some data
-        if os.path.exists(self.filename) and os.path.getsize(self.filename) > 50000:
-            try:
-                self.tail_instance = Popen(["tail", "-f", "-c", "+0", self.filename], stdout=PIPE)
-                self.mplayer_instance = Popen(["mplayer", "-quiet", "-"], stdin=self.tail_instance.stdout)
-                self.mplayer_recording_pid = self.mplayer_instance.pid
-                self.tail_pid = self.tail_instance.pid
-            except OSError:
-                self.error_dialog.showMessage("excecution of %s failed" % " ".join(cmd))
-            self.preview_file_timer.stop()
+    def setup_extra_ui(self):
+        """Creates the widgets that are not designed with QT Designer"""
+        self.actionRefresh_probes = QtGui.QAction(self)
+        self.menuPrueba.insertAction(self.actionSalir, self.actionRefresh_probes)
+        QtCore.QObject.connect(self.actionRefresh_probes,
+            QtCore.SIGNAL("activated()"), self.refresh_probes)
+        self.actionCalibrate = QtGui.QAction(self)
+        self.menuPrueba.insertAction(self.actionSalir, self.actionCalibrate)
+        QtCore.QObject.connect(self.actionCalibrate,
+            QtCore.SIGNAL("activated()"), self.start_calibration)
+        self.actionTimeshift = QtGui.QAction(self)
+        self.actionTimeshift.setCheckable(True)
+        self.menuPrueba.insertAction(self.actionSalir, self.actionTimeshift)
+        QtCore.QObject.connect(self.actionTimeshift,
+            QtCore.SIGNAL("toggled(bool)"), self.set_timeshift)
+
+        #tab with the recordings running, more can be started on other
+        #devices
+        self.recordings_tab = QtGui.QWidget()
+        layout = QtGui.QVBoxLayout(self.recordings_tab)
+        self.recordings_list = QtGui.QListWidget(self.recordings_tab)
+        layout.addWidget(self.recordings_list)
+        buttons = QtGui.QHBoxLayout()
+        self.job_device_label = QtGui.QLabel(self.recordings_tab)
+        buttons.addWidget(self.job_device_label)
+        self.job_device = QtGui.QLineEdit(self.recordings_tab)
+        self.job_device.setText('/dev/video1')
+        buttons.addWidget(self.job_device)
+        self.job_record_button = QtGui.QPushButton(self.recordings_tab)
+        buttons.addWidget(self.job_record_button)
+        self.job_stop_button = QtGui.QPushButton(self.recordings_tab)
+        buttons.addWidget(self.job_stop_button)
+        layout.addLayout(buttons)
+        self.tabWidget.addTab(self.recordings_tab, "")
+        QtCore.QObject.connect(self.job_record_button,
+            QtCore.SIGNAL("clicked()"), self.record_on_device)
+        QtCore.QObject.connect(self.job_stop_button,
+            QtCore.SIGNAL("clicked()"), self.stop_selected_recording)
+
+        #tab with the scheduled recordings
+        self.schedule_tab = QtGui.QWidget()
+        layout = QtGui.QVBoxLayout(self.schedule_tab)
+        self.schedule_list = QtGui.QListWidget(self.schedule_tab)
+        layout.addWidget(self.schedule_list)
+        buttons = QtGui.QHBoxLayout()
+        self.schedule_repeat_label = QtGui.QLabel(self.schedule_tab)
+        buttons.addWidget(self.schedule_repeat_label)
+        self.schedule_repeat = QtGui.QComboBox(self.schedule_tab)
+        self.schedule_repeat.addItems(["", "", ""])
+        buttons.addWidget(self.schedule_repeat)
+        buttons.addStretch()
+        self.schedule_remove_button = QtGui.QPushButton(self.schedule_tab)
+        buttons.addWidget(self.schedule_remove_button)
+        layout.addLayout(buttons)
+        self.tabWidget.addTab(self.schedule_tab, "")
+        QtCore.QObject.connect(self.schedule_remove_button,
+            QtCore.SIGNAL("clicked()"), self.cancel_shedule)
+
+        #tab with the re-encodings of finished recordings
+        self.transcode_tab = QtGui.QWidget()
+        layout = QtGui.QVBoxLayout(self.transcode_tab)
+        self.transcode_list = QtGui.QListWidget(self.transcode_tab)
+        layout.addWidget(self.transcode_list)
+        buttons = QtGui.QHBoxLayout()
+        buttons.addStretch()
+        self.transcode_remove_button = QtGui.QPushButton(self.transcode_tab)
+        buttons.addWidget(self.transcode_remove_button)
+        layout.addLayout(buttons)
+        self.tabWidget.addTab(self.transcode_tab, "")
+        QtCore.QObject.connect(self.transcode_remove_button,
+            QtCore.SIGNAL("clicked()"), self.remove_transcode)
+        #the estimate shown in the status depends on them
+        for widget, signal in ((self.videocodec, "currentIndexChanged(int)"),
+                               (self.audiocodec, "currentIndexChanged(int)"),
+                               (self.duration, "timeChanged(QTime)"),
+                               (self.tabWidget, "currentChanged(int)")):
+            QtCore.QObject.connect(widget, QtCore.SIGNAL(signal),
+                lambda *args: self.update_estimate())
+        self.retranslate_extra_ui()
+
+    def retranslateUi(self, MainWindow):
+        Ui_MainWindow.retranslateUi(self, MainWindow)
+        if hasattr(self, 'actionRefresh_probes'):
+            self.retranslate_extra_ui()
+
+    def retranslate_extra_ui(self):
+        self.actionRefresh_probes.setText(self.tr("Refresh codecs and device information"))
+        self.actionCalibrate.setText(self.tr("Calibrate encoder presets"))
+        self.actionTimeshift.setText(self.tr("Time-shift: capture in background"))
+        self.tabWidget.setTabText(self.tabWidget.indexOf(self.recordings_tab),
+                                  self.tr("Recordings"))
+        self.job_device_label.setText(self.tr("Device:"))
+        self.job_record_button.setText(self.tr("Record on this device"))
+        self.job_stop_button.setText(self.tr("Stop selected"))
+        self.tabWidget.setTabText(self.tabWidget.indexOf(self.schedule_tab),
+                                  self.tr("Schedule"))
+        self.schedule_repeat_label.setText(self.tr("Repeat scheduled "
+                                                   "recordings:"))
+        self.schedule_repeat.setItemText(0, self.tr("Once"))
+        self.schedule_repeat.setItemText(1, self.tr("Daily"))
+        self.schedule_repeat.setItemText(2, self.tr("Weekly"))
+        self.schedule_remove_button.setText(self.tr("Remove selected"))
+        self.tabWidget.setTabText(self.tabWidget.indexOf(self.transcode_tab),
+                                  self.tr("Transcode"))
+        self.transcode_remove_button.setText(self.tr("Remove selected"))
+
+    def update_codecs_lists(self, refresh=False):
+        codecs = utils.get_codecs_list('mencoder -oac help', refresh=refresh)
+        if codecs:
+            self.audiocodec.clear()
+            for codec in codecs:
+                self.audiocodec.addItem(codec)
+                
+        codecs = utils.get_codecs_list('mencoder -ovc help', refresh=refresh)
+        if codecs:
+            self.videocodec.clear()
+            for codec in codecs:
+                self.videocodec.addItem(codec)     
 
+    def refresh_probes(self):
+        audiocodec = self.audiocodec.currentText()
+        videocodec = self.videocodec.currentText()
+        self.update_codecs_lists(refresh=True)
+        self.audiocodec.setCurrentIndex(self.audiocodec.findText(audiocodec))
+        self.videocodec.setCurrentIndex(self.videocodec.findText(videocodec))
+        self.update_device_values(refresh=True)
+
+    def start_calibration(self):
+        """Looks for the best preset of the video codec that this machine
+        can encode in real time, see calibrate.calibrate"""
+        if self.calibration_thread:
+            return
+        parameters = self.get_params_from_gui()
+        if not calibrate.get_ladder(parameters):
+            self.error_dialog.showMessage(
+                self.tr("There are no presets to calibrate for this video codec"))
+            return
+        self.calibration_dialog = InfoDialog(self)
+        self.calibration_dialog.plainTextEdit.setPlainText(
+            self.tr("Benchmarking the presets, this may take a few minutes"))
+        self.calibration_dialog.show()
+        self.actionCalibrate.setEnabled(False)
+        thread = CalibrationThread(parameters, self)
+        QtCore.QObject.connect(thread, QtCore.SIGNAL("logged(QString)"),
+            self.calibration_dialog.plainTextEdit.appendPlainText)
+        QtCore.QObject.connect(thread,
+            QtCore.SIGNAL("calibrated(PyQt_PyObject)"), self.calibration_done)
+        self.calibration_thread = thread
+        thread.start()
+
+    def calibration_done(self, (preset, result)):
+        self.calibration_thread.wait()
+        self.calibration_thread = None
+        self.actionCalibrate.setEnabled(True)
+        dialog = self.calibration_dialog
+        if preset is None:
+            dialog.plainTextEdit.appendPlainText(
+                self.tr("mencoder failed with every preset"))
+            return
+        name, parm, value = preset
+        tuned = calibrate.save_preset(self.get_params_from_gui(), preset,
+                                      result)
+        getattr(self, parm).setText(tuned[parm])
+        dialog.plainTextEdit.appendPlainText(
+            self.tr("Saved %1").arg(name))
+
+    def children_changed(self, fd):
+        self.child_watcher.handle_events()
+
+    def update_recordings(self):
+        for recording in self.recording_manager.recordings:
+            recording.sample_stats()
+            warning = recording.check_disk()
+            if warning:
+                self.error_dialog.showMessage(warning)
+        if self.recording:
+            self.update_status()
+        self.update_recordings_list()
+
+    def update_recordings_list(self):
+        recordings = self.recording_manager.recordings
+        while self.recordings_list.count() > len(recordings):
+            self.recordings_list.takeItem(self.recordings_list.count() - 1)
+        while self.recordings_list.count() < len(recordings):
+            self.recordings_list.addItem("")
+        for row, recording in enumerate(recordings):
+            cpus = recording.cpus and ",".join(str(c) for c in recording.cpus)
+            usage = recording.stats.current()
+            cpu_percent = usage and "%.0f" % usage.cpu_percent or "-"
+            memory = usage and "%.0f" % (usage.rss / 1e6) or "-"
+            self.recordings_list.item(row).setText(
+                self.tr("%1  %2  %3 fps  %4  (CPUs %5, %6% CPU, %7 MB)").arg(
+                recording.parameters.get('device')).arg(
+                utils.secs_to_str(recording.elapsed())).arg(
+                "%.1f" % recording.metrics.fps).arg(recording.filename).arg(
+                cpus or "-").arg(cpu_percent).arg(memory))
 
-    def check_mplayer_preview(self):
-        if self.mplayer_instance.poll() is not None:
-            self.mplayer_preview_pid = 0
-            self.mplayer_preview_timer.stop()
+    def update_status(self):
+        metrics = self.recording.metrics
+        elapsed = utils.secs_to_str(self.recording.elapsed())
+        if metrics.updated is None:
+            self.status_label.setText(self.tr('Recording... %1').arg(elapsed))
+            return
+        self.status_label.setText(self.tr('Recording... %1 (%2 fps)').arg(
+            elapsed).arg("%.1f" % metrics.fps))
+        speed = metrics.speed is not None and "%.2f" % metrics.speed or "-"
+        text = self.tr("Position: %1 s\n"
+            "Encoding speed: %2 fps (%3x real time)\n"
+            "Skipped frames: %4\nDuplicate frames: %5\nSize: %6 MB").arg(
+            "%.1f" % metrics.position).arg("%.1f" % metrics.fps).arg(speed).arg(
+            metrics.skipped_frames).arg(metrics.duplicate_frames).arg(
+            metrics.size_mb)
+        usage = self.recording.stats.current()
+        if usage:
+            text = self.tr("%1\nCPU: %2%\nMemory: %3 MB\n"
+                           "Written to disk: %4 MB").arg(text).arg(
+                "%.0f" % usage.cpu_percent).arg("%.0f" % (usage.rss / 1e6)).arg(
+                "%.0f" % (usage.write_bytes / 1e6))
+        self.status_label.setToolTip(text)
+
+    def mencoder_output_ready(self, recording):
+        if not recording.read_output():
+            self.output_notifiers[recording].setEnabled(False)
+        if recording is self.recording:
+            self.update_status()
+
+    def mencoder_finished(self, recording, returncode):
+        #the rest of the output is already in the pipe
+        self.output_notifiers.pop(recording).setEnabled(False)
+        recording.read_output()
+        recording.poll()
+        print "process finished with status code %s" % str(returncode)
+        self.queue_transcode(recording)
+        if returncode > 0:
+            self.error_dialog.showMessage(self.tr("mencoder execution " \
+                "failed. This program produces output to stdout. Start " \
+                "the program from the command line and check console " \
+                "output for possible causes of this failure."))
+        #the settings were changed because it was falling behind
+        segment = recording.next_segment()
+        if segment and self.start_recording(segment, recording.preview,
+                                            replaces=recording):
+            if recording is self.recording:
+                self.recording = segment
+            return
+        self.recording_manager.remove(recording)
+        if recording is self.recording:
+            self.record_stop_cleanup()
+        else:
+            self.job_stop_cleanup(recording)
+
+    def queue_transcode(self, recording):
+        """Queues the encoding of the intermediate file of a finished
+        two-stage capture, or the re-encoding of a finished recording if
+        transcode_after_recording is set"""
+        if recording.is_timeshift():
+            return
+        if self.transcode_queue.add_recording(recording.filename,
+                                              recording.parameters):
+            self.start_transcodes()
+
+    def start_transcodes(self):
+        """Starts the queued re-encodings that fit in the CPUs not used by
+        the recordings"""
+        busy = len(self.recording_manager.recordings)
+        for job in self.transcode_queue.start_jobs(busy):
+            notifier = QtCore.QSocketNotifier(job.output_fileno(),
+                                              QtCore.QSocketNotifier.Read)
+            QtCore.QObject.connect(notifier, QtCore.SIGNAL("activated(int)"),
+                lambda fd, job=job: self.transcode_output_ready(job))
+            self.transcode_notifiers[job] = notifier
+            self.child_watcher.watch(job.process,
+                lambda returncode, job=job: self.transcode_finished(job))
+        self.update_transcode_list()
+
+    def transcode_output_ready(self, job):
+        percent = int(job.percent)
+        if not job.read_output():
+            self.transcode_notifiers[job].setEnabled(False)
+        if int(job.percent) != percent:
+            self.transcode_queue.update()
+            self.update_transcode_list()
+
+    def transcode_finished(self, job):
+        self.transcode_notifiers.pop(job).setEnabled(False)
+        job.read_output()
+        self.transcode_queue.job_finished(job)
+        self.start_transcodes()
+
+    def update_transcode_list(self):
+        self.transcode_list.clear()
+        for job in self.transcode_queue.jobs:
+            self.transcode_list.addItem(job.description())
+
+    def remove_transcode(self):
+        """Removes the selected re-encoding from the queue, stopping it if
+        it is running"""
+        jobs = self.transcode_queue.jobs
+        row = self.transcode_list.currentRow()
+        if 0 <= row < len(jobs):
+            self.transcode_queue.remove(jobs[row].id)
+        self.update_transcode_list()
+
+    def mplayer_preview_finished(self, returncode):
+        self.mplayer_preview_pid = 0
 
 
     def check_schedule(self):
-        current_time = QtCore.QDateTime.currentDateTime()
-        recording_time = self.recording_date.dateTime()
-        seconds_remaining = current_time.secsTo(recording_time)
-        if seconds_remaining <= 0:
-            self.append_suffix.setChecked(True)
+        self.scheduler_running = bool(scheduler.get_scheduler_pid())
+        if self.scheduler_running:
+            #mtvcgui-rec --scheduler is running, it makes the recordings
+            self.scheduler.load()
+        else:
+            for job in self.scheduler.pop_due():
+                self.start_scheduled(job)
+        self.update_schedule()
+
+    def start_scheduled(self, job):
+        parameters = scheduler.job_parameters(job)
+        if self.recording_manager.device_in_use(parameters.get('device')):
+            self.error_dialog.showMessage(self.tr("%1 can't be recorded, "
+                "%2 is already being recorded").arg(job.description()).arg(
+                parameters.get('device')))
+            return
+        recording = Recording(parameters)
+        recording.make_filename()
+        warning = recording.check_space()
+        if warning:
+            self.error_dialog.showMessage(warning)
+        try:
+            recording.run_pre_command()
+        except OSError:
+            self.error_dialog.showMessage("excecution of %s failed" %
+                                          (parameters.get('pre_command'),))
+        if self.start_recording(recording, False) and not self.recording:
+            self.recording = recording
             self.stopButton.setEnabled(True)
             self.runButton.setEnabled(False)
-            self.run_mencoder(accepted=True)
+            self.update_status()
+
+    def update_schedule(self):
+        """Shows the scheduled recordings and sets the timer to the start
+        of the next one"""
+        jobs = self.scheduler.jobs()
+        self.schedule_list.clear()
+        for job in jobs:
+            self.schedule_list.addItem(job.description())
+        self.cancel_sheduleButton.setEnabled(bool(jobs))
+        if not self.recording:
+            if jobs:
+                self.status_label.setText(self.tr('Next recording: %1').arg(
+                    jobs[0].description()))
+            else:
+                self.status_label.setText(self.tr('Stopped'))
+            self.update_estimate()
+
+        deadline = self.scheduler.next_deadline()
+        if deadline is None:
+            self.schedule_timer.stop()
         else:
-            self.status_label.setText(self.tr('Waiting %1').arg(utils.secs_to_str(seconds_remaining)))
+            #it is checked again at least once a day, QTimer can't wait for
+            #more than 24 days
+            wait = max(deadline - time.time(), 0)
+            if self.scheduler_running:
+                #the other process launches the recordings that are due
+                wait = max(wait, SCHEDULE_RECHECK_SECONDS)
+            msecs = min(wait * 1000, 24 * 3600 * 1000)
+            self.schedule_timer.start(int(msecs))
+
+    def update_estimate(self):
+        """Shows the disk bandwidth and space the recording with the
+        current settings will need"""
+        if self.recording:
+            return
+        parameters = self.get_params_from_gui()
+        two_stage = parameters.get('two_stage_capture')
+        if two_stage:
+            parameters = transcode.get_intermediate_parameters(parameters)
+        rate, total, free = utils.estimate_disk_usage(parameters)
+        text = self.tr("Writes about %1 MB/s").arg("%.1f" % (rate / 1e6))
+        if two_stage:
+            text = self.tr("Two-stage capture to %1\n%2").arg(
+                os.path.dirname(parameters.get('outputfile')) or ".").arg(
+                text)
+        if total:
+            text = self.tr("%1\nNeeds %2 GB").arg(text).arg(
+                "%.1f" % (total / 1e9))
+        if free is not None:
+            text = self.tr("%1\n%2 GB free").arg(text).arg(
+                "%.1f" % (free / 1e9))
+            if total and total > free:
+                self.status_label.setText(self.tr("Not enough disk space"))
+        self.status_label.setToolTip(text)
 
     def record_stop_cleanup(self):
         self.status_label.setText(self.tr('Stopped'))
-        self.checker_timer.stop()
-        self.time_running = 0
-        if self.mplayer_recording_pid:
-            if self.tail_pid:
-                call(['kill', str(self.tail_pid)])
-                self.tail_pid = 0
-            call(['kill', str(self.mplayer_recording_pid)])
-            self.mplayer_recording_pid = 0
-            
-        post_command = str(self.post_command.text())
-        if post_command:
-            cmds = [c for c in re.split("\s+", post_command) if c]
-            try:
-                call(cmds)
-            except OSError:
-                self.error_dialog.showMessage("excecution of %s failed" % post_command)
+        self.job_stop_cleanup(self.recording)
+        self.recording = None
         self.stopButton.setEnabled(False)
         self.runButton.setEnabled(True)
-        self.cancel_sheduleButton.setEnabled(False)
-        self.scheduleButton.setEnabled(True)
+        self.update_schedule()
+
+    def job_stop_cleanup(self, recording):
+        if recording is self.timeshift:
+            self.timeshift = None
+            self.timeshift_stop()
+            self.actionTimeshift.setChecked(False)
+        recording.stop_preview()
+        try:
+            recording.run_post_command()
+        except OSError:
+            self.error_dialog.showMessage("excecution of %s failed" %
+                recording.parameters.get('post_command'))
+        if not self.recording_manager.recordings:
+            self.checker_timer.stop()
+        self.update_recordings_list()
 
     def exit_cleanup(self):
-        if self.mplayer_recording_pid:
-            print "killing mplayer rec"
-            call(['kill', str(self.mplayer_recording_pid)])
-            if self.tail_pid:
-                call(['kill', str(self.tail_pid)])
+        #probes are killed on timeout, a running QThread can't be destroyed
+        for thread in [self.device_probe_thread, self.calibration_thread] + \
+            self.finished_probe_threads:
+            if thread:
+                thread.wait()
         if self.mplayer_preview_pid:
             print "killing mplayer prev"
             call(['kill', str(self.mplayer_preview_pid)])
-        if self.mencoder_pid:
-            call(['kill', str(self.mencoder_pid)])
+        if self.recording_manager.recordings:
+            print "killing mplayer rec"
+            self.recording_manager.stop_all()
+        #they are started again the next time
+        self.transcode_queue.stop()
+        self.metrics_timer.stop()
+        self.metrics_exporter.stop()
 
 
     def shedule_recording(self):
-        self.stopButton.setEnabled(False)
-        self.runButton.setEnabled(False)
-        self.cancel_sheduleButton.setEnabled(True)
-        self.scheduleButton.setEnabled(False)
-        self.schedule_timer.start(1000)
+        """Schedules a recording with the current parameters at the time
+        selected, repeated as selected in the schedule tab"""
+        parameters = self.get_params_from_gui()
+        start = self.recording_date.dateTime().toTime_t()
+        duration = utils.str_to_secs(parameters.get('duration')) or 0
+        recurrence = [None, 'daily', 'weekly'][
+            self.schedule_repeat.currentIndex()]
+        job = scheduler.ScheduledJob(start, duration, parameters, recurrence)
+        conflicts = self.scheduler.add(job)
+        if conflicts:
+            self.error_dialog.showMessage(self.tr("%1 overlaps with more "
+                "recordings than tuners available (%2) or with another "
+                "recording from the same device: %3").arg(
+                job.description()).arg(self.scheduler.tuners).arg(
+                ", ".join(j.description() for j in conflicts[0][1])))
+        self.update_schedule()
 
     def cancel_shedule(self):
-        self.status_label.setText(self.tr('Stopped'))
-        self.schedule_timer.stop()
-        self.cancel_sheduleButton.setEnabled(False)
-        self.scheduleButton.setEnabled(True)
-        self.stopButton.setEnabled(False)
-        self.runButton.setEnabled(True)
+        """Removes the scheduled recording selected in the schedule tab, or
+        the next one"""
+        jobs = self.scheduler.jobs()
+        row = self.schedule_list.currentRow()
+        if 0 <= row < len(jobs):
+            self.scheduler.remove(jobs[row].id)
+        elif jobs:
+            self.scheduler.remove(jobs[0].id)
+        self.update_schedule()
 
     def show_about_dialog(self):
         dialog = AboutDialog(self)
@@ -583,14 +1040,18 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
                     norm_int = -1
                     norm_name = config.get('mencoder GUI', 'norm')
                     if norm_name:
-                        for i in NORMS_DICT:
-                            if NORMS_DICT[i] == norm_name:
+                        for i in self.norms_dict:
+                            if self.norms_dict[i] == norm_name:
                                 norm_int = i
                                 break
                 if norm_int > -1 and not norm_name:
                     norm_name = str(norm_int)
                     self.norm.addItem(norm_name)
                 index = self.norm.findText(norm_name)
+                if index == -1 and norm_name and not self.norm.count():
+                    #not probed yet, show the saved value meanwhile
+                    self.norm.addItem(norm_name)
+                    index = self.norm.findText(norm_name)
                 self.norm.setCurrentIndex(index)
                 self.setFocus()
         except:
@@ -606,14 +1067,18 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
                     input_int = -1
                     input_name = config.get('mencoder GUI', 'input')
                     if input_name:
-                        for i in INPUTS_DICT:
-                            if INPUTS_DICT[i] == input_name:
+                        for i in self.inputs_dict:
+                            if self.inputs_dict[i] == input_name:
                                 input_int = i
                                 break
                 if input_int > -1 and not input_name:
                     input_name = str(input_int)
                     self.input.addItem(input_name)
                 index = self.input.findText(input_name)
+                if index == -1 and input_name and not self.input.count():
+                    #not probed yet, show the saved value meanwhile
+                    self.input.addItem(input_name)
+                    index = self.input.findText(input_name)
                 self.input.setCurrentIndex(index)
                 self.setFocus()
         except:
@@ -658,10 +1123,13 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
         parameters['norm'] = str(norm)
         
         norm_int = parameters['norm']
-        for key, val in NORMS_DICT.items():
+        for key, val in self.norms_dict.items():
             if val == parameters['norm']:
                 norm_int = str(key)
                 break
+        else:
+            #not probed yet, use the value saved with the same name
+            norm_int = get_saved_int('norm', parameters['norm']) or norm_int
         parameters['norm_int'] = norm_int
         
         
@@ -669,10 +1137,13 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
         parameters['input'] = str(input)
         
         input_int = parameters['input']
-        for key, val in INPUTS_DICT.items():
+        for key, val in self.inputs_dict.items():
             if val == parameters['input']:
                 input_int = str(key)
                 break
+        else:
+            #not probed yet, use the value saved with the same name
+            input_int = get_saved_int('input', parameters['input']) or input_int
         parameters['input_int'] = input_int
 
         if config:
@@ -757,14 +1228,8 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
         if config:
             parameters['envvars'] = str(self.envvars.toPlainText())
         else:
-            envvars = {}
-            for lines in str(self.envvars.toPlainText()).split('\n'):
-                keyval = lines.split('=', 1)
-                if len(keyval) == 2:
-                    key = keyval[0].strip()
-                    val = keyval[1].strip()
-                    envvars[key] = val
-            parameters['envvars'] = envvars
+            parameters['envvars'] = \
+                utils.parse_envvars(str(self.envvars.toPlainText()))
         
         if parameters['channel_type'] == 'number':
             parameters['channel_text'] = str(self.channel.value())
@@ -772,6 +1237,10 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
             parameters['channel_text'] = \
                 str(self.frequency.value()).replace(",",".")
 
+        if not config:
+            #the ones that are only set in the .ini file
+            parameters.update(utils.get_advanced_parameters())
+
         return parameters
 
 
@@ -779,7 +1248,8 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
     def preview_with_mplayer(self):
         if not self.mplayer_preview_pid:
             parameters = self.get_params_from_gui()
-            cmd = utils.generate_mplayer_command(parameters)
+            backends.tune(parameters)
+            cmd = backends.get_backend(parameters).preview_command(parameters)
             print "Excecuting %s" % " ".join(cmd)
             env = os.environ.copy()
             if parameters.get('setenvvars'):
@@ -788,7 +1258,8 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
             try:
                 self.mplayer_instance = Popen(cmd, stdin=PIPE, env=env)
                 self.mplayer_preview_pid = self.mplayer_instance.pid
-                self.mplayer_preview_timer.start(1000)
+                self.child_watcher.watch(self.mplayer_instance,
+                                         self.mplayer_preview_finished)
             except OSError:
                 self.error_dialog.showMessage("excecution of %s failed" %
                                               (" ".join(cmd),))
@@ -800,59 +1271,114 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
             call(['kill', str(self.mplayer_preview_pid)])
             self.mplayer_preview_pid = 0
 
+        if self.recording or self.timeshift_copier:
+            return
+
         parameters = self.get_params_from_gui()
+        if self.timeshift and self.timeshift.parameters.get('device') == \
+            parameters.get('device'):
+            self.timeshift_keep()
+            return
+        if self.recording_manager.device_in_use(parameters.get('device')):
+            self.error_dialog.showMessage(self.tr("%1 is already being "
+                "recorded").arg(parameters.get('device')))
+            return
 
-        self.schedule_timer.stop()
-        channel_text = parameters.get('channel_text')
-        append_suffix = self.append_suffix.isChecked()
         play_while_recording = self.play_while_recording.isChecked()
-        filename = utils.make_filename(str(self.outputfile.text()),
-                                       channel_text,
-                                       append_suffix=append_suffix)
+        #the file of a two-stage capture is the intermediate one
+        recording = Recording(parameters)
+        #a previewed recording is saved in MPEG-TS
+        recording.preview = play_while_recording
+        recording.make_filename()
+        #it may go to a spare directory if the disk hasn't enough space
+        warning = recording.check_space()
+        if warning:
+            self.error_dialog.showMessage(warning)
+        filename = recording.filename
 
         self.filename = filename
 
         if not accepted and os.path.exists(filename):
+            #it's placed again if the user accepts
+            recording.release_placement()
             dialog = FileExistsDialog(self)
             dialog.show()
         else:
             self.stopButton.setEnabled(True)
             self.runButton.setEnabled(False)
 
-            pre_command = str(self.pre_command.text())
-            if pre_command:
-                cmds = [c for c in re.split("\s+", pre_command) if c]
-                try:
-                    call(cmds)
-                except OSError:
-                    self.error_dialog.showMessage("excecution of %s failed" %
-                                                  (pre_command,))
-
-            cmd = utils.generate_command(parameters)
-            env = os.environ.copy()
-            if parameters.get('setenvvars'):
-                for key, val in parameters.get('envvars').items():
-                    env[key] = val
             try:
-                self.mencoder_instance = Popen(cmd, env=env)
-                self.mencoder_pid = self.mencoder_instance.pid
+                recording.run_pre_command()
             except OSError:
-                self.error_dialog.showMessage("excecution of %s failed" % " ".join(cmd))
-
-            if self.mencoder_pid:
-                self.status_label.setText(self.tr('Recording... %1').arg(
-                    utils.secs_to_str(self.time_running)
-                    ))
-                self.checker_timer.start(1000)
-                self.scheduleButton.setEnabled(False)
-                self.cancel_sheduleButton.setEnabled(False)
-                if play_while_recording:
-                    self.preview_file_timer.start(2000)
+                self.error_dialog.showMessage("excecution of %s failed" %
+                                              (parameters.get('pre_command'),))
+
+            if self.start_recording(recording, play_while_recording):
+                self.recording = recording
+                self.update_status()
             else:
                 self.stopButton.setEnabled(False)
                 self.runButton.setEnabled(True)
 
 
+    def start_recording(self, recording, preview, replaces=None):
+        """Starts mencoder for the recording and watches its output and its
+        end. replaces is the recording it continues, if it is a new
+        segment. Returns False if it couldn't be started."""
+        if not replaces:
+            recording.threads = self.recording_manager.thread_share()
+        try:
+            recording.start(preview=preview)
+        except OSError, e:
+            self.error_dialog.showMessage(recording.start_error(e))
+        if not recording.pid:
+            return False
+        notifier = QtCore.QSocketNotifier(recording.output_fileno(),
+                                          QtCore.QSocketNotifier.Read)
+        QtCore.QObject.connect(notifier, QtCore.SIGNAL("activated(int)"),
+            lambda fd: self.mencoder_output_ready(recording))
+        self.output_notifiers[recording] = notifier
+        self.child_watcher.watch(recording.process,
+            lambda returncode: self.mencoder_finished(recording, returncode))
+        if replaces:
+            self.recording_manager.replace(replaces, recording)
+        else:
+            self.recording_manager.add(recording)
+        if not self.checker_timer.isActive():
+            self.checker_timer.start(1000)
+        self.update_recordings_list()
+        return True
+
+    def record_on_device(self):
+        """Starts another recording with the current parameters on the
+        device of the recordings tab"""
+        device = str(self.job_device.text())
+        if self.recording_manager.device_in_use(device):
+            self.error_dialog.showMessage(self.tr("%1 is already being "
+                "recorded").arg(device))
+            return
+        parameters = self.get_params_from_gui()
+        parameters['device'] = device
+        recording = Recording(parameters)
+        filename = recording.make_filename()
+        if self.recording_manager.filename_in_use(filename) or \
+            os.path.exists(filename):
+            root, ext = os.path.splitext(filename)
+            recording.filename = "%s_%s%s" % (root, os.path.basename(device),
+                                              ext)
+        try:
+            recording.run_pre_command()
+        except OSError:
+            self.error_dialog.showMessage("excecution of %s failed" %
+                                          (parameters.get('pre_command'),))
+        self.start_recording(recording, False)
+
+    def stop_selected_recording(self):
+        row = self.recordings_list.currentRow()
+        if 0 <= row < len(self.recording_manager.recordings):
+            #the cleanup is done when mencoder finishes
+            self.recording_manager.recordings[row].stop()
+
     def show_available_audio_codecs(self):
         dialog = InfoDialog(self)
         text = "If for some reason the dropdown list with the supported codecs is not correct\n" \
@@ -872,10 +1398,52 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
         dialog.show()
 
     def stop_button_pressed(self):
-        if self.mencoder_pid:
-            call(['kill', str(self.mencoder_pid)])
-            self.mencoder_pid = 0
-        self.record_stop_cleanup()
+        if self.timeshift_copier:
+            self.timeshift_stop()
+        elif self.recording:
+            #the cleanup is done when mencoder finishes
+            self.recording.stop()
+
+    def set_timeshift(self, enabled):
+        """Starts or stops the time-shift capture of the current channel,
+        which keeps the last minutes so recording can start from them"""
+        if enabled and not self.timeshift:
+            parameters = self.get_params_from_gui()
+            if self.recording_manager.device_in_use(parameters.get('device')):
+                self.error_dialog.showMessage(self.tr("%1 is already being "
+                    "recorded").arg(parameters.get('device')))
+                self.actionTimeshift.setChecked(False)
+                return
+            parameters['timeshift'] = True
+            parameters['duration'] = ''
+            recording = Recording(parameters)
+            if self.start_recording(recording, False):
+                self.timeshift = recording
+            else:
+                self.actionTimeshift.setChecked(False)
+        elif not enabled and self.timeshift:
+            #the cleanup is done when mencoder finishes
+            self.timeshift.stop()
+
+    def timeshift_keep(self):
+        """Records from the time-shift buffer, starting timeshift_minutes
+        ago"""
+        filename = make_timeshift_filename(self.timeshift.parameters)
+        self.timeshift_copier = self.timeshift.keep(filename)
+        self.status_label.setText(self.tr("Recording from %1 minutes ago "
+            "to %2").arg(self.timeshift.parameters.get(
+            'timeshift_minutes')).arg(filename))
+        self.stopButton.setEnabled(True)
+        self.runButton.setEnabled(False)
+
+    def timeshift_stop(self):
+        if self.timeshift_copier:
+            #it finishes copying in background
+            self.timeshift_copier.stop()
+            self.timeshift_copier = None
+            self.stopButton.setEnabled(False)
+            self.runButton.setEnabled(True)
+            self.update_schedule()
 
     def channel_changed(self, channel):
         if self.mplayer_preview_pid:
@@ -927,7 +1495,7 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
 
     def norm_changed(self, norm):
         if self.mplayer_preview_pid:
-            norm = NORMS_DICT.get(norm, 'NTSC')
+            norm = self.norms_dict.get(norm, 'NTSC')
             try:
                 self.mplayer_instance.stdin.write('tv_set_norm %s\n' %
                                                   (str(norm),))
@@ -935,36 +1503,106 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
                 self.error_dialog.showMessage("communication with mplayer failed")
                 
                 
-    def update_device_values(self):
-        global config, NORMS_DICT, INPUTS_DICT
+    def update_device_values(self, refresh=False):
+        """Updates the norms and inputs lists with the ones supported by the
+        selected device. They are taken from the cache if possible, if not
+        (or if refresh is true) the device is probed in background and the
+        current values are kept until the results arrive in
+        device_values_probed.
+        """
         parameters = self.get_params_from_gui()
+        device = parameters['device']
+        driver = parameters['driver']
+        self.watch_device(device)
+
+        if self.device_probe_thread:
+            #a newer probe replaces its result, but the thread must be
+            #referenced until it finishes
+            QtCore.QObject.disconnect(self.device_probe_thread,
+                QtCore.SIGNAL("probed(PyQt_PyObject)"),
+                self.device_values_probed)
+            self.finished_probe_threads.append(self.device_probe_thread)
+            self.device_probe_thread = None
+
+        if not refresh:
+            dev_info = utils.get_cached_device_information(device, driver)
+            if dev_info:
+                self.show_device_values(dev_info)
+                return
+
         preview_command = \
             utils.generate_mplayer_command(parameters,
                                            extra_params=['-vo', 'null',
                                                          '-ao', 'null',
                                                          '-frames', '0'],
                                            as_string=True)
-        dev_info = utils.get_device_information(preview_command)
+        thread = DeviceProbeThread(preview_command, device, driver, self)
+        QtCore.QObject.connect(thread,
+            QtCore.SIGNAL("probed(PyQt_PyObject)"), self.device_values_probed)
+        QtCore.QObject.connect(thread, QtCore.SIGNAL("finished()"),
+            self.forget_finished_probe_threads)
+        self.device_probe_thread = thread
+        thread.start()
+
+    def watch_device(self, device):
+        directories = self.device_watcher.directories()
+        if directories:
+            self.device_watcher.removePaths(directories)
+        self.device_identity = utils.get_device_identity(device)
+        if os.path.isdir(os.path.dirname(device)):
+            self.device_watcher.addPath(os.path.dirname(device))
+
+    def device_dir_changed(self, directory):
+        device = str(self.device.text())
+        if utils.get_device_identity(device) != self.device_identity:
+            #the device node was removed or replaced (e.g. hotplug)
+            self.update_device_values()
+
+    def forget_finished_probe_threads(self):
+        self.finished_probe_threads = [t for t in self.finished_probe_threads
+                                       if not t.isFinished()]
+
+    def device_values_probed(self, dev_info):
+        self.device_probe_thread = None
+        if dev_info.get('timed_out') and \
+            not (dev_info['norms'] or dev_info['inputs']):
+            #keep the saved values instead of leaving the lists empty
+            return
+        utils.cache_device_information(dev_info['device'], dev_info['driver'],
+                                       dev_info)
+        self.show_device_values(dev_info)
+
+    def show_device_values(self, dev_info):
         norms = dev_info['norms']
         inputs = dev_info['inputs']
-        
+
+        current_norm = self.norm.currentText()
         self.norm.clear()
+        self.norms_dict = {}
         
         if norms:
            for norm_id, norm_value in norms:
                 self.norm.addItem(norm_value)
-                NORMS_DICT[int(norm_id)] = norm_value
+                self.norms_dict[int(norm_id)] = norm_value
                 
         self.update_norm_index_from_config()
+        index = self.norm.findText(current_norm)
+        if index > -1:
+            self.norm.setCurrentIndex(index)
         
+        current_input = self.input.currentText()
         self.input.clear()
+        self.inputs_dict = {}
         
         if inputs:
            for input_id, input_value in inputs:
                 self.input.addItem(input_value)
-                INPUTS_DICT[int(input_id)] = input_value
+                self.inputs_dict[int(input_id)] = input_value
                 
         self.update_input_index_from_config()
+        index = self.input.findText(current_input)
+        if index > -1:
+            self.input.setCurrentIndex(index)
 
     def preview_command(self):
         appTranslator = QtCore.QTranslator()
@@ -972,8 +1610,8 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
         app.installTranslator(appTranslator)
         self.retranslateUi(self)
         parameters = self.get_params_from_gui()
-        self.previewcommand.setText(utils.generate_command(parameters,
-                                                           preview=True))
+        self.previewcommand.setText(" ".join(
+            backends.get_backend(parameters).capture_command(parameters)))
 
     def save_configuration(self, config_filename=None):
         parameters = self.get_params_from_gui(config=True)
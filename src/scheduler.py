@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+
+# Author: Santiago Bruno
+# License: GPL v3
+# Web pages: http://www.santiagobruno.com.ar/programas.html
+#            http://code.google.com/p/mtvcgui/
+
+"""Scheduled recordings. They are kept in a heap ordered by the time they
+must be launched (a lead before their start) and saved in ~/.mtvcgui/schedule.json, so they survive restarts and can be
+shared by the GUI and the headless scheduler (mtvcgui-rec --scheduler).
+"""
+
+import heapq
+import os
+import signal
+import time
+
+import utils
+
+SCHEDULE_FILENAME = 'schedule.json'
+SCHEDULER_PID_FILENAME = 'scheduler.pid'
+#seconds mencoder took to start capturing in the last recordings, by device
+STARTUP_CACHE_FILENAME = 'startup.cache'
+STARTUP_SAMPLES = 10
+#the lead is never longer than this, however slow the startups were
+MAX_LEAD = 120
+
+RECURRENCES = {'daily': 1, 'weekly': 7}
+
+#how far recurring recordings are checked for conflicts
+CONFLICT_HORIZON = 8 * 24 * 3600
+
+
+def next_occurrence(start, recurrence):
+    """Returns the start of the next occurrence of a recurring recording,
+    at the same local time even if daylight saving time changes"""
+    t = time.localtime(start)
+    return time.mktime((t.tm_year, t.tm_mon,
+                        t.tm_mday + RECURRENCES[recurrence], t.tm_hour,
+                        t.tm_min, t.tm_sec, 0, 0, -1))
+
+
+class ScheduledJob(object):
+    """A recording that must start at start (seconds since the epoch) and
+    last duration seconds (0 until it is stopped) with the given
+    parameters, as returned by MainWindow.get_params_from_gui or
+    utils.load_parameters. recurrence is None, 'daily' or 'weekly'."""
+
+    def __init__(self, start, duration, parameters, recurrence=None,
+                 job_id=None):
+        self.start = start
+        self.duration = duration
+        self.parameters = parameters
+        self.recurrence = recurrence
+        self.id = job_id
+
+    def end(self, start=None):
+        """Returns the end of the occurrence starting at start (the next
+        one by default), None if it has no duration"""
+        if not self.duration:
+            return None
+        return (start or self.start) + self.duration
+
+    def occurrences(self, until):
+        """Returns the (start, end) of the occurrences starting before
+        until, the first one always"""
+        start = self.start
+        result = [(start, self.end(start))]
+        while self.recurrence:
+            start = next_occurrence(start, self.recurrence)
+            if start >= until:
+                break
+            result.append((start, self.end(start)))
+        return result
+
+    def description(self):
+        text = "%s %s" % (time.strftime('%Y-%m-%d %H:%M',
+                                         time.localtime(self.start)),
+                          self.parameters.get('channel_text'))
+        if self.duration:
+            text += " (%s)" % utils.secs_to_str(self.duration)
+        if self.recurrence:
+            text += " " + self.recurrence
+        return text
+
+    def as_dict(self):
+        return {'id': self.id, 'start': self.start, 'duration': self.duration,
+                'parameters': self.parameters, 'recurrence': self.recurrence}
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(values['start'], values['duration'], values['parameters'],
+                   values.get('recurrence'), values.get('id'))
+
+
+def record_startup_latency(device, latency):
+    """Saves how long a recording from the device took to start capturing,
+    since the pre capture command was run"""
+    cache = utils.load_cache(STARTUP_CACHE_FILENAME)
+    latencies = cache.get(device, [])[-(STARTUP_SAMPLES - 1):]
+    cache[device] = latencies + [round(latency, 2)]
+    utils.save_cache(STARTUP_CACHE_FILENAME, cache)
+
+
+def get_lead(device, settings, cache=None):
+    """Returns how many seconds before their start the recordings from the
+    device must be launched: schedule_lead from the settings, or more if
+    schedule_lead_auto is set and the last startups were slower"""
+    lead = settings.get('schedule_lead', 0)
+    if settings.get('schedule_lead_auto'):
+        if cache is None:
+            cache = utils.load_cache(STARTUP_CACHE_FILENAME)
+        latencies = cache.get(device)
+        if latencies:
+            #some margin over the slowest recent one
+            lead = max(lead, max(latencies) * 1.2 + 1)
+    return min(lead, MAX_LEAD)
+
+
+def overlap(start1, end1, start2, end2):
+    return (end2 is None or start1 < end2) and (end1 is None or start2 < end1)
+
+
+class Scheduler(object):
+    """The scheduled recordings. The file is read again before every change
+    because the GUI and the headless scheduler may both change it.
+    tuners is the number of recordings that can be made at the same time.
+    """
+
+    def __init__(self, tuners=1):
+        self.tuners = tuners
+        self.heap = []
+        self.next_id = 1
+        self.load()
+
+    def load(self):
+        self.settings = utils.get_advanced_parameters()
+        self.startup_cache = utils.load_cache(STARTUP_CACHE_FILENAME)
+        schedule = utils.load_cache(SCHEDULE_FILENAME)
+        self.next_id = schedule.get('next_id', 1)
+        self.heap = []
+        for values in schedule.get('jobs', []):
+            try:
+                job = ScheduledJob.from_dict(values)
+            except (KeyError, TypeError):
+                continue
+            self.heap.append(self.entry(job))
+        heapq.heapify(self.heap)
+
+    def save(self):
+        utils.save_cache(SCHEDULE_FILENAME,
+                         {'next_id': self.next_id,
+                          'jobs': [job.as_dict() for job in self.jobs()]})
+
+    def jobs(self):
+        """Returns the scheduled recordings sorted by start time"""
+        return [job for start, job_id, job in
+                sorted((job.start, job_id, job)
+                       for launch, job_id, job in self.heap)]
+
+    def add(self, job):
+        """Schedules the job and returns its conflicts, see conflicts"""
+        self.load()
+        job.id = self.next_id
+        self.next_id += 1
+        heapq.heappush(self.heap, self.entry(job))
+        self.save()
+        notify_scheduler()
+        return self.conflicts(job)
+
+    def remove(self, job_id):
+        self.load()
+        self.heap = [entry for entry in self.heap if entry[1] != job_id]
+        heapq.heapify(self.heap)
+        self.save()
+        notify_scheduler()
+
+    def lead(self, job):
+        """Returns how many seconds before its start the job is launched"""
+        return get_lead(job.parameters.get('device'), self.settings,
+                        self.startup_cache)
+
+    def entry(self, job):
+        """Returns the entry of the job in the heap, by launch time"""
+        return (job.start - self.lead(job), job.id, job)
+
+    def next_deadline(self):
+        """Returns when the next recording must be launched (its lead before
+        it starts), or None"""
+        if not self.heap:
+            return None
+        return self.heap[0][0]
+
+    def pop_due(self, now=None):
+        """Removes and returns the recordings that must have been launched
+        by now and haven't ended yet. Recurring ones are scheduled again for
+        their next occurrence."""
+        if now is None:
+            now = time.time()
+        due = []
+        changed = False
+        while self.heap and self.heap[0][0] <= now:
+            launch, job_id, job = heapq.heappop(self.heap)
+            changed = True
+            end = job.end()
+            if end is None or end > now:
+                due.append(job)
+            if job.recurrence:
+                start = next_occurrence(job.start, job.recurrence)
+                while start <= now:
+                    start = next_occurrence(start, job.recurrence)
+                following = ScheduledJob(start, job.duration, job.parameters,
+                                         job.recurrence, job.id)
+                heapq.heappush(self.heap, self.entry(following))
+        if changed:
+            self.save()
+        return due
+
+    def conflicts(self, job):
+        """Returns the (start, jobs) of the occurrences of the job that
+        overlap with more recordings than tuners available, or with another
+        recording from the same device"""
+        until = job.start + CONFLICT_HORIZON
+        others = [j for j in self.jobs() if j.id != job.id]
+        device = job.parameters.get('device')
+        conflicts = []
+        for start, end in job.occurrences(until):
+            overlapping = []
+            #(time, change in the number of recordings)
+            events = [(start, 1)]
+            if end is not None:
+                events.append((end, -1))
+            for other in others:
+                other_until = end is None and until or end
+                for other_start, other_end in other.occurrences(other_until):
+                    if overlap(start, end, other_start, other_end):
+                        overlapping.append(other)
+                        events.append((max(start, other_start), 1))
+                        if other_end is not None:
+                            events.append((other_end, -1))
+            if any(o.parameters.get('device') == device for o in overlapping):
+                conflicts.append((start, overlapping))
+                continue
+            #ends are sorted before starts at the same time
+            recordings = 0
+            for when, change in sorted(events):
+                recordings += change
+                if recordings > self.tuners:
+                    conflicts.append((start, overlapping))
+                    break
+        return conflicts
+
+
+def job_parameters(job, now=None):
+    """Returns the parameters to record the job now, with the duration until
+    its end (longer if it is launched before its start, shorter if late)"""
+    if now is None:
+        now = time.time()
+    parameters = dict(job.parameters)
+    parameters['append_suffix'] = True
+    #the recording is launched before its start, see Recording.capture_started
+    parameters['scheduled_start'] = job.start
+    end = job.end()
+    if end is not None:
+        parameters['duration'] = utils.secs_to_str(int(end - now))
+    return parameters
+
+
+def get_scheduler_pid():
+    """Returns the pid of the running headless scheduler, or None"""
+    pid_filename = os.path.join(utils.get_config_dir(), SCHEDULER_PID_FILENAME)
+    try:
+        pid = int(open(pid_filename).read())
+        os.kill(pid, 0)
+    except (IOError, OSError, ValueError):
+        return None
+    return pid
+
+
+def notify_scheduler():
+    """Makes the headless scheduler, if it is running, read the schedule
+    again"""
+    pid = get_scheduler_pid()
+    if pid and pid != os.getpid():
+        try:
+            os.kill(pid, signal.SIGUSR1)
+        except OSError:
+            pass
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+# Author: Santiago Bruno
+# License: GPL v3
+# Web pages: http://www.santiagobruno.com.ar/programas.html
+#            http://code.google.com/p/mtvcgui/
+
+"""Telemetry of finished recordings. Each one gets a JSON sidecar next to
+the file, capture.avi.json, with its command, timing, encoding speed,
+frames lost and resources used (see Recording.telemetry). report()
+aggregates the sidecars of a directory by channel, device or preset to find
+the ones that often can't keep up in real time:
+
+    mtvcgui-rec --report /srv/tv --group-by preset
+"""
+
+import json
+import os
+
+SIDECAR_SUFFIX = '.json'
+TELEMETRY_VERSION = 1
+#a recording missed real time if it skipped frames or encoded slower than
+#this fraction of the capture frame rate on average
+REALTIME_MARGIN = 0.95
+GROUP_KEYS = ['channel', 'device', 'preset', 'backend']
+
+
+def write_sidecar(filename, telemetry):
+    """Writes the telemetry of the recording saved in filename to its
+    sidecar"""
+    telemetry = dict(telemetry, telemetry_version=TELEMETRY_VERSION)
+    sidecar_filename = filename + SIDECAR_SUFFIX
+    #the report must never read a half written sidecar
+    temporary = sidecar_filename + '.tmp'
+    try:
+        #e.g. a filename with bytes that aren't UTF-8 can't be saved
+        data = json.dumps(telemetry, indent=1, sort_keys=True)
+        sidecar = open(temporary, 'w')
+        try:
+            sidecar.write(data)
+        finally:
+            sidecar.close()
+        os.rename(temporary, sidecar_filename)
+    except (IOError, OSError, ValueError, UnicodeError), e:
+        print "Error writing the telemetry sidecar: %s" % e
+        try:
+            os.remove(temporary)
+        except OSError:
+            pass
+
+
+def load_sidecars(directory):
+    """Returns the telemetry of the sidecars found in the directory and
+    its subdirectories"""
+    sidecars = []
+    for root, dirs, files in os.walk(directory):
+        for name in sorted(files):
+            if not name.endswith(SIDECAR_SUFFIX):
+                continue
+            try:
+                telemetry = json.load(open(os.path.join(root, name)))
+            except (IOError, ValueError):
+                continue
+            #other JSON files
+            if isinstance(telemetry, dict) and \
+                'telemetry_version' in telemetry:
+                sidecars.append(telemetry)
+    return sidecars
+
+
+def missed_realtime(telemetry):
+    """Returns True if the recording couldn't keep up with the capture"""
+    if telemetry.get('skipped_frames'):
+        return True
+    capture_fps = telemetry.get('capture_fps')
+    average_fps = telemetry.get('average_fps')
+    return bool(capture_fps and average_fps and
+                average_fps < capture_fps * REALTIME_MARGIN)
+
+
+def aggregate(sidecars, key):
+    """Groups the telemetry by the value of key and returns a list of
+    dicts with the totals of each group, the ones that miss real time more
+    often first"""
+    groups = {}
+    for telemetry in sidecars:
+        groups.setdefault(telemetry.get(key) or '-', []).append(telemetry)
+    rows = []
+    for value, group in groups.items():
+        fps = [t['average_fps'] for t in group if t.get('average_fps')]
+        min_fps = [t['min_fps'] for t in group if t.get('min_fps')]
+        latencies = [t['startup_latency'] for t in group
+                     if t.get('startup_latency') is not None]
+        rows.append({
+            key: value,
+            'recordings': len(group),
+            'missed': len([t for t in group if missed_realtime(t)]),
+            'failed': len([t for t in group if t.get('returncode')]),
+            'degraded': len([t for t in group if t.get('degraded_to')]),
+            'average_fps': fps and sum(fps) / len(fps) or 0.0,
+            'min_fps': min_fps and min(min_fps) or 0.0,
+            'skipped_frames': sum(t.get('skipped_frames') or 0
+                                  for t in group),
+            'startup_latency': latencies and
+                sum(latencies) / len(latencies) or 0.0,
+            'peak_rss': max([t.get('peak_rss') or 0 for t in group]),
+        })
+    rows.sort(key=lambda row: (-float(row['missed']) / row['recordings'],
+                               -row['recordings'], row[key]))
+    return rows
+
+
+def format_report(rows, key):
+    """Returns the aggregated rows as a text table"""
+    lines = ["%-24s %5s %6s %6s %8s %8s %8s %8s %7s" % (
+        key, 'recs', 'missed', 'failed', 'avg fps', 'min fps', 'skipped',
+        'startup', 'RSS MB')]
+    for row in rows:
+        lines.append("%-24s %5d %6d %6d %8.1f %8.1f %8d %7.1fs %7.0f" % (
+            unicode(row[key])[:24], row['recordings'], row['missed'],
+            row['failed'], row['average_fps'], row['min_fps'],
+            row['skipped_frames'], row['startup_latency'],
+            row['peak_rss'] / 1e6))
+    return "\n".join(lines)
+
+
+def report(directory, keys=None):
+    """Returns the report of the sidecars of the directory grouped by each
+    of the keys (all of GROUP_KEYS by default), or None if there are none"""
+    sidecars = load_sidecars(directory)
+    if not sidecars:
+        return None
+    sections = ["%d recordings, %d missed real time" % (
+        len(sidecars), len([t for t in sidecars if missed_realtime(t)]))]
+    for key in keys or GROUP_KEYS:
+        sections.append(format_report(aggregate(sidecars, key), key))
+    return "\n\n".join(sections)
@@ -0,0 +1,419 @@
+# -*- coding: utf-8 -*-
+
+# Author: Santiago Bruno
+# License: GPL v3
+# Web pages: http://www.santiagobruno.com.ar/programas.html
+#            http://code.google.com/p/mtvcgui/
+
+"""Re-encoding of finished recordings in background. Recordings can be
+captured with settings that keep up in real time and converted later by a
+few mencoder processes with low priority, using the cores left free.
+
+The queue is saved in ~/.mtvcgui/transcode.json, so pending jobs survive
+restarts. The encoding settings are the ones of the recording overridden by
+the [transcode] section of the .ini file, e.g.
+
+    [transcode]
+    videocodec = x264
+    x264_bitrate = 1200
+
+Two-stage captures are recorded to an intermediate file with a cheap codec
+and encoded to the output file with the selected codecs by the queue.
+"""
+
+import errno
+import fcntl
+import os
+import select
+import signal
+from subprocess import Popen, PIPE, STDOUT
+
+import backends
+import utils
+from progress import ProgressParser
+
+TRANSCODE_FILENAME = 'transcode.json'
+#held by the process running the queue
+TRANSCODE_LOCK_FILENAME = 'transcode.lock'
+
+#parameters of the capture that don't apply to its re-encoding, they are
+#used only if they are set in [transcode]
+CAPTURE_ONLY_PARAMETERS = ['extrafilters', 'scalewidth', 'scaleheight',
+                           'ofps', 'duration', 'extramencoderparms']
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+#codec settings of the intermediate files of two-stage captures, by
+#intermediate_codec. They are cheap to encode but big.
+INTERMEDIATE_CODECS = {
+    'mjpeg': {'videocodec': 'lavc', 'lavc_videocodec': 'mjpeg',
+              'lavc_videobitrate': '', 'lavc_video_extra_opts': 'vqscale=2'},
+    'ffv1': {'videocodec': 'lavc', 'lavc_videocodec': 'ffv1',
+             'lavc_videobitrate': '', 'lavc_video_extra_opts': ''},
+    'raw': {'videocodec': 'raw'},
+}
+INTERMEDIATE_SUFFIX = '_intermediate'
+
+
+def get_input_files(filename):
+    """Returns the files to read for a recording, the segments if it is a
+    playlist of segments"""
+    if not filename.endswith('.m3u8'):
+        return [filename]
+    directory = os.path.dirname(filename)
+    playlist = open(filename)
+    try:
+        return [os.path.join(directory, line.strip()) for line in playlist
+                if line.strip() and not line.startswith('#')]
+    finally:
+        playlist.close()
+
+
+def get_transcode_parameters(parameters, overrides=None):
+    """Returns the parameters to re-encode a recording made with the given
+    parameters: the ones of [transcode] or the overrides given replace
+    them"""
+    if overrides is None:
+        overrides = utils.load_section('transcode')
+    parameters = dict(parameters)
+    for parm in CAPTURE_ONLY_PARAMETERS:
+        parameters[parm] = ''
+    parameters.update(overrides)
+    return parameters
+
+
+def get_intermediate_parameters(parameters):
+    """Returns the parameters to capture a two-stage recording: the
+    intermediate codec and PCM audio, written to intermediate_dir. The
+    parameters given are kept as final_parameters, to encode it later."""
+    capture = dict(parameters)
+    capture.update(INTERMEDIATE_CODECS.get(
+        parameters.get('intermediate_codec'), INTERMEDIATE_CODECS['mjpeg']))
+    if parameters.get('audiocodec') != 'none':
+        capture['audiocodec'] = 'pcm'
+    #the intermediate codec keeps up and goes in an AVI file
+    capture['adaptive_quality'] = False
+    capture['segment_seconds'] = 0
+    capture['segment_size_mb'] = 0
+    capture['transcode_after_recording'] = False
+    template = parameters.get('outputfile') or ''
+    directory = os.path.expanduser(parameters.get('intermediate_dir') or
+                                   os.path.dirname(template))
+    root = os.path.splitext(os.path.basename(template))[0]
+    capture['outputfile'] = os.path.join(directory,
+                                         root + INTERMEDIATE_SUFFIX + '.avi')
+    if parameters.get('intermediate_dir'):
+        #instead of the output_roots
+        capture['output_roots'] = ''
+    capture['final_parameters'] = parameters
+    return capture
+
+
+def get_final_filename(filename, final_parameters):
+    """Returns the output file of the intermediate file of a two-stage
+    capture, named like it in the directory of the output template"""
+    root = os.path.splitext(os.path.basename(filename))[0]
+    root = ''.join(root.rsplit(INTERMEDIATE_SUFFIX, 1))
+    template = final_parameters.get('outputfile') or ''
+    extension = os.path.splitext(template)[1] or '.avi'
+    output_root = None
+    if final_parameters.get('output_roots'):
+        import outputpool
+        output_root = outputpool.place(final_parameters)
+    return utils.make_filename(
+        os.path.join(os.path.dirname(template), root + extension), '',
+        append_suffix=True, root=output_root)
+
+
+def make_output_filename(filename, parameters):
+    root = os.path.splitext(filename)[0]
+    return utils.make_filename(root + parameters.get('transcode_suffix',
+                                                     '_transcoded') + '.avi',
+                               '', append_suffix=True)
+
+
+def low_priority(command):
+    """Returns the command to run command with the lowest CPU and disk
+    priorities"""
+    prefix = ['nice', '-n', '19']
+    if utils.find_executable('ionice'):
+        prefix += ['ionice', '-c', '3']
+    return prefix + command
+
+
+def get_free_cpus(busy=0):
+    """Returns how many CPUs are left when busy are used (e.g. by the
+    recordings), at least one"""
+    return max(1, utils.get_available_cpus() - busy)
+
+
+class TranscodeJob(object):
+    """The re-encoding of a recording, running in a mencoder process"""
+
+    def __init__(self, job_id, inputfile, outputfile, parameters,
+                 status=QUEUED, percent=0, returncode=None,
+                 delete_input=False):
+        self.id = job_id
+        self.inputfile = inputfile
+        self.outputfile = outputfile
+        self.parameters = parameters
+        #the input is an intermediate file, removed when it is encoded
+        self.delete_input = delete_input
+        self.status = status
+        self.percent = percent
+        self.returncode = returncode
+        self.process = None
+        self.progress = ProgressParser()
+        self.interrupted = False
+
+    def start(self, threads=None):
+        """Starts mencoder, with that many encoder threads unless the
+        parameters set them. Raises OSError if it can't be run."""
+        parameters = self.parameters
+        if threads and not parameters.get('encoder_threads'):
+            parameters = dict(parameters, encoder_threads=threads)
+        self.command = backends.get_backend(parameters).encode_command(
+            parameters, get_input_files(self.inputfile), self.outputfile)
+        print "Excecuting %s" % " ".join(self.command)
+        self.process = Popen(low_priority(self.command), stdout=PIPE,
+                             stderr=STDOUT)
+        flags = fcntl.fcntl(self.process.stdout, fcntl.F_GETFL)
+        fcntl.fcntl(self.process.stdout, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.status = RUNNING
+        self.percent = 0
+        self.returncode = None
+        self.interrupted = False
+
+    def output_fileno(self):
+        return self.process.stdout.fileno()
+
+    def read_output(self):
+        """Reads the available mencoder output without blocking. Returns
+        False when the output ended."""
+        while True:
+            try:
+                data = os.read(self.output_fileno(), 65536)
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return True
+                raise
+            if not data:
+                return False
+            self.progress.feed(data)
+            if self.progress.metrics.percent is not None:
+                self.percent = self.progress.metrics.percent
+
+    def poll(self):
+        if self.process and self.returncode is None:
+            self.returncode = self.process.poll()
+            if self.returncode is not None:
+                self.finished()
+        return self.returncode
+
+    def finished(self):
+        if self.interrupted:
+            self.status = QUEUED
+            self.percent = 0
+        else:
+            self.status = self.returncode and FAILED or DONE
+            if self.status == DONE:
+                self.percent = 100
+
+    def stop(self):
+        """Stops mencoder, the job is queued again"""
+        if self.process and self.poll() is None:
+            self.interrupted = True
+            try:
+                os.kill(self.process.pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def description(self):
+        text = "%s -> %s: %s" % (os.path.basename(self.inputfile),
+                                 os.path.basename(self.outputfile),
+                                 self.status)
+        if self.status == RUNNING:
+            text += " %d%%" % self.percent
+        return text
+
+    def as_dict(self):
+        return {'id': self.id, 'inputfile': self.inputfile,
+                'outputfile': self.outputfile,
+                'parameters': self.parameters, 'status': self.status,
+                'percent': self.percent, 'returncode': self.returncode,
+                'delete_input': self.delete_input}
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(values['id'], values['inputfile'], values['outputfile'],
+                   values['parameters'], values.get('status', QUEUED),
+                   values.get('percent', 0), values.get('returncode'),
+                   values.get('delete_input', False))
+
+
+class TranscodeQueue(object):
+    """The re-encodings pending, running and finished. At most workers run
+    at the same time (the free CPUs if 0). The caller starts them with
+    start_jobs, watches their output and end, and calls job_finished."""
+
+    def __init__(self, workers=0):
+        self.workers = workers
+        self.jobs = []
+        self.next_id = 1
+        self.lock_file = None
+        self.stopping = False
+        self.load()
+
+    def lock(self):
+        """Returns True if this process can run the jobs, only one of the
+        GUI and mtvcgui-rec processes runs them"""
+        if self.lock_file:
+            return True
+        lock_filename = os.path.join(utils.get_config_dir(),
+                                     TRANSCODE_LOCK_FILENAME)
+        try:
+            lock_file = open(lock_filename, 'a')
+        except IOError:
+            return False
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lock_file.close()
+            return False
+        self.lock_file = lock_file
+        return True
+
+    def load(self):
+        queue = utils.load_cache(TRANSCODE_FILENAME)
+        self.next_id = queue.get('next_id', 1)
+        #the jobs started by this process are up to date
+        started = dict((job.id, job) for job in self.jobs if job.process)
+        self.jobs = []
+        for values in queue.get('jobs', []):
+            try:
+                job = TranscodeJob.from_dict(values)
+            except (KeyError, TypeError):
+                continue
+            if job.id in started:
+                job = started[job.id]
+            elif job.status == RUNNING:
+                #it was interrupted, start it again
+                job.status = QUEUED
+            self.jobs.append(job)
+
+    def save(self):
+        utils.save_cache(TRANSCODE_FILENAME,
+                         {'next_id': self.next_id,
+                          'jobs': [job.as_dict() for job in self.jobs]})
+
+    def add(self, inputfile, parameters, overrides=None, outputfile=None,
+            delete_input=False):
+        """Queues the re-encoding of a recording made with parameters"""
+        self.load()
+        parameters = get_transcode_parameters(parameters, overrides)
+        if not outputfile:
+            outputfile = make_output_filename(inputfile, parameters)
+        job = TranscodeJob(self.next_id, inputfile, outputfile, parameters,
+                           delete_input=delete_input)
+        self.next_id += 1
+        self.jobs.append(job)
+        self.save()
+        return job
+
+    def remove(self, job_id):
+        self.load()
+        for job in self.jobs:
+            if job.id == job_id:
+                job.stop()
+        self.jobs = [job for job in self.jobs if job.id != job_id]
+        self.save()
+
+    def running(self):
+        return [job for job in self.jobs if job.status == RUNNING]
+
+    def pending(self):
+        return [job for job in self.jobs if job.status == QUEUED]
+
+    def start_jobs(self, busy=0):
+        """Starts the queued jobs that fit in the free workers, busy CPUs
+        are not counted as free. Returns the ones started."""
+        if self.stopping or not self.lock():
+            return []
+        self.load()
+        workers = self.workers or get_free_cpus(busy)
+        #each job gets its share of the free CPUs
+        threads = max(1, get_free_cpus(busy) / workers)
+        started = []
+        for job in self.pending()[:max(0, workers - len(self.running()))]:
+            try:
+                job.start(threads)
+            except OSError:
+                print "excecution of %s failed" % " ".join(job.command)
+                job.status = FAILED
+                continue
+            started.append(job)
+        self.save()
+        return started
+
+    def stop(self):
+        """Stops the jobs running, they are started again the next time"""
+        self.stopping = True
+        for job in self.running():
+            job.stop()
+
+    def update(self):
+        """Saves the progress of the jobs running, keeping the changes
+        made by other processes"""
+        self.load()
+        self.save()
+
+    def job_finished(self, job):
+        job.poll()
+        print "transcoding of %s finished with status code %s" % (
+            job.inputfile, job.returncode)
+        if job.status == DONE and job.delete_input:
+            for filename in set(get_input_files(job.inputfile) +
+                                [job.inputfile]):
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+        self.update()
+
+    def add_recording(self, filename, parameters):
+        """Queues what must be done with a finished recording (or part of
+        it): the encoding of the intermediate file of a two-stage capture,
+        or its re-encoding if transcode_after_recording is set. Returns the
+        job queued or None."""
+        if not filename or not os.path.exists(filename):
+            return None
+        final_parameters = parameters.get('final_parameters')
+        if final_parameters:
+            return self.add(filename, final_parameters, {},
+                            get_final_filename(filename, final_parameters),
+                            not parameters.get('keep_intermediate'))
+        if parameters.get('transcode_after_recording'):
+            return self.add(filename, parameters)
+        return None
+
+    def run(self, busy=0):
+        """Runs the queued jobs until there are none left"""
+        self.start_jobs(busy)
+        while self.running():
+            jobs = dict((job.output_fileno(), job) for job in self.running())
+            try:
+                ready = select.select(jobs.keys(), [], [])[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in ready:
+                job = jobs[fd]
+                last_percent = job.percent
+                if job.read_output():
+                    if int(job.percent) != int(last_percent):
+                        self.update()
+                    continue
+                job.process.wait()
+                self.job_finished(job)
+                self.start_jobs(busy)
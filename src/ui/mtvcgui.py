@@ -712,7 +712,7 @@ class Ui_MainWindow(object):
         self.label_27.setText(QtGui.QApplication.translate("MainWindow", "Run this command after capturing:", None, QtGui.QApplication.UnicodeUTF8))
         self.scheduleButton.setText(QtGui.QApplication.translate("MainWindow", "Schedule Recording", None, QtGui.QApplication.UnicodeUTF8))
         self.cancel_sheduleButton.setText(QtGui.QApplication.translate("MainWindow", "Cancel", None, QtGui.QApplication.UnicodeUTF8))
-        self.play_while_recording.setToolTip(QtGui.QApplication.translate("MainWindow", "<html><head/><body><p>It is absolutely not recommended to use this! It may consume too much CPU and ruin your capture!! It makes use of the \'tail\' command, so it must be available.</p></body></html>", None, QtGui.QApplication.UnicodeUTF8))
+        self.play_while_recording.setToolTip(QtGui.QApplication.translate("MainWindow", "<html><head/><body><p>It is absolutely not recommended to use this! It may consume too much CPU and ruin your capture!! What is recorded is sent to mplayer while it is written, so it is saved in MPEG-TS (.ts) instead of AVI.</p></body></html>", None, QtGui.QApplication.UnicodeUTF8))
         self.play_while_recording.setText(QtGui.QApplication.translate("MainWindow", "Play recorded file while capture (kind of preview) (NOT RECOMMENDED)", None, QtGui.QApplication.UnicodeUTF8))
         self.setenvvars.setText(QtGui.QApplication.translate("MainWindow", "Set these environment variables:", None, QtGui.QApplication.UnicodeUTF8))
         self.label_34.setText(QtGui.QApplication.translate("MainWindow", "To limit the recording length specify a duration in the first tab", None, QtGui.QApplication.UnicodeUTF8))
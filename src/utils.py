@@ -5,12 +5,234 @@
 # Web pages: http://www.santiagobruno.com.ar/programas.html
 #            http://code.google.com/p/mtvcgui/
 
+import fcntl
 import locale
 import os
 import commands
+import json
 import re
+import threading
 import time
 import ConfigParser
+from subprocess import Popen, call, PIPE, STDOUT
+
+
+PROBES_CACHE_FILENAME = 'probes.cache'
+DEVICES_CACHE_FILENAME = 'devices.cache'
+
+#values of the dropdown lists that are saved by index in the configuration
+DRIVERS = ['v4l2', 'v4l']
+CHANLISTS = ['us-cable', 'us-bcast', 'europe-east', 'europe-west']
+LAVC_AUDIO_CODECS = ['mp2', 'libmp3lame', 'ac3', 'flac', 'vorbis',
+                     'adpcm_ima_wav']
+LAVC_VIDEO_CODECS = ['mpeg4', 'mjpeg', 'h263', 'h263p', 'msmpeg4',
+                     'msmpeg4v2', 'wmv1', 'wmv2', 'rv10', 'rv20',
+                     'mpeg1video', 'mpeg2video', 'huffyuv', 'flv']
+
+#values saved as True/False in the configuration
+BOOLEAN_PARAMETERS = ['append_suffix', 'xvid_cbr', 'xvid_cartoon',
+                      'xvid_interlacing', 'x264_cbr', 'alsa_audio', 'noskip',
+                      'quiet', 'play_while_recording', 'setenvvars']
+
+#parameters saved as the index of their value in these lists
+INDEX_PARAMETERS = [('driver', DRIVERS), ('chanlist', CHANLISTS),
+                    ('lavc_audiocodec', LAVC_AUDIO_CODECS),
+                    ('lavc_videocodec', LAVC_VIDEO_CODECS)]
+
+#sections of the .ini file with the settings of extra outputs encoded from
+#the same capture, e.g. [rendition web]
+RENDITION_SECTION = 'rendition '
+
+#parameters that are only set editing the .ini file, with their defaults.
+#Their values are converted to the type of the default.
+ADVANCED_PARAMETERS = {
+    #lower the encoding quality when the recording can't keep up
+    'adaptive_quality': False,
+    #seconds of video encoded per second required, and seconds it must be
+    #lower before degrading
+    'adaptive_min_speed': 0.95,
+    'adaptive_window': 30,
+    #skipped frames allowed in a window
+    'adaptive_max_skipped': 10,
+    #recordings that can be made at the same time, by the scheduler
+    'tuners': 1,
+    #seconds before their start scheduled recordings are launched, more if
+    #schedule_lead_auto is set and the capture took longer to start before
+    'schedule_lead': 5,
+    'schedule_lead_auto': True,
+    #split recordings in MPEG-TS segments of these seconds or MB (0 for no
+    #limit, both 0 for a single file) and run this command with each one
+    'segment_seconds': 0,
+    'segment_size_mb': 0,
+    'segment_command': '',
+    #minutes kept by the time-shift buffer, and where its files are written
+    #(~/.mtvcgui/timeshift if empty)
+    'timeshift_minutes': 10,
+    'timeshift_dir': '',
+    #queue finished recordings to be re-encoded with the settings of the
+    #[transcode] section, by this many processes (0 for the free CPUs)
+    'transcode_after_recording': False,
+    'transcode_workers': 0,
+    #capture to a cheap intermediate file (mjpeg, ffv1 or raw video with
+    #PCM audio) in intermediate_dir (the output directory if empty) and
+    #encode it later with the selected codecs
+    'two_stage_capture': False,
+    'intermediate_codec': 'mjpeg',
+    'intermediate_dir': '',
+    'keep_intermediate': False,
+    #program that captures and encodes, mencoder or ffmpeg (see
+    #backends.py), and the video filters and extra parameters of ffmpeg
+    'backend': 'mencoder',
+    'ffmpeg_filters': '',
+    'ffmpeg_extra_params': '',
+    #threads of the video encoder (0 for the CPUs available, shared by the
+    #recordings made at the same time)
+    'encoder_threads': 0,
+    #serve the metrics of the recordings on this port (0 to disable it)
+    #and/or write them to this directory, see metrics.py
+    'metrics_port': 0,
+    'metrics_address': '127.0.0.1',
+    'metrics_textfile_dir': '',
+    #warn when the disk of the recording would be full in these minutes,
+    #and continue in one of these directories (separated by commas) when
+    #in less than disk_rollover_minutes, see diskwatch.py
+    'disk_warn_minutes': 10,
+    'disk_rollover_minutes': 2,
+    'disk_spare_dirs': '',
+    #directories (separated by commas) the output template is relative to,
+    #each recording goes to the least loaded disk, see outputpool.py. A disk
+    #is loaded if it is written faster than this fraction of its speed.
+    'output_roots': '',
+    'output_root_max_load': 0.8,
+}
+
+#kbit/s assumed for the codecs without a bitrate setting
+DEFAULT_VIDEO_BITRATE = 6000
+DEFAULT_AUDIO_BITRATE = 224
+#bits per pixel of the codecs that are used without a bitrate (the
+#intermediate files of two-stage captures), roughly for analog TV
+BITS_PER_PIXEL = {'raw': 12.0, 'huffyuv': 8.0, 'ffv1': 6.0, 'mjpeg': 2.5}
+
+#the lavc encoders of mencoder don't use more threads than this
+LAVC_MAX_THREADS = 8
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+
+
+def get_config_dir():
+    """Returns the directory where the configuration and other per user
+    files are stored (~/.mtvcgui)
+    """
+    return os.path.join(os.path.expanduser("~"), '.mtvcgui')
+
+
+def find_executable(name):
+    """Returns the real path of the executable that would be run for name,
+    searching the PATH like the shell does, or None if it is not found
+    """
+    if os.path.dirname(name):
+        candidates = [name]
+    else:
+        candidates = [os.path.join(directory, name) for directory in
+                      os.environ.get('PATH', os.defpath).split(os.pathsep)]
+    for candidate in candidates:
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return os.path.realpath(candidate)
+    return None
+
+
+def load_cache(cache_name):
+    """Loads a cache file (e.g. the cached output of mplayer/mencoder probes)
+    from the configuration directory. Returns an empty cache if there is
+    none or it can't be read.
+    """
+    cache_filename = os.path.join(get_config_dir(), cache_name)
+    try:
+        cache_file = open(cache_filename)
+        try:
+            cache = json.load(cache_file)
+        finally:
+            cache_file.close()
+    except (IOError, ValueError):
+        return {}
+    if not isinstance(cache, dict):
+        return {}
+    return cache
+
+
+def save_cache(cache_name, cache):
+    """Saves a cache file to the configuration directory. The file is
+    replaced atomically so a concurrent reader never sees it half written.
+    """
+    import tempfile
+    config_dir = get_config_dir()
+    cache_filename = os.path.join(config_dir, cache_name)
+    tmp_filename = None
+    try:
+        #values that can't be saved (e.g. bytes that aren't UTF-8) must not
+        #leave a half written file
+        data = json.dumps(cache)
+        if not os.path.exists(config_dir):
+            os.mkdir(config_dir)
+        #each process writes its own temporary file
+        fd, tmp_filename = tempfile.mkstemp(prefix=cache_name + '.',
+                                            dir=config_dir)
+        cache_file = os.fdopen(fd, 'w')
+        try:
+            cache_file.write(data)
+        finally:
+            cache_file.close()
+        os.rename(tmp_filename, cache_filename)
+    except (IOError, OSError, ValueError, UnicodeError):
+        print "Error trying to save cache to %s" % (cache_filename, )
+        if tmp_filename:
+            try:
+                os.remove(tmp_filename)
+            except OSError:
+                pass
+
+
+def get_probe(cmd, refresh=False):
+    """Returns the cached probe for the given command (e.g. mencoder -ovc help)
+    as a dictionary with its raw output in the 'output' key. Probes are cached
+    per binary and are reused while the binary keeps the same path,
+    modification time and size. If refresh is true the command is run again.
+    """
+    binary = find_executable(cmd.split()[0])
+    if not binary:
+        return {'output': commands.getoutput(cmd)}
+
+    stat = os.stat(binary)
+    cache = load_cache(PROBES_CACHE_FILENAME)
+    entry = cache.get(binary)
+    if not entry or entry.get('mtime') != stat.st_mtime or \
+        entry.get('size') != stat.st_size:
+        entry = {'mtime': stat.st_mtime, 'size': stat.st_size, 'probes': {}}
+        cache[binary] = entry
+
+    probe = entry['probes'].get(cmd)
+    if refresh or probe is None:
+        print "Probing with command " + cmd
+        #the output may have bytes that aren't UTF-8, JSON can't keep them
+        output = commands.getoutput(cmd).decode('utf-8', 'replace')
+        probe = {'output': output}
+        entry['probes'][cmd] = probe
+        save_cache(PROBES_CACHE_FILENAME, cache)
+    return probe
+
+
+def update_probe(cmd, key, value):
+    """Stores a value parsed from the output of a probe command in its cache
+    entry, so the parsing does not need to be repeated
+    """
+    binary = find_executable(cmd.split()[0])
+    if not binary:
+        return
+    cache = load_cache(PROBES_CACHE_FILENAME)
+    probe = cache.get(binary, {}).get('probes', {}).get(cmd)
+    if probe is not None:
+        probe[key] = value
+        save_cache(PROBES_CACHE_FILENAME, cache)
 
 
 def find_translation(prefix='', tr_dir='i18n', locale_string=None):
@@ -41,11 +263,42 @@ def find_translation(prefix='', tr_dir='i18n', locale_string=None):
     return tr_path
 
 
-def get_codecs(cmd):
+def get_output(cmd, timeout=None):
+    """Runs the given command line and returns its output (stdout and
+    stderr) like commands.getoutput does. If timeout seconds pass before the
+    command finishes it is killed and the output produced until then is
+    returned. The second returned value tells if that was the case.
+    """
+    # exec so the process killed on timeout is the command and not the shell
+    process = Popen('exec ' + cmd, shell=True, stdout=PIPE, stderr=STDOUT)
+    killed = []
+    def kill():
+        killed.append(True)
+        try:
+            process.kill()
+        except OSError:
+            pass
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+    try:
+        output = process.communicate()[0]
+    finally:
+        if timer:
+            timer.cancel()
+    timed_out = bool(killed)
+    if output[-1:] == '\n':
+        output = output[:-1]
+    return output, timed_out
+
+
+def get_codecs(cmd, refresh=False):
     """Returns available codecs from mplayer using the given command
     e.g. mencoder -ovc help
+    The output of the command is cached, refresh forces running it again.
     """
-    output = commands.getoutput(cmd)
+    output = get_probe(cmd, refresh=refresh)['output']
     lines = output.split('\n')
     text = ''
     skip = True
@@ -59,36 +312,47 @@ def get_codecs(cmd):
         text = output
     return text
     
-def get_codecs_list(cmd, add_null=True):
+def get_codecs_list(cmd, add_null=True, refresh=False):
     """Parses the available codecs from mplayer using the given command
     e.g. mencoder -ovc help, and returns a list with their names
     if add_null is true, it returns also 'null' which is a valid value for
     codec but it is not displayed in the available codecs list
+    The parsed list is cached with the command output, refresh forces
+    running the command again.
     """
-    codecs = []
-    output = commands.getoutput(cmd)
-    lines = output.split('\n')
-    codec_re = re.compile("^\s+(\S+)\s+\-\s+.+$")
-    for line in lines:
-        match = codec_re.match(line)
-        if match:
-            codecs.append(match.group(1))
+    probe = get_probe(cmd, refresh=refresh)
+    codecs = probe.get('codecs')
+    if codecs is None:
+        codecs = []
+        lines = probe['output'].split('\n')
+        codec_re = re.compile("^\s+(\S+)\s+\-\s+.+$")
+        for line in lines:
+            match = codec_re.match(line)
+            if match:
+                codecs.append(match.group(1))
+        update_probe(cmd, 'codecs', codecs)
+    codecs = [str(codec) for codec in codecs]
     if add_null:
         codecs.append('null')
     return codecs
     
     
-def get_device_information(cmd):
+def get_device_information(cmd, timeout=None):
     """Parses the supported norms and inputs using the given command
     e.g. mplayer -slave tv:// -tv channel=42:driver=v4l2:device=/dev/video1
     -vo null -ao null -frames 0 and a dictionary with the results
+    If the command doesn't finish in timeout seconds it is killed, and the
+    'timed_out' value of the dictionary is true.
     """
     norms = []
     inputs = []
     normsfound = False
     inputsfound = False
     print "Getting device information with command " + cmd
-    output = commands.getoutput(cmd)
+    output, timed_out = get_output(cmd, timeout=timeout)
+    if timed_out:
+        print "Getting device information timed out after %s seconds" % \
+            (timeout, )
     lines = output.split('\n')
     norms_line_re = re.compile("^\s*supported norms:(.*)$")
     norms_re = re.compile("\s*(\d+)\s*=\s*([^;]+);")
@@ -113,12 +377,76 @@ def get_device_information(cmd):
             break
     print "Norms found " + str(norms)
     print "Inputs found " + str(inputs)
-    return {'norms': norms, 'inputs': inputs}
+    return {'norms': norms, 'inputs': inputs, 'timed_out': timed_out}
     
 
-def make_filename(filename, channel_text, append_suffix=True):
+def get_device_identity(device):
+    """Returns a dictionary identifying the device node (e.g. /dev/video0)
+    and the hardware behind it, from the node itself and its entry in
+    /sys/class/video4linux. Returns None if the device doesn't exist.
+    If the node is replaced, e.g. because a card is plugged in again or a
+    different one takes its place, the identity changes.
+    """
+    try:
+        stat = os.stat(device)
+    except OSError:
+        return None
+    identity = {'rdev': stat.st_rdev, 'ino': stat.st_ino,
+                'ctime': stat.st_ctime, 'name': '', 'bus_info': ''}
+    sysfs_dir = os.path.join('/sys/class/video4linux',
+                             os.path.basename(os.path.realpath(device)))
+    try:
+        name_file = open(os.path.join(sysfs_dir, 'name'))
+        try:
+            identity['name'] = name_file.read().strip()
+        finally:
+            name_file.close()
+    except IOError:
+        pass
+    bus_link = os.path.join(sysfs_dir, 'device')
+    if os.path.exists(bus_link):
+        identity['bus_info'] = os.path.realpath(bus_link)
+    return identity
+
+
+def get_cached_device_information(device, driver):
+    """Returns the norms and inputs cached for the device used with the
+    given driver, like get_device_information does, or None if they are not
+    cached. Entries of a device whose node was replaced are dropped.
+    """
+    cache = load_cache(DEVICES_CACHE_FILENAME)
+    key = '%s:%s' % (driver, device)
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    if entry.get('identity') != get_device_identity(device):
+        del cache[key]
+        save_cache(DEVICES_CACHE_FILENAME, cache)
+        return None
+    return {'norms': [tuple(pair) for pair in entry['norms']],
+            'inputs': [tuple(pair) for pair in entry['inputs']],
+            'timed_out': False}
+
+
+def cache_device_information(device, driver, dev_info):
+    """Caches the norms and inputs of the device used with the given driver,
+    as returned by get_device_information
+    """
+    identity = get_device_identity(device)
+    if identity is None or dev_info.get('timed_out'):
+        return
+    cache = load_cache(DEVICES_CACHE_FILENAME)
+    cache['%s:%s' % (driver, device)] = {'identity': identity,
+                                         'norms': dev_info['norms'],
+                                         'inputs': dev_info['inputs']}
+    save_cache(DEVICES_CACHE_FILENAME, cache)
+
+
+def make_filename(filename, channel_text, append_suffix=True, root=None):
     """Generates the filename given the filename template and filling the
     variables with the date (channel or date)
+    root is the output directory the template is relative to, chosen from
+    the output_roots (only the name of absolute templates is used)
     """
     def repl_func(match, now):
         year   = now[0]
@@ -141,6 +469,11 @@ def make_filename(filename, channel_text, append_suffix=True):
 
         return text[1:-1]
 
+    if root:
+        if os.path.isabs(filename):
+            filename = os.path.basename(filename)
+        filename = os.path.join(root, filename)
+
     new_filename = filename.replace('{channel}', channel_text)
     now    = time.localtime()
     new_filename = re.sub('{[^}]*?}', lambda x: repl_func(x, now), new_filename)
@@ -177,13 +510,25 @@ def secs_to_str(seconds):
     return "%.2d:%.2d:%.2d" % (hours, mins, secs)
 
 
+def str_to_secs(text):
+    """Convert a time in hh:mm:ss (or mm:ss, or ss) to a number of seconds.
+    Returns None if it is empty or not valid."""
+    try:
+        seconds = 0
+        for part in text.split(':'):
+            seconds = seconds * 60 + int(part)
+        return seconds
+    except (AttributeError, ValueError):
+        return None
+
+
 def save_configuration(parameters, config_filename=None):
     """Saves the current configuration to the .ini file
     """
 
     config = ConfigParser.ConfigParser()
     if not config_filename:
-        config_dir = os.path.join(os.path.expanduser("~"), '.mtvcgui')
+        config_dir = get_config_dir()
         config_filename = os.path.join(config_dir, 'mtvcgui.ini')
     else:
         config_dir = os.path.dirname(config_filename)
@@ -217,46 +562,243 @@ def save_configuration(parameters, config_filename=None):
         print "Error trying to save configuration to %s" % (config_filename, )
 
 
-def generate_command(parameters, preview=False):
-    """Generates a command for mencoder with current parameters.
-    preview command generates a string to be displayed on screen, instead of
-    a list of parameters for executing subprocess"""
+def parse_envvars(text):
+    """Parses environment variables given as KEY=value lines and returns
+    them in a dictionary
+    """
+    envvars = {}
+    for lines in text.split('\n'):
+        keyval = lines.split('=', 1)
+        if len(keyval) == 2:
+            key = keyval[0].strip()
+            val = keyval[1].strip()
+            envvars[key] = val
+    return envvars
+
+
+def get_advanced_parameters(config_filename=None):
+    """Returns the parameters in ADVANCED_PARAMETERS as saved in the .ini
+    file, or their defaults, and the renditions (see load_renditions)"""
+    if not config_filename:
+        config_filename = os.path.join(get_config_dir(), 'mtvcgui.ini')
+    config = ConfigParser.ConfigParser()
+    config.read(config_filename)
+    parameters = {}
+    for parm, default in ADVANCED_PARAMETERS.items():
+        parameters[parm] = default
+        if not config.has_option('mencoder GUI', parm):
+            continue
+        value = config.get('mencoder GUI', parm)
+        try:
+            if isinstance(default, bool):
+                parameters[parm] = value == 'True'
+            else:
+                parameters[parm] = type(default)(value)
+        except ValueError:
+            print "Invalid value for %s in %s" % (parm, config_filename)
+    parameters['renditions'] = load_renditions(config_filename)
+    return parameters
+
+
+def load_parameters(config_filename=None):
+    """Loads the parameters saved in the .ini file and returns them like
+    MainWindow.get_params_from_gui does, so they can be used to generate the
+    commands without the GUI. Returns None if there is no configuration.
+    """
+    if not config_filename:
+        config_filename = os.path.join(get_config_dir(), 'mtvcgui.ini')
+    config = ConfigParser.ConfigParser()
+    config.read(config_filename)
+    if not config.has_section('mencoder GUI'):
+        return None
+
+    parameters = dict(config.items('mencoder GUI'))
+
+    for parm, values in INDEX_PARAMETERS:
+        try:
+            parameters[parm] = values[int(parameters.get(parm))]
+        except (TypeError, ValueError, IndexError):
+            pass
+
+    for parm in BOOLEAN_PARAMETERS:
+        parameters[parm] = parameters.get(parm) == 'True'
+
+    parameters['envvars'] = parse_envvars(parameters.get('envvars', ''))
+    parameters.update(get_advanced_parameters(config_filename))
+
+    if parameters.get('duration') == '00:00:00':
+        parameters['duration'] = ''
+
+    if parameters.get('channel_type', 'number') == 'number':
+        parameters['channel_text'] = parameters.get('channel')
+    else:
+        parameters['channel_text'] = parameters.get('frequency')
+
+    return parameters
+
+
+def load_section(section, config_filename=None):
+    """Returns the parameters set in another section of the .ini file (e.g.
+    [transcode]) converted like load_parameters does, to override the ones
+    of the main section. Returns an empty dict if there is no section."""
+    if not config_filename:
+        config_filename = os.path.join(get_config_dir(), 'mtvcgui.ini')
+    config = ConfigParser.ConfigParser()
+    config.read(config_filename)
+    if not config.has_section(section):
+        return {}
+
+    parameters = dict(config.items(section))
+
+    for parm, values in INDEX_PARAMETERS:
+        if parm in parameters:
+            try:
+                parameters[parm] = values[int(parameters.get(parm))]
+            except (TypeError, ValueError, IndexError):
+                pass
+
+    for parm in BOOLEAN_PARAMETERS:
+        if parm in parameters:
+            parameters[parm] = parameters.get(parm) == 'True'
+
+    return parameters
+
+
+def load_renditions(config_filename=None):
+    """Returns the (name, parameters) of the [rendition NAME] sections of
+    the .ini file, extra outputs encoded from the same capture with the
+    parameters of the section replacing the ones of the recording"""
+    if not config_filename:
+        config_filename = os.path.join(get_config_dir(), 'mtvcgui.ini')
+    config = ConfigParser.ConfigParser()
+    config.read(config_filename)
+    return [(section[len(RENDITION_SECTION):].strip(),
+             load_section(section, config_filename))
+            for section in config.sections()
+            if section.startswith(RENDITION_SECTION)]
+
+
+def get_rendition_parameters(parameters, overrides):
+    """Returns the parameters to encode a rendition of a capture made with
+    parameters. The extra filters, output frame rate and extra parameters
+    are applied once to the capture, the ones of the rendition are used
+    only if it sets them."""
+    rendition = dict(parameters)
+    for parm in ('extrafilters', 'ofps', 'extramencoderparms'):
+        rendition[parm] = ''
+    rendition.update(overrides)
+    return rendition
+
+
+def set_cloexec(fd):
+    """Makes the child processes (e.g. mencoder) not inherit fd. Otherwise
+    they would keep pipes and sockets open after we close them."""
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+
+def run_user_command(command_line):
+    """Runs a command given by the user (e.g. the pre and post capture
+    commands) splitting it by spaces. Raises OSError if it can't be run.
+    """
+    cmds = [c for c in re.split("\s+", command_line) if c]
+    if cmds:
+        return call(cmds)
+
+
+def estimate_bitrate(parameters):
+    """Returns the approximate kbit/s of a recording with the parameters,
+    from the bitrates set for the codecs or a generous default"""
+    bitrates = {'lavc': ('lavc_videobitrate', 'lavc_audiobitrate'),
+                'xvid': ('xvid_bitrate', None),
+                'x264': ('x264_bitrate', None),
+                'mp3lame': (None, 'lame_audiobitrate')}
+    video = bitrates.get(parameters.get('videocodec'), (None, None))[0]
+    audio = bitrates.get(parameters.get('audiocodec'), (None, None))[1]
+    try:
+        video_bitrate = int(parameters.get(video))
+    except (TypeError, ValueError):
+        video_bitrate = DEFAULT_VIDEO_BITRATE
+        codec = parameters.get('videocodec')
+        if codec == 'lavc':
+            codec = parameters.get('lavc_videocodec')
+        if codec in BITS_PER_PIXEL:
+            width, height = get_frame_size(parameters, scaled=True)
+            video_bitrate = int(width * height * get_capture_fps(parameters)
+                                * BITS_PER_PIXEL[codec] / 1000)
+    try:
+        audio_bitrate = int(parameters.get(audio))
+    except (TypeError, ValueError):
+        audio_bitrate = DEFAULT_AUDIO_BITRATE
+    if parameters.get('audiocodec') == 'none':
+        audio_bitrate = 0
+    elif parameters.get('audiocodec') == 'pcm':
+        #16 bit stereo
+        audio_bitrate = int(parameters.get('audiorate') or 48000) * 32 / 1000
+    return video_bitrate + audio_bitrate
+
+
+def estimate_disk_usage(parameters):
+    """Returns the bytes per second a recording with the parameters writes,
+    the bytes it needs (None if it has no duration) and the bytes free
+    where it is written (None if it can't be known)"""
+    rate = estimate_bitrate(parameters) * 1000 / 8
+    seconds = str_to_secs(parameters.get('duration'))
+    total = seconds and rate * seconds or None
+    directory = os.path.dirname(os.path.abspath(
+        parameters.get('outputfile') or '.'))
+    try:
+        stat = os.statvfs(directory)
+        free = stat.f_bavail * stat.f_frsize
+    except OSError:
+        free = None
+    return rate, total, free
+
+
+def get_frame_size(parameters, scaled=False):
+    """Returns the width and height the device captures, or the ones it is
+    scaled to if scaled is True"""
+    if scaled:
+        try:
+            return (int(parameters.get('scalewidth')),
+                    int(parameters.get('scaleheight')))
+        except (TypeError, ValueError):
+            pass
+    try:
+        return int(parameters.get('tvwidth')), int(parameters.get('tvheight'))
+    except (TypeError, ValueError):
+        pass
+    if get_capture_fps(parameters) < 29:
+        return 720, 576
+    return 720, 480
+
+
+def get_capture_fps(parameters):
+    """Returns the frame rate the encoder has to keep up with: the output
+    frame rate if one is set, otherwise the one of the selected norm"""
+    try:
+        return float(parameters.get('ofps'))
+    except (TypeError, ValueError):
+        pass
+    norm = (parameters.get('norm') or '').upper()
+    if norm.startswith('NTSC') or norm in ('PAL-M', 'PAL-60'):
+        return 29.97
+    return 25.0
+
+
+def generate_tv_params(parameters):
+    """Generates the value of the -tv parameter of mencoder and mplayer,
+    which selects and tunes the capture device, with current parameters"""
 
     channel_type = parameters.get('channel_type', 'number')
     channel = parameters.get('channel')
     frequency = parameters.get('frequency')
-    duration = parameters.get('duration')
     driver = parameters.get('driver')
     device = parameters.get('device')
     norm = parameters.get('norm')
     norm_int = parameters.get('norm_int') or '0'
-    input = parameters.get('input')
     input_int = parameters.get('input_int') or '0'
     chanlist = parameters.get('chanlist')
-    audiocodec = parameters.get('audiocodec')
-    videocodec = parameters.get('videocodec')
-    append_suffix = parameters.get('append_suffix')
-    lame_audiobitrate = parameters.get('lame_audiobitrate')
-    lame_extra_opts = parameters.get('lame_extra_opts')
-    lavc_audiocodec = parameters.get('lavc_audiocodec')
-    lavc_audiobitrate = parameters.get('lavc_audiobitrate')
-    lavc_audio_extra_opts = parameters.get('lavc_audio_extra_opts')
-    lavc_videocodec = parameters.get('lavc_videocodec')
-    lavc_videobitrate = parameters.get('lavc_videobitrate')
-    lavc_video_extra_opts = parameters.get('lavc_video_extra_opts')
-    xvid_cbr = parameters.get('xvid_cbr')
-    xvid_bitrate = parameters.get('xvid_bitrate')
-    xvid_extra_opts = parameters.get('xvid_extra_opts')
-    xvid_fixed_quant = parameters.get('xvid_fixed_quant')
-    xvid_me_quality = parameters.get('xvid_me_quality')
-    xvid_cartoon = parameters.get('xvid_cartoon')
-    xvid_interlacing = parameters.get('xvid_interlacing')
-    x264_cbr = parameters.get('x264_cbr')
-    x264_bitrate = parameters.get('x264_bitrate')
-    x264_dropdown_value = parameters.get('x264_dropdown_value')
-    x264_qp = parameters.get('x264_qp')
-    x264_crf = parameters.get('x264_crf')
-    x264_extra_opts = parameters.get('x264_extra_opts')
     tvwidth = parameters.get('tvwidth')
     tvheight = parameters.get('tvheight')
     audiorate = parameters.get('audiorate')
@@ -267,20 +809,6 @@ def generate_command(parameters, preview=False):
     hue = parameters.get('hue')
     saturation = parameters.get('saturation')
     extratvparms = parameters.get('extratvparms')
-    scaleheight = parameters.get('scaleheight')
-    scalewidth = parameters.get('scalewidth')
-    ofps = parameters.get('ofps')
-    noskip = parameters.get('noskip')
-    quiet = parameters.get('quiet')
-    extrafilters = parameters.get('extrafilters')
-    extramencoderparms = parameters.get('extramencoderparms')
-    outputfile = parameters.get('outputfile')
-
-    channel_text = parameters.get('channel_text')
-
-    outputfile = make_filename(outputfile, channel_text,
-                               append_suffix=append_suffix)
-
 
     if channel_type == 'frequency':
         tvparms = 'freq=' + frequency
@@ -329,9 +857,39 @@ def generate_command(parameters, preview=False):
     if extratvparms:
         tvparms += ':' + extratvparms
 
-    mencoderparms = ['-tv']
+    return tvparms
+
+
+def generate_filters(parameters):
+    """Generates the -vf parameters (extra filters and scaling) for mencoder
+    and mplayer with current parameters, or an empty list if there are no
+    filters"""
+
+    scaleheight = parameters.get('scaleheight')
+    scalewidth = parameters.get('scalewidth')
+    extrafilters = parameters.get('extrafilters')
+
+    if extrafilters or (scalewidth and scaleheight):
+        filters = []
+        if extrafilters:
+            filters.append(extrafilters)
+        if scaleheight:
+            filters.append("scale=%s:%s" % (scalewidth, scaleheight) )
 
-    mencoderparms.append(tvparms)
+        filters = ','.join(filters)
+
+        return ['-vf', filters]
+    return []
+
+
+def generate_codec_params(parameters):
+    """Generates the mencoder parameters that select the audio and video
+    codecs with current parameters"""
+
+    audiocodec = parameters.get('audiocodec')
+    videocodec = parameters.get('videocodec')
+
+    mencoderparms = []
 
     if audiocodec == 'none':
         mencoderparms.append('-nosound')
@@ -340,30 +898,152 @@ def generate_command(parameters, preview=False):
 
     mencoderparms += ['-ovc', videocodec]
 
-    if duration:
-        mencoderparms += ['-endpos', duration]
+    return mencoderparms
 
-    if ofps:
-        mencoderparms += ['-ofps', ofps]
 
-    if noskip:
-        mencoderparms.append('-noskip')
+def parse_cpu_list(text):
+    """Returns the CPU numbers of a list like 0-3,8,10-11"""
+    cpus = []
+    for part in text.strip().split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
 
-    if quiet:
-        mencoderparms.append('-quiet')
 
+def get_allowed_cpus():
+    """Returns the numbers of the CPUs the process may run on (its affinity,
+    e.g. set with taskset), all of them if it can't be read"""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('Cpus_allowed_list:'):
+                    cpus = parse_cpu_list(line.split(':', 1)[1])
+                    if cpus:
+                        return cpus
+    except (IOError, ValueError):
+        pass
+    try:
+        return range(max(1, os.sysconf('SC_NPROCESSORS_ONLN')))
+    except (ValueError, OSError):
+        return [0]
 
-    if extrafilters or (scalewidth and scaleheight):
-        filters = []
-        if extrafilters:
-            filters.append(extrafilters)
-        if scaleheight:
-            filters.append("scale=%s:%s" % (scalewidth, scaleheight) )
 
-        filters = ','.join(filters)
+def read_cgroup_file(directories, name):
+    """Returns the contents of the file name in the first of the cgroup
+    directories that has it, or None"""
+    for directory in directories:
+        try:
+            with open(os.path.join(directory, name)) as cgroup_file:
+                return cgroup_file.read().strip()
+        except IOError:
+            #missing or unreadable, the next one may do
+            continue
+    return None
+
+
+def get_cpu_quota():
+    """Returns how many CPUs the cgroup of the process may use (e.g. 1.5 in
+    a container started with --cpus=1.5), or None if it has no limit"""
+    #controller: path of the cgroup of the process, '' for cgroup v2
+    cgroups = {}
+    try:
+        with open('/proc/self/cgroup') as cgroup_file:
+            for line in cgroup_file:
+                hierarchy, controllers, path = line.strip().split(':', 2)
+                for controller in controllers.split(','):
+                    cgroups[controller] = path.lstrip('/')
+    except (IOError, ValueError):
+        pass
+    quotas = []
+    if '' in cgroups:
+        #"max 100000" without a limit, or "<quota> <period>"
+        cpu_max = read_cgroup_file([os.path.join(CGROUP_ROOT, cgroups['']),
+                                    CGROUP_ROOT], 'cpu.max')
+        try:
+            quota, period = cpu_max.split()
+            quotas.append(float(quota) / int(period))
+        except (AttributeError, ValueError):
+            pass
+    if 'cpu' in cgroups:
+        directories = []
+        for base in ('cpu', 'cpu,cpuacct'):
+            directories += [os.path.join(CGROUP_ROOT, base, cgroups['cpu']),
+                            os.path.join(CGROUP_ROOT, base)]
+        #the quota is -1 without a limit
+        try:
+            quota = int(read_cgroup_file(directories, 'cpu.cfs_quota_us'))
+            period = int(read_cgroup_file(directories, 'cpu.cfs_period_us'))
+            if quota > 0 and period > 0:
+                quotas.append(float(quota) / period)
+        except (TypeError, ValueError):
+            pass
+    return quotas and min(quotas) or None
+
+
+def get_available_cpus():
+    """Returns how many CPUs the process can use, from its affinity and the
+    CPU quota of its cgroup, at least one"""
+    cpus = len(get_allowed_cpus())
+    quota = get_cpu_quota()
+    if quota:
+        #a quota of 1.5 CPUs keeps 2 threads busy most of the time
+        cpus = min(cpus, int(-(-quota // 1)))
+    return max(1, cpus)
+
+
+def get_encoder_threads(parameters):
+    """Returns the threads the video encoder must use: encoder_threads, set
+    in the .ini file or by the RecordingManager to share the CPUs between
+    recordings, or else the CPUs available"""
+    try:
+        threads = int(parameters.get('encoder_threads') or 0)
+    except ValueError:
+        threads = 0
+    return threads > 0 and threads or get_available_cpus()
+
 
-        mencoderparms += ['-vf', filters]
+def has_option(options, name):
+    """Returns True if the colon separated encoder options (e.g. the extra
+    options of the user) set name"""
+    return name in [option.split('=', 1)[0]
+                    for option in (options or '').split(':')]
+
+
+def generate_encoder_options(parameters):
+    """Generates the options of the selected audio and video encoders
+    (-lavcopts, -lameopts, -xvidencopts, -x264encopts) with current
+    parameters. The video encoders use the threads of get_encoder_threads
+    unless their extra options set them."""
+
+    audiocodec = parameters.get('audiocodec')
+    videocodec = parameters.get('videocodec')
+    lame_audiobitrate = parameters.get('lame_audiobitrate')
+    lame_extra_opts = parameters.get('lame_extra_opts')
+    lavc_audiocodec = parameters.get('lavc_audiocodec')
+    lavc_audiobitrate = parameters.get('lavc_audiobitrate')
+    lavc_audio_extra_opts = parameters.get('lavc_audio_extra_opts')
+    lavc_videocodec = parameters.get('lavc_videocodec')
+    lavc_videobitrate = parameters.get('lavc_videobitrate')
+    lavc_video_extra_opts = parameters.get('lavc_video_extra_opts')
+    xvid_cbr = parameters.get('xvid_cbr')
+    xvid_bitrate = parameters.get('xvid_bitrate')
+    xvid_extra_opts = parameters.get('xvid_extra_opts')
+    xvid_fixed_quant = parameters.get('xvid_fixed_quant')
+    xvid_me_quality = parameters.get('xvid_me_quality')
+    xvid_cartoon = parameters.get('xvid_cartoon')
+    xvid_interlacing = parameters.get('xvid_interlacing')
+    x264_cbr = parameters.get('x264_cbr')
+    x264_bitrate = parameters.get('x264_bitrate')
+    x264_dropdown_value = parameters.get('x264_dropdown_value')
+    x264_qp = parameters.get('x264_qp')
+    x264_crf = parameters.get('x264_crf')
+    x264_extra_opts = parameters.get('x264_extra_opts')
+    threads = get_encoder_threads(parameters)
 
+    mencoderparms = []
 
     lavcopts = []
     if audiocodec == 'lavc' and (lavc_audiocodec or lavc_audiobitrate):
@@ -379,6 +1059,8 @@ def generate_command(parameters, preview=False):
             lavcopts.append("vcodec=" + lavc_videocodec)
         if lavc_videobitrate:
             lavcopts.append("vbitrate=" + lavc_videobitrate)            
+        if not has_option(lavc_video_extra_opts, 'threads'):
+            lavcopts.append("threads=%d" % min(threads, LAVC_MAX_THREADS))
         if lavc_video_extra_opts:
             lavcopts.append(lavc_video_extra_opts)
         
@@ -410,6 +1092,8 @@ def generate_command(parameters, preview=False):
             xvidencopts.append("cartoon")
         if xvid_interlacing:
             xvidencopts.append("interlacing")
+        if not has_option(xvid_extra_opts, 'threads'):
+            xvidencopts.append("threads=%d" % threads)
         if xvid_extra_opts:
             xvidencopts.extend(xvid_extra_opts.split(":"))
         
@@ -425,6 +1109,8 @@ def generate_command(parameters, preview=False):
             x264encopts.append("qp=" + x264_qp)
         if not x264_cbr and x264_crf and x264_dropdown_value == 'crf':
             x264encopts.append("crf=" + x264_crf)
+        if not has_option(x264_extra_opts, 'threads'):
+            x264encopts.append("threads=%d" % threads)
         if x264_extra_opts:
             x264encopts.extend(x264_extra_opts.split(":"))
             
@@ -432,6 +1118,65 @@ def generate_command(parameters, preview=False):
             x264encopts = ':'.join(x264encopts)
             mencoderparms += ['-x264encopts', x264encopts]
 
+    return mencoderparms
+
+
+def generate_command(parameters, preview=False, outputfile=None,
+                     output_format=None, raw=False):
+    """Generates a command for mencoder with current parameters.
+    preview command generates a string to be displayed on screen, instead of
+    a list of parameters for executing subprocess
+    outputfile is used instead of the filename generated from the template
+    if it is given
+    output_format is a container of libavformat (e.g. mpegts) to use instead
+    of AVI
+    raw captures without encoding nor scaling (raw video and PCM audio), for
+    the renditions encoded from it by generate_encode_command"""
+
+    if raw:
+        parameters = dict(parameters, videocodec='raw', scalewidth='',
+                          scaleheight='')
+        if parameters.get('audiocodec') != 'none':
+            parameters['audiocodec'] = 'pcm'
+
+    duration = parameters.get('duration')
+    append_suffix = parameters.get('append_suffix')
+    ofps = parameters.get('ofps')
+    noskip = parameters.get('noskip')
+    quiet = parameters.get('quiet')
+    extramencoderparms = parameters.get('extramencoderparms')
+    channel_text = parameters.get('channel_text')
+
+    if not outputfile:
+        outputfile = make_filename(parameters.get('outputfile'), channel_text,
+                                   append_suffix=append_suffix)
+
+    mencoderparms = ['-tv']
+
+    mencoderparms.append(generate_tv_params(parameters))
+
+    mencoderparms += generate_codec_params(parameters)
+
+    if duration:
+        mencoderparms += ['-endpos', duration]
+
+    if ofps:
+        mencoderparms += ['-ofps', ofps]
+
+    if noskip:
+        mencoderparms.append('-noskip')
+
+    if quiet:
+        mencoderparms.append('-quiet')
+
+    mencoderparms += generate_filters(parameters)
+
+    mencoderparms += generate_encoder_options(parameters)
+
+    if output_format:
+        mencoderparms += ['-of', 'lavf', '-lavfopts',
+                          'format=' + output_format]
+
     if extramencoderparms:
         for extraparm in extramencoderparms.split(' '):
             mencoderparms.append(extraparm)
@@ -446,6 +1191,24 @@ def generate_command(parameters, preview=False):
         return command
 
 
+def generate_encode_command(parameters, inputs, outputfile, extra=None):
+    """Generates the mencoder command that encodes the input files (a
+    recording, or - for the stream of a raw capture) to outputfile with the
+    codecs of the parameters. extra are added before the output, e.g. to
+    encode only a part."""
+    command = ['mencoder'] + list(inputs)
+    command += generate_codec_params(parameters)
+    if parameters.get('ofps'):
+        command += ['-ofps', parameters.get('ofps')]
+    command += generate_filters(parameters)
+    command += generate_encoder_options(parameters)
+    if parameters.get('extramencoderparms'):
+        command += parameters.get('extramencoderparms').split()
+    command += list(extra or [])
+    command += ['-o', outputfile]
+    return command
+
+
 def generate_mplayer_command(parameters, extra_params=None, as_string=False):
     """Generates a command for mplayer, for channel preview
        extra mplayer parameters may be passed as a list in extra_params
@@ -453,83 +1216,12 @@ def generate_mplayer_command(parameters, extra_params=None, as_string=False):
        of a list of values [command, arg1, arg2, arg3,...]
     """
 
-    channel_type = parameters.get('channel_type', 'number')
-    channel = parameters.get('channel')
-    frequency = parameters.get('frequency')
-    driver = parameters.get('driver')
-    device = parameters.get('device')
-    norm = parameters.get('norm')
-    norm_int = parameters.get('norm_int') or '0'
-    input = parameters.get('input')
-    input_int = parameters.get('input_int') or '0'
-    chanlist = parameters.get('chanlist')
-    tvwidth = parameters.get('tvwidth')
-    tvheight = parameters.get('tvheight')
-    extratvparms = parameters.get('extratvparms')
     extramplayerparms = parameters.get('extramplayerparms')
-    audiorate = parameters.get('audiorate')
-    alsa_audio = parameters.get('alsa_audio')
-    adevice = parameters.get('adevice')
-    brightness = parameters.get('brightness')
-    contrast = parameters.get('contrast')
-    hue = parameters.get('hue')
-    saturation = parameters.get('saturation')
-    scaleheight = parameters.get('scaleheight')
-    scalewidth = parameters.get('scalewidth')
     ofps = parameters.get('ofps')
-    extrafilters = parameters.get('extrafilters')
-
-
-    channel_text = parameters.get('channel_text')
-
-    if channel_type == 'frequency':
-        tvparms = 'freq=' + frequency
-    else:
-        tvparms = 'channel=' + channel
-
-    tvparms  += ':driver=' + driver
-    tvparms += ':device=' + device
-
-    if norm and norm != '-1':
-        if driver == 'v4l2':
-            tvparms += ':normid=' + norm_int
-        else:
-            tvparms += ':norm=' + norm_int
-
-    tvparms += ':input=' + input_int
-    tvparms += ':chanlist=' + chanlist
-
-    if tvwidth and tvheight:
-        tvparms += ':width=' + tvwidth
-        tvparms += ':height=' + tvheight
-
-    if audiorate:
-        tvparms += ':audiorate=' + audiorate
-
-    if alsa_audio:
-        tvparms += ":alsa"
-        if adevice:
-            tvparms += ":adevice=" + adevice
-
-    if brightness:
-        tvparms += ':brightness=' + brightness
-
-    if contrast:
-        tvparms += ':contrast=' + contrast
-
-    if hue:
-        tvparms += ':hue=' + hue
-
-    if saturation:
-        tvparms += ':saturation=' + saturation
-
-
-    if extratvparms:
-        tvparms += ':' + extratvparms
 
     mencoderparms = ['-tv']
 
-    mencoderparms.append(tvparms)
+    mencoderparms.append(generate_tv_params(parameters))
 
     if ofps:
         mencoderparms += ['-fps', ofps]
@@ -540,16 +1232,7 @@ def generate_mplayer_command(parameters, extra_params=None, as_string=False):
     else:
         mencoderparms.append('-quiet')
 
-    if extrafilters or (scalewidth and scaleheight):
-        filters = []
-        if extrafilters:
-            filters.append(extrafilters)
-        if scaleheight:
-            filters.append("scale=%s:%s" % (scalewidth, scaleheight) )
-
-        filters = ','.join(filters)
-        
-        mencoderparms += ['-vf', filters]
+    mencoderparms += generate_filters(parameters)
     
     if extramplayerparms:
         for param in extramplayerparms.split():